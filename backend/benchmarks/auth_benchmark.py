@@ -0,0 +1,58 @@
+"""
+Microbenchmark da autenticação (get_current_user) com e sem o cache de tokens.
+
+Uso (a partir de backend/):
+    python benchmarks/auth_benchmark.py
+    python benchmarks/auth_benchmark.py --iterations 20000
+
+Frio: o cache é limpo antes de cada chamada (jwt.decode + SELECT do usuário).
+Quente: o mesmo token já validado (só a consulta ao cache).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def measure(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+def run(iterations: int):
+    workdir = tempfile.mkdtemp(prefix="buresidian-bench-")
+    os.environ["BURESIDIAN_DB"] = os.path.join(workdir, "bench.db")
+    sys.modules.pop("main", None)
+    import main
+    from fastapi.security import HTTPAuthorizationCredentials
+
+    main.init_db()
+    token = main.create_access_token(data={"sub": "demo"})
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+    def cold():
+        main.auth_cache.clear()
+        main.get_current_user(credentials)
+
+    def warm():
+        main.get_current_user(credentials)
+
+    cold_us = measure(cold, iterations)
+    main.get_current_user(credentials)
+    warm_us = measure(warm, iterations)
+
+    print(f"{iterations} chamadas de get_current_user")
+    print(f"  frio  (jwt.decode + SELECT): {cold_us:8.1f} µs/chamada")
+    print(f"  quente (cache):              {warm_us:8.1f} µs/chamada  ({cold_us / warm_us:.0f}x)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+    run(args.iterations)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark do modelo de grafo em memória (/notes/graph e /api/graph/connections).
+
+Uso (a partir de backend/):
+    python benchmarks/graph_benchmark.py
+    python benchmarks/graph_benchmark.py --sizes 1000 10000
+
+Para cada tamanho cria um banco temporário com notas sintéticas (links, tags e
+menções), e mede: montagem a frio, resposta em cache e a primeira resposta
+depois de editar e de renomear uma nota.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+WORDS = ["projeto", "reunião", "ideia", "tarefa", "leitura", "código", "banco", "grafo",
+         "nota", "viagem", "estudo", "design", "cliente", "backend", "frontend", "teste"]
+TAGS = ["projeto", "ideia", "tarefa", "leitura", "estudo", "cliente", "dev", "pessoal"]
+
+def populate(main, size: int, seed: int = 42):
+    rng = random.Random(seed)
+    titles = [f"{rng.choice(WORDS).title()} {i}" for i in range(size)]
+    rows = []
+    for i, title in enumerate(titles):
+        words = [rng.choice(WORDS) for _ in range(40)]
+        for _ in range(3):
+            words.insert(rng.randrange(len(words)), f"[[{rng.choice(titles)}]]")
+        words.insert(rng.randrange(len(words)), f"#{rng.choice(TAGS)}/{rng.randrange(max(1, size // 25))}")
+        words.insert(rng.randrange(len(words)), rng.choice(titles))
+        rows.append((title, " ".join(words), 1))
+
+    with main.db_write() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO notes (title, content, user_id) VALUES (?, ?, ?)", rows)
+        main.rebuild_note_indexes(cursor)
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+def run(size: int):
+    workdir = tempfile.mkdtemp(prefix="buresidian-bench-")
+    os.environ["BURESIDIAN_DB"] = os.path.join(workdir, "bench.db")
+    sys.modules.pop("main", None)
+    import main
+
+    main.init_db()
+    _, populate_ms = timed(lambda: populate(main, size))
+
+    results = {"size": size, "populate_ms": populate_ms}
+    for name, builder, needs_mentions in (("notes_graph", main.build_notes_graph, True),
+                                          ("graph_connections", main.build_graph_connections, False)):
+        def serve():
+            return main.graph_cache.get(1).view(name, builder, needs_mentions=needs_mentions)
+
+        main.graph_cache.clear()
+        payload, cold_ms = timed(serve)
+        _, warm_ms = timed(serve)
+
+        # Editar o conteúdo de uma nota invalida só ela
+        with main.db_write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE notes SET content = ? WHERE id = 1", ("editada [[Projeto 2]] #nova",))
+            main.sync_note_indexes(cursor, 1, 1, content="editada [[Projeto 2]] #nova")
+        _, edit_ms = timed(serve)
+
+        # Renomear muda as menções em qualquer nota
+        with main.db_write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT title FROM notes WHERE id = 2")
+            previous_title = cursor.fetchone()[0]
+            new_title = f"Renomeada {name}"
+            cursor.execute("UPDATE notes SET title = ? WHERE id = 2", (new_title,))
+            main.sync_note_indexes(cursor, 2, 1, title=new_title, previous_title=previous_title)
+        _, rename_ms = timed(serve)
+
+        results[name] = {
+            "edges": len(payload["edges"]),
+            "cold_ms": cold_ms,
+            "warm_ms": warm_ms,
+            "after_edit_ms": edit_ms,
+            "after_rename_ms": rename_ms,
+        }
+
+    main.db_pool.close()
+    return results
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    print(f"{'notas':>7} {'view':<18} {'arestas':>9} {'frio (ms)':>11} {'cache (ms)':>11} "
+          f"{'após edição (ms)':>17} {'após renomear (ms)':>19}")
+    for size in args.sizes:
+        results = run(size)
+        for name in ("notes_graph", "graph_connections"):
+            r = results[name]
+            print(f"{size:>7} {name:<18} {r['edges']:>9} {r['cold_ms']:>11.1f} {r['warm_ms']:>11.3f} "
+                  f"{r['after_edit_ms']:>17.1f} {r['after_rename_ms']:>19.1f}")
+
+if __name__ == "__main__":
+    main_cli()
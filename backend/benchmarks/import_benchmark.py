@@ -0,0 +1,101 @@
+"""
+Benchmark da importação em lote (POST /import) contra notas criadas uma a uma.
+
+Uso (a partir de backend/):
+    python benchmarks/import_benchmark.py
+    python benchmarks/import_benchmark.py --notes 20000 --baseline 1000
+
+Gera um vault sintético (pastas, [[links]] e #tags) como zip de Markdown e
+como NDJSON, importa cada um num banco temporário novo e mostra notas/s.
+A linha de base cria --baseline notas pelo caminho do POST /notes
+(create_note: uma transação e uma indexação por nota).
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+WORDS = ["projeto", "reunião", "ideia", "tarefa", "leitura", "código", "banco", "grafo",
+         "nota", "viagem", "estudo", "design", "cliente", "backend", "frontend", "teste"]
+TAGS = ["projeto", "ideia/nova", "tarefa", "leitura", "estudo/curso", "cliente", "dev", "pessoal"]
+FOLDERS = ["", "Projetos", "Projetos/Ativos", "Diário", "Referências/Livros"]
+
+def synthetic_notes(size: int, seed: int = 42):
+    rng = random.Random(seed)
+    titles = [f"{rng.choice(WORDS).title()} {i}" for i in range(size)]
+    for i, title in enumerate(titles):
+        words = [rng.choice(WORDS) for _ in range(60)]
+        words += [f"[[{rng.choice(titles)}]]" for _ in range(3)]
+        words += [f"#{rng.choice(TAGS)}" for _ in range(2)]
+        rng.shuffle(words)
+        yield {"title": title, "content": " ".join(words), "folder": FOLDERS[i % len(FOLDERS)]}
+
+def build_zip(size: int) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for note in synthetic_notes(size):
+            archive.writestr("/".join(part for part in (note["folder"], note["title"] + ".md") if part),
+                             note["content"])
+    return buffer.getvalue()
+
+def build_ndjson(size: int) -> bytes:
+    return "".join(json.dumps(note, ensure_ascii=False) + "\n" for note in synthetic_notes(size)).encode()
+
+def fresh_main(workdir: str, name: str):
+    os.environ["BURESIDIAN_DB"] = os.path.join(workdir, f"{name}.db")
+    sys.modules.pop("main", None)
+    import main
+    main.init_db()
+    return main
+
+def run_import(workdir: str, format: str, payload: bytes) -> dict:
+    main = fresh_main(workdir, f"import-{format}")
+    path = os.path.join(workdir, f"vault.{format}")
+    with open(path, "wb") as target:
+        target.write(payload)
+    job = main.VaultImport(format, 1, path, format, len(payload))
+    asyncio.run(job.run())
+    status = job.status()
+    main.db_pool.close()
+    return status
+
+def run_baseline(workdir: str, size: int) -> float:
+    main = fresh_main(workdir, "baseline")
+    user = {"id": 1, "username": "demo"}
+    start = time.perf_counter()
+    for note in synthetic_notes(size):
+        main.create_note(main.NoteCreate(title=note["title"], content=note["content"]), user)
+    elapsed = time.perf_counter() - start
+    main.db_pool.close()
+    return size / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=5000)
+    parser.add_argument("--baseline", type=int, default=500, help="notas criadas uma a uma (0 = pular)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="buresidian-import-")
+    os.chdir(workdir)  # uploads/ é criado no diretório atual
+    for format, build in (("zip", build_zip), ("ndjson", build_ndjson)):
+        payload = build(args.notes)
+        status = run_import(workdir, format, payload)
+        if status["state"] != "done":
+            print(f"{format}: FALHA ({status['error']})")
+            sys.exit(1)
+        print(f"{format:6}: {status['notes_imported']} notas, {status['folders_created']} pastas, "
+              f"{len(payload) / 1024 / 1024:.1f} MB em {status['elapsed_seconds']:.2f}s "
+              f"({status['notes_per_second']:.0f} notas/s)")
+    if args.baseline:
+        print(f"uma a uma (create_note): {run_baseline(workdir, args.baseline):.0f} notas/s")
+
+if __name__ == "__main__":
+    main()
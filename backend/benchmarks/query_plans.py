@@ -0,0 +1,124 @@
+"""
+Teste dos planos de execução (EXPLAIN QUERY PLAN) das consultas mais usadas.
+
+Uso (a partir de backend/):
+    python benchmarks/query_plans.py
+    python benchmarks/query_plans.py --verbose
+
+Cria um banco temporário com init_db (schema + migrações) e confere que cada
+consulta quente usa índice: qualquer passo "SCAN" sobre uma tabela é falha.
+Ordenação em B-tree temporária só aparece como aviso. Sai com código 1 se
+alguma consulta cair em varredura completa.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# (nome, SQL, parâmetros) — mesmas consultas dos endpoints
+HOT_QUERIES = [
+    ("notas do usuário (página seguinte)", """
+        SELECT n.id, n.updated_at, n.title, f.name
+        FROM notes n
+        LEFT JOIN folders f ON n.folder_id = f.id
+        WHERE n.user_id = ? AND (n.updated_at, n.id) < (?, ?)
+        ORDER BY n.updated_at DESC, n.id DESC
+        LIMIT ?
+    """, (1, "2024-01-01 00:00:00", 10, 51)),
+    ("notas de uma pasta", """
+        SELECT n.id, n.updated_at, n.title
+        FROM notes n
+        WHERE n.user_id = ? AND n.folder_id = ?
+        ORDER BY n.updated_at DESC, n.id DESC
+        LIMIT ?
+    """, (1, 1, 51)),
+    ("notas apagadas desde", "SELECT note_id FROM note_tombstones WHERE user_id = ? AND deleted_at >= ?",
+     (1, "2024-01-01 00:00:00")),
+    ("nota por id", "SELECT id, title, content, folder_id FROM notes WHERE id = ? AND user_id = ?", (1, 1)),
+    ("pastas do usuário", "SELECT id, name, parent_id FROM folders WHERE user_id = ?", (1,)),
+    ("comentários da nota", """
+        SELECT c.id, c.content, c.created_at, u.username
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.note_id = ?
+        ORDER BY c.created_at ASC
+    """, (1,)),
+    ("reações da nota", """
+        SELECT emoji, COUNT(*) as count
+        FROM reactions
+        WHERE note_id = ?
+        GROUP BY emoji
+        ORDER BY emoji
+    """, (1,)),
+    ("contagem de uma reação", "SELECT COUNT(*) FROM reactions WHERE note_id = ? AND emoji = ?", (1, "x")),
+    ("versões da nota", """
+        SELECT nv.id, nv.version_number, nv.title, nv.change_description,
+               nv.created_at, u.username, COALESCE(nv.content_length, LENGTH(nv.content), 0)
+        FROM note_versions nv
+        JOIN users u ON nv.user_id = u.id
+        WHERE nv.note_id = ? AND (? IS NULL OR nv.version_number < ?)
+        ORDER BY nv.version_number DESC
+        LIMIT ?
+    """, (1, None, None, 51)),
+    ("boards do usuário", """
+        SELECT id, name, owner_id, created_at, updated_at
+        FROM canvas_boards
+        WHERE owner_id = ? OR owner_id IS NULL
+        ORDER BY updated_at DESC
+    """, (1,)),
+    ("nós do board", """
+        SELECT id, type, ref_note_id, text, url, x, y, width, height, color, z_index
+        FROM canvas_nodes WHERE board_id = ?
+        ORDER BY z_index, id
+    """, (1,)),
+    ("arestas do board", """
+        SELECT id, source_node_id, target_node_id, label, style
+        FROM canvas_edges WHERE board_id = ?
+    """, (1,)),
+    ("backlinks", "SELECT source_note_id FROM note_links WHERE user_id = ? AND target_note_id = ?", (1, 1)),
+    ("notas de uma tag", "SELECT note_id FROM note_tags WHERE user_id = ? AND path = ?", (1, "projeto")),
+]
+
+def explain(cursor, sql: str, params) -> list:
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[3] for row in cursor.fetchall()]
+
+def run(verbose: bool) -> bool:
+    workdir = tempfile.mkdtemp(prefix="buresidian-plans-")
+    os.environ["BURESIDIAN_DB"] = os.path.join(workdir, "plans.db")
+    sys.modules.pop("main", None)
+    import main
+
+    main.init_db()
+    failures = 0
+    with main.db_read() as conn:
+        cursor = conn.cursor()
+        print(f"schema_version: {main.current_schema_version(cursor)}")
+        for name, sql, params in HOT_QUERIES:
+            plan = explain(cursor, sql, params)
+            scans = [step for step in plan if step.startswith("SCAN ")]
+            temp_sorts = [step for step in plan if "TEMP B-TREE" in step]
+            label = "FALHA" if scans else "aviso" if temp_sorts else "ok"
+            print(f"  [{label:5}] {name}")
+            if scans or verbose:
+                for step in plan:
+                    print(f"           {step}")
+            failures += bool(scans)
+    main.db_pool.close()
+
+    if failures:
+        print(f"FALHA: {failures} consulta(s) com varredura completa")
+    else:
+        print("OK: todas as consultas usam índice")
+    return not failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verbose", action="store_true", help="mostra o plano de todas as consultas")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.verbose) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark de requisições/s nos endpoints de leitura de notas e de busca.
+
+Uso (a partir de backend/):
+    python benchmarks/read_throughput.py
+    python benchmarks/read_throughput.py --notes 1000 --requests 500 --concurrency 8
+
+Antes/depois: rode uma vez nesta árvore e outra apontando --backend-dir para
+uma cópia anterior do backend, por exemplo:
+    git worktree add /tmp/buresidian-antes <commit> && \\
+    python benchmarks/read_throughput.py --backend-dir /tmp/buresidian-antes/backend
+
+Cria um banco temporário, popula --notes notas pelo POST /notes e mede, com o
+TestClient (sem rede), req/s sequencial e com --concurrency clientes em threads.
+O cache de views fica desligado para medir o trabalho no banco.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+WORDS = ["projeto", "reunião", "ideia", "tarefa", "leitura", "código", "banco", "grafo",
+         "nota", "viagem", "estudo", "design", "cliente", "backend", "frontend", "teste"]
+
+def endpoints(note_ids: list) -> list:
+    """(nome, gerador de URL) — mesmos parâmetros que o frontend usa"""
+    rng = random.Random(7)
+    return [
+        ("GET /notes", lambda: "/notes"),
+        ("GET /notes/{id}", lambda: f"/notes/{rng.choice(note_ids)}"),
+        ("GET /search", lambda: f"/search?q={rng.choice(WORDS)}"),
+        ("GET /search/advanced", lambda: f"/search/advanced?q={rng.choice(WORDS)}"),
+        ("GET /notes/search", lambda: f"/notes/search?query={rng.choice(WORDS)}"),
+        ("GET /api/search/global", lambda: f"/api/search/global?query={rng.choice(WORDS)}"),
+    ]
+
+def populate(client, headers: dict, size: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    note_ids = []
+    for i in range(size):
+        content = " ".join(rng.choice(WORDS) for _ in range(120))
+        response = client.post("/notes", json={"title": f"{rng.choice(WORDS).title()} {i}", "content": content},
+                               headers=headers)
+        response.raise_for_status()
+        note_ids.append(response.json()["id"])
+    return note_ids
+
+def measure(client, headers: dict, url, requests: int, concurrency: int) -> tuple:
+    """(req/s, status da primeira resposta); concurrency > 1 divide as requisições entre threads"""
+    first = client.get(url(), headers=headers)
+    if first.status_code != 200:
+        return None, first.status_code
+
+    def worker(count: int):
+        for _ in range(count):
+            client.get(url(), headers=headers)
+
+    share = max(1, requests // concurrency)
+    threads = [threading.Thread(target=worker, args=(share,)) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return share * concurrency / (time.perf_counter() - start), 200
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="buresidian-read-")
+    os.chdir(workdir)  # versões antigas do backend usam buresidian.db no diretório atual
+    os.environ["BURESIDIAN_DB"] = os.path.join(workdir, "buresidian.db")
+    os.environ["BURESIDIAN_VIEW_CACHE"] = "off"
+    os.environ.setdefault("BURESIDIAN_BCRYPT_ROUNDS", "4")
+    sys.path.insert(0, os.path.abspath(args.backend_dir))
+    sys.modules.pop("main", None)
+    import main
+    from fastapi.testclient import TestClient
+
+    main.init_db()
+    with TestClient(main.app) as client:
+        token = client.post("/auth/login", json={"username": "demo", "password": "demo123"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        note_ids = populate(client, headers, args.notes)
+
+        print(f"backend: {os.path.abspath(args.backend_dir)}  notas: {args.notes}  "
+              f"requisições: {args.requests}")
+        print(f"{'endpoint':<24} {'sequencial':>12} {f'{args.concurrency} threads':>12}")
+        for name, url in endpoints(note_ids):
+            sequential, code = measure(client, headers, url, args.requests, 1)
+            if sequential is None:
+                print(f"{name:<24} {f'HTTP {code}':>12}")
+                continue
+            concurrent, _ = measure(client, headers, url, args.requests, args.concurrency)
+            print(f"{name:<24} {sequential:>10.0f}/s {concurrent:>10.0f}/s")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=300)
+    parser.add_argument("--requests", type=int, default=300, help="requisições por endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--backend-dir", default=BACKEND_DIR, help="diretório do main.py a medir")
+    run(parser.parse_args())
+
+if __name__ == "__main__":
+    main_cli()
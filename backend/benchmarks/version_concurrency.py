@@ -0,0 +1,103 @@
+"""
+Teste de concorrência da numeração de versões (create_note_version).
+
+Uso (a partir de backend/):
+    python benchmarks/version_concurrency.py
+    python benchmarks/version_concurrency.py --threads 16 --processes 4 --saves 50
+
+Várias threads (mesmo pool de conexões) e vários processos (cada um com o seu
+pool, no mesmo arquivo) salvam a mesma nota ao mesmo tempo via update_note.
+Confere no final que os números de versão são únicos e contínuos, que cada
+salvamento foi um commit só e que todas as versões podem ser reconstruídas.
+Sai com código 1 se algo falhar.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def import_main(db_path: str):
+    os.environ["BURESIDIAN_DB"] = db_path
+    sys.modules.pop("main", None)
+    import main
+    return main
+
+def save_many(main, note_id: int, worker: str, saves: int):
+    user = {"id": 1, "username": "demo"}
+    for i in range(saves):
+        content = f"{worker} save {i}\n" + "linha compartilhada\n" * 20
+        main.update_note(note_id, main.NoteUpdate(content=content), user)
+
+def process_worker(db_path: str, note_id: int, worker: str, saves: int):
+    main = import_main(db_path)
+    save_many(main, note_id, worker, saves)
+    main.db_pool.close()
+
+def run(threads: int, processes: int, saves: int) -> bool:
+    workdir = tempfile.mkdtemp(prefix="buresidian-versions-")
+    db_path = os.path.join(workdir, "versions.db")
+    main = import_main(db_path)
+    main.init_db()
+
+    with main.db_write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO notes (title, content, user_id) VALUES ('Concorrência', '', 1)")
+        note_id = cursor.lastrowid
+
+    writes_before = main.db_pool.stats["writes"]
+    start = time.perf_counter()
+
+    workers = [threading.Thread(target=save_many, args=(main, note_id, f"t{i}", saves)) for i in range(threads)]
+    context = multiprocessing.get_context("spawn")
+    workers += [context.Process(target=process_worker, args=(db_path, note_id, f"p{i}", saves))
+                for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    elapsed = time.perf_counter() - start
+    thread_writes = main.db_pool.stats["writes"] - writes_before
+    expected = (threads + processes) * saves
+
+    with main.db_read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version_number FROM note_versions WHERE note_id = ? ORDER BY version_number",
+                       (note_id,))
+        numbers = [row[0] for row in cursor.fetchall()]
+        contents = main.load_version_contents(cursor, note_id)
+
+    failures = []
+    if numbers != list(range(1, expected + 1)):
+        duplicates = len(numbers) - len(set(numbers))
+        failures.append(f"números de versão: {len(numbers)} (esperado {expected}), {duplicates} repetidos")
+    if thread_writes != threads * saves:
+        failures.append(f"commits nas threads: {thread_writes} (esperado {threads * saves})")
+    if len(contents) != len(numbers) or any(content is None for content in contents.values()):
+        failures.append("versões que não puderam ser reconstruídas")
+    if any(process.exitcode != 0 for process in workers if isinstance(process, context.Process)):
+        failures.append("processo terminou com erro")
+
+    print(f"{threads} threads + {processes} processos x {saves} salvamentos: "
+          f"{len(numbers)} versões em {elapsed:.2f}s ({expected / elapsed:.0f} salvamentos/s)")
+    for failure in failures:
+        print(f"FALHA: {failure}")
+    if not failures:
+        print("OK: números únicos e contínuos, um commit por salvamento")
+    return not failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--saves", type=int, default=50)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.threads, args.processes, args.saves) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Teste de carga: latência dos broadcasts de WebSocket com o grafo sendo montado.
+
+Uso (a partir de backend/):
+    python benchmarks/ws_latency.py
+    python benchmarks/ws_latency.py --notes 20000 --messages 1000 --heavy-clients 2
+
+Dois clientes entram em /ws/notes/1; um manda "version_created" a cada
+--interval ms e o outro mede quanto cada broadcast leva para chegar. Mede
+primeiro sem carga e depois com --heavy-clients threads pedindo sem parar
+GET /api/graph/connections com o cache do grafo esvaziado a cada pedido
+(montagem a frio sobre --notes notas). Mostra p50/p95/p99 das duas fases e sai
+com código 1 se o p99 com carga passar de --max-p99-ratio vezes o p99 sem carga
+(com folga mínima de --slack-ms).
+
+Montar o grafo é CPU em Python: mesmo fora do event loop disputa o GIL, então
+cada pedido pesado a mais em paralelo soma alguns ms (o intervalo de troca do
+GIL) à latência dos broadcasts.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+WORDS = ["projeto", "reunião", "ideia", "tarefa", "leitura", "código", "banco", "grafo",
+         "nota", "viagem", "estudo", "design", "cliente", "backend", "frontend", "teste"]
+TAGS = ["projeto", "ideia", "tarefa", "leitura", "estudo", "cliente", "dev", "pessoal"]
+
+def populate(main, size: int, seed: int = 42):
+    rng = random.Random(seed)
+    titles = [f"{rng.choice(WORDS).title()} {i}" for i in range(size)]
+    rows = []
+    for title in titles:
+        words = [rng.choice(WORDS) for _ in range(40)]
+        for _ in range(3):
+            words.insert(rng.randrange(len(words)), f"[[{rng.choice(titles)}]]")
+        words.insert(rng.randrange(len(words)), f"#{rng.choice(TAGS)}/{rng.randrange(max(1, size // 25))}")
+        rows.append((title, " ".join(words), 1))
+
+    with main.db_write() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO notes (title, content, user_id) VALUES (?, ?, ?)", rows)
+        main.rebuild_note_indexes(cursor)
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure_broadcasts(client, messages: int, interval: float) -> list:
+    """Latências (ms) de `messages` broadcasts entre dois clientes da mesma nota"""
+    sent = {}
+    latencies = []
+    with client.websocket_connect("/ws/notes/1?user_id=2&username=leitor") as receiver, \
+         client.websocket_connect("/ws/notes/1?user_id=1&username=autor") as sender:
+
+        def receive():
+            while len(latencies) < messages:
+                message = json.loads(receiver.receive_text())
+                if message.get("type") == "version_created":
+                    latencies.append((time.perf_counter() - sent[message["version_number"]]) * 1000)
+
+        reader = threading.Thread(target=receive, daemon=True)
+        reader.start()
+        for sequence in range(messages):
+            sent[sequence] = time.perf_counter()
+            sender.send_text(json.dumps({"type": "version_created", "version_number": sequence,
+                                         "user_id": 1, "username": "autor"}))
+            time.sleep(interval)
+        reader.join(timeout=30)
+    return latencies
+
+def run(args) -> bool:
+    workdir = tempfile.mkdtemp(prefix="buresidian-ws-")
+    os.chdir(workdir)  # uploads/ é criado no diretório atual
+    os.environ["BURESIDIAN_DB"] = os.path.join(workdir, "ws.db")
+    os.environ.setdefault("BURESIDIAN_BCRYPT_ROUNDS", "4")
+    sys.modules.pop("main", None)
+    import main
+    from fastapi.testclient import TestClient
+
+    main.init_db()
+    populate(main, args.notes)
+    interval = args.interval / 1000
+
+    with TestClient(main.app) as client:
+        token = client.post("/auth/login", json={"username": "demo", "password": "demo123"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        idle = measure_broadcasts(client, args.messages, interval)
+
+        stop = threading.Event()
+        builds = []
+
+        def heavy():
+            while not stop.is_set():
+                main.graph_cache.clear()
+                start = time.perf_counter()
+                client.get("/api/graph/connections", headers=headers).raise_for_status()
+                builds.append((time.perf_counter() - start) * 1000)
+
+        workers = [threading.Thread(target=heavy, daemon=True) for _ in range(args.heavy_clients)]
+        for worker in workers:
+            worker.start()
+        while not builds:
+            time.sleep(0.01)  # a primeira montagem já passou: carga estável
+        loaded = measure_broadcasts(client, args.messages, interval)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        executor = client.get("/metrics", headers=headers).json()["database_executor"]
+
+    print(f"notas: {args.notes}  mensagens por fase: {args.messages}  "
+          f"montagens do grafo durante a medição: {len(builds)} "
+          f"(média {sum(builds) / len(builds):.0f} ms)")
+    print(f"{'fase':<12} {'recebidas':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'máx (ms)':>9}")
+    for name, latencies in (("sem carga", idle), ("com grafo", loaded)):
+        print(f"{name:<12} {len(latencies):>9} {percentile(latencies, 0.5):>9.2f} "
+              f"{percentile(latencies, 0.95):>9.2f} {percentile(latencies, 0.99):>9.2f} {max(latencies):>9.2f}")
+    print(f"executor: pico de fila {executor['peak_queued']}, espera máxima {executor['wait_seconds_max']:.3f}s")
+
+    if len(idle) < args.messages or len(loaded) < args.messages:
+        print("FALHA: broadcasts perdidos")
+        return False
+    limit = max(percentile(idle, 0.99) * args.max_p99_ratio, percentile(idle, 0.99) + args.slack_ms)
+    if percentile(loaded, 0.99) > limit:
+        print(f"FALHA: p99 com carga acima de {limit:.2f} ms")
+        return False
+    print(f"OK: p99 com carga dentro de {limit:.2f} ms")
+    return True
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=500, help="broadcasts medidos em cada fase")
+    parser.add_argument("--interval", type=float, default=5, help="ms entre mensagens")
+    parser.add_argument("--heavy-clients", type=int, default=1)
+    parser.add_argument("--max-p99-ratio", type=float, default=3.0)
+    parser.add_argument("--slack-ms", type=float, default=20.0)
+    sys.exit(0 if run(parser.parse_args()) else 1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,24 +1,42 @@
 import os
-from datetime import datetime, timedelta
-from typing import Optional, List
+import re
+import sys
+import io
+import zlib
+import base64
+import zipfile
+import tempfile
+import shutil
+import uuid
+import difflib
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional, List
 import sqlite3
 import time
 import json
 import asyncio
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from functools import wraps
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, WebSocket, WebSocketDisconnect, Query
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, WebSocket, WebSocketDisconnect, Query, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import anyio
 import uvicorn
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from pydantic import BaseModel
 
 # Variável global para rastrear tempo de inicialização
 startup_time = time.time()
 import aiofiles
+import password_hashing
 from pathlib import Path
 
 # Configurações
@@ -26,10 +44,39 @@ SECRET_KEY = "buresidian-local-secret-key-2024"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 43200  # 30 dias para uso local
 
+# Configurações do banco de dados
+DATABASE_PATH = os.getenv("BURESIDIAN_DB", "buresidian.db")
+DB_WORKERS = int(os.getenv("BURESIDIAN_DB_WORKERS", "16"))  # threads para I/O de banco
+DB_READER_POOL_SIZE = int(os.getenv("BURESIDIAN_DB_READERS", str(DB_WORKERS)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("BURESIDIAN_DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("BURESIDIAN_DB_CACHE_KB", "65536"))  # por conexão
+DB_MMAP_SIZE = int(os.getenv("BURESIDIAN_DB_MMAP_BYTES", str(256 * 1024 * 1024)))
+
+# Caches em memória
+GRAPH_CACHE_USERS = int(os.getenv("BURESIDIAN_GRAPH_CACHE_USERS", "64"))  # grafos de usuários mantidos
+AUTH_CACHE_SIZE = int(os.getenv("BURESIDIAN_AUTH_CACHE_SIZE", "1024"))  # tokens já validados
+AUTH_CACHE_TTL = int(os.getenv("BURESIDIAN_AUTH_CACHE_TTL", "300"))     # segundos (nunca além do exp do token)
+VIEW_CACHE_BACKEND = os.getenv("BURESIDIAN_VIEW_CACHE", "memory")  # memory | disk | off (tags, links quebrados, busca)
+VIEW_CACHE_SIZE = int(os.getenv("BURESIDIAN_VIEW_CACHE_SIZE", "2048"))  # respostas guardadas
+VIEW_CACHE_TTL = int(os.getenv("BURESIDIAN_VIEW_CACHE_TTL", "300"))     # segundos, além da invalidação explícita
+VIEW_CACHE_PATH = os.getenv("BURESIDIAN_VIEW_CACHE_PATH", "buresidian-views.db")  # só para o backend disk
+
+# WebSockets: fila de saída por conexão e política para clientes lentos
+WS_SEND_QUEUE_SIZE = int(os.getenv("BURESIDIAN_WS_SEND_QUEUE", "256"))
+WS_SLOW_CONSUMER_POLICY = os.getenv("BURESIDIAN_WS_SLOW_POLICY", "drop_presence")  # drop_presence | coalesce | disconnect
+PRESENCE_TICK_HZ = float(os.getenv("BURESIDIAN_PRESENCE_HZ", "20"))  # 0 = repassa presença na hora
+
+# Edições via WebSocket: gravadas com atraso, várias notas por transação
+NOTE_WRITE_IDLE_MS = int(os.getenv("BURESIDIAN_NOTE_WRITE_IDLE_MS", "750"))         # grava após esse tempo sem edições
+NOTE_WRITE_MAX_DELAY_MS = int(os.getenv("BURESIDIAN_NOTE_WRITE_MAX_DELAY_MS", "5000"))  # nem edição contínua adia mais que isso
+
+# bcrypt fora do processo da API (custo em BURESIDIAN_BCRYPT_ROUNDS, ver password_hashing.py)
+PASSWORD_HASH_WORKERS = int(os.getenv("BURESIDIAN_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("BURESIDIAN_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8)))  # acima disso: 429
+
 # Inicialização
 app = FastAPI(title="Buresidian API", version="1.0.0")
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # CORS para desenvolvimento local
 app.add_middleware(
@@ -38,6 +85,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Export-Next-Cursor"],
 )
 
 # Criar diretórios necessários
@@ -143,8 +191,276 @@ class CanvasCollaboratorAdd(BaseModel):
     permission: str = "view"  # 'view', 'edit', 'admin'
 
 # Database
+class DatabasePool:
+    """Pool de conexões SQLite em modo WAL: um escritor serializado e vários leitores"""
+
+    def __init__(self, path: str, reader_count: int):
+        self.path = path
+        self.reader_count = max(1, reader_count)
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        self._readers_created = 0
+        self._readers_lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.RLock()
+        self._write_depth = 0  # > 0: já dentro de uma escrita (aninhadas viram SAVEPOINT)
+        self._after_commit: List[Callable[[], None]] = []
+        self.stats = {
+            "reads": 0,
+            "writes": 0,
+            "rollbacks": 0,
+            "reader_waits": 0,
+        }
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._readers_lock:
+            if self._readers_created < self.reader_count:
+                self._readers_created += 1
+                return self._connect(read_only=True)
+
+        # Pool esgotado: aguardar uma conexão ser devolvida
+        self.stats["reader_waits"] += 1
+        return self._readers.get()
+
+    def _release_reader(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._readers.put(conn)
+
+    @contextmanager
+    def read(self):
+        """Conexão somente leitura; leitores não bloqueiam o escritor em WAL"""
+        conn = self._acquire_reader()
+        self.stats["reads"] += 1
+        try:
+            yield conn
+        finally:
+            self._release_reader(conn)
+
+    @contextmanager
+    def write(self):
+        """Conexão de escrita exclusiva; commit ao sair, rollback em caso de erro.
+
+        Escritas aninhadas (uma função que grava chamada dentro de outra escrita)
+        entram na transação de fora como SAVEPOINT: um commit só, no final.
+        """
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            
+            if self._write_depth:
+                yield from self._nested_write(conn)
+                return
+            
+            self.stats["writes"] += 1
+            self._write_depth = 1
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                self._after_commit.clear()
+                self.stats["rollbacks"] += 1
+                raise
+            finally:
+                self._write_depth = 0
+            callbacks, self._after_commit = self._after_commit, []
+            for callback in callbacks:
+                callback()
+
+    def _nested_write(self, conn: sqlite3.Connection):
+        savepoint = f"nested_write_{self._write_depth}"
+        pending_callbacks = len(self._after_commit)
+        self._write_depth += 1
+        conn.execute(f"SAVEPOINT {savepoint}")
+        try:
+            yield conn
+            conn.execute(f"RELEASE {savepoint}")
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {savepoint}")
+            conn.execute(f"RELEASE {savepoint}")
+            del self._after_commit[pending_callbacks:]
+            raise
+        finally:
+            self._write_depth -= 1
+
+    def after_commit(self, callback: Callable[[], None]):
+        """Agenda `callback` para depois do commit da escrita em andamento (descartado no rollback)"""
+        with self._writer_lock:
+            self._after_commit.append(callback)
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._readers_created = 0
+
+    def status(self) -> dict:
+        return {
+            "path": self.path,
+            "readers_max": self.reader_count,
+            "readers_open": self._readers_created,
+            "readers_idle": self._readers.qsize(),
+            **self.stats,
+        }
+
+db_pool = DatabasePool(DATABASE_PATH, DB_READER_POOL_SIZE)
+
+def db_read():
+    return db_pool.read()
+
+def db_write():
+    return db_pool.write()
+
+# Todo acesso ao SQLite é bloqueante: endpoints síncronos (def) já rodam no pool
+# de threads do AnyIO; código async (WebSockets, broadcasts) usa run_db. As
+# métricas ficam no limitador do pool, então contam os dois caminhos.
+db_executor_stats = {
+    "submitted": 0,
+    "completed": 0,
+    "peak_queued": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+}
+
+def instrument_thread_limiter(limiter):
+    """Conta no limitador padrão do AnyIO cada tarefa que pega (ou espera) um worker"""
+    if getattr(limiter, "_buresidian_instrumented", False):
+        return
+    acquire = limiter.acquire
+    release = limiter.release
+
+    async def counted_acquire():
+        db_executor_stats["submitted"] += 1
+        stats = limiter.statistics()
+        if stats.borrowed_tokens >= stats.total_tokens:
+            db_executor_stats["peak_queued"] = max(db_executor_stats["peak_queued"], stats.tasks_waiting + 1)
+        start = time.perf_counter()
+        await acquire()
+        waited = time.perf_counter() - start
+        db_executor_stats["wait_seconds_total"] += waited
+        db_executor_stats["wait_seconds_max"] = max(db_executor_stats["wait_seconds_max"], waited)
+
+    def counted_release():
+        release()
+        db_executor_stats["completed"] += 1
+
+    limiter.acquire = counted_acquire
+    limiter.release = counted_release
+    limiter._buresidian_instrumented = True
+
+async def run_db(func, *args, **kwargs):
+    """Executa trabalho de banco fora do event loop, no pool de threads limitado"""
+    return await run_in_threadpool(func, *args, **kwargs)
+
+def db_executor_status() -> dict:
+    stats = anyio.to_thread.current_default_thread_limiter().statistics()
+    return {
+        "workers": int(stats.total_tokens),
+        "busy": stats.borrowed_tokens,
+        "queued": stats.tasks_waiting,
+        **db_executor_stats,
+        "wait_seconds_total": round(db_executor_stats["wait_seconds_total"], 3),
+        "wait_seconds_max": round(db_executor_stats["wait_seconds_max"], 3),
+    }
+
+# =================== MIGRAÇÕES ===================
+# Mudanças de schema versionadas: cada migração roda uma única vez, em ordem, na
+# mesma transação do init_db, e fica registrada em schema_version. Migração já
+# publicada não se edita; mudança nova entra como uma nova versão no fim da lista.
+# Cada passo é um SQL ou uma função que recebe o cursor.
+
+SCHEMA_MIGRATIONS = [
+    (1, "Índices dos predicados mais usados", [
+        # Listagem de notas do usuário, mais recentes primeiro
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_updated ON notes (user_id, updated_at)",
+        # Comentários e reações de uma nota
+        "CREATE INDEX IF NOT EXISTS idx_comments_note_created ON comments (note_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_reactions_note_emoji ON reactions (note_id, emoji)",
+        # Estado de um board (nós em ordem de z_index, arestas)
+        "CREATE INDEX IF NOT EXISTS idx_canvas_nodes_board_z ON canvas_nodes (board_id, z_index)",
+        "CREATE INDEX IF NOT EXISTS idx_canvas_edges_board ON canvas_edges (board_id)",
+        "CREATE INDEX IF NOT EXISTS idx_canvas_boards_owner ON canvas_boards (owner_id, updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_folders_user ON folders (user_id)",
+        # note_versions (note_id, version_number) já tem o índice único idx_note_versions_number
+    ]),
+    (2, "Listagem de notas por pasta e registro de notas apagadas (modo since)", [
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_folder_updated ON notes (user_id, folder_id, updated_at)",
+        '''
+            CREATE TABLE IF NOT EXISTS note_tombstones (
+                note_id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_note_tombstones_user ON note_tombstones (user_id, deleted_at)",
+    ]),
+]
+
+def current_schema_version(cursor) -> int:
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+def apply_migrations(cursor) -> List[int]:
+    """Aplica as migrações pendentes e devolve as versões aplicadas"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    current = current_schema_version(cursor)
+    applied = []
+    for version, description, steps in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        for step in steps:
+            if callable(step):
+                step(cursor)
+            else:
+                cursor.execute(step)
+        cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+        print(f"Migração {version} aplicada: {description}")
+        applied.append(version)
+    return applied
+
 def init_db():
-    conn = sqlite3.connect('buresidian.db')
+    with db_write() as conn:
+        _create_schema(conn)
+        apply_migrations(conn.cursor())
+
+def _create_schema(conn: sqlite3.Connection):
     cursor = conn.cursor()
     
     # Usuários
@@ -289,27 +605,194 @@ def init_db():
         )
     ''')
     
-    # Criar usuário demo
-    try:
-        hashed_password = pwd_context.hash("demo123")
+    # Conteúdo das versões comprimido (ver HISTÓRICO DE VERSÕES); content fica NULL
+    cursor.execute("PRAGMA table_info(note_versions)")
+    version_columns = [column[1] for column in cursor.fetchall()]
+    if "content_encoding" not in version_columns:
+        cursor.execute("ALTER TABLE note_versions ADD COLUMN content_encoding TEXT")
+        cursor.execute("ALTER TABLE note_versions ADD COLUMN payload BLOB")
+        cursor.execute("ALTER TABLE note_versions ADD COLUMN base_version_id INTEGER")
+    if "content_length" not in version_columns:
+        # Tamanho do conteúdo para a listagem, que não reconstrói as versões
+        cursor.execute("ALTER TABLE note_versions ADD COLUMN content_length INTEGER")
+        backfill_version_lengths(cursor)
+    # Número de versão único por nota; o índice também serve a busca da versão mais nova
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_note_versions_number'")
+    if cursor.fetchone() is None:
+        renumber_duplicate_versions(cursor)
+        cursor.execute("DROP INDEX IF EXISTS idx_note_versions_note")
+        cursor.execute("CREATE UNIQUE INDEX idx_note_versions_number ON note_versions (note_id, version_number)")
+    
+    # Índice de links [[wiki]] entre notas (mantido a cada escrita de nota)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_links'")
+    links_table_existed = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_links (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            source_note_id INTEGER NOT NULL,
+            target_title TEXT NOT NULL,
+            target_key TEXT NOT NULL,
+            target_note_id INTEGER,
+            display_text TEXT,
+            position INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (source_note_id) REFERENCES notes (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_links_source ON note_links (source_note_id, position)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_links_target_key ON note_links (user_id, target_key)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_links_target ON note_links (user_id, target_note_id)")
+    
+    # Título normalizado usado para resolver [[links]] sem varrer as notas
+    cursor.execute("PRAGMA table_info(notes)")
+    if "title_key" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE notes ADD COLUMN title_key TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_title_key ON notes (user_id, title_key)")
+    
+    if not links_table_existed:
+        rebuild_link_index(cursor)
+    
+    # Índice de #tags: uma linha por nota e por prefixo hierárquico da tag
+    # (#a/b/c gera os caminhos a, a/b e a/b/c, todos com tag = a/b/c)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_tags'")
+    tags_table_existed = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS note_tags (
+            note_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            path TEXT NOT NULL,
+            depth INTEGER NOT NULL,
+            occurrences INTEGER NOT NULL DEFAULT 1,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (note_id, tag, path),
+            FOREIGN KEY (note_id) REFERENCES notes (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_tags_path ON note_tags (user_id, path, note_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_tags_tag ON note_tags (user_id, tag) WHERE path = tag")
+    
+    if not tags_table_existed:
+        rebuild_tag_index(cursor)
+    
+    # Busca textual: FTS5 sobre título e conteúdo, sincronizado por triggers
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+    fts_table_existed = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            title,
+            content,
+            content='notes',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO notes_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
+    
+    if not fts_table_existed:
+        rebuild_search_index(cursor)
+    
+    # Criar usuário demo (só calcula o hash se ainda não existir)
+    cursor.execute("SELECT 1 FROM users WHERE username = 'demo'")
+    if cursor.fetchone():
+        print("Usuário demo já existe")
+    else:
         cursor.execute("INSERT INTO users (username, hashed_password) VALUES (?, ?)", 
-                      ("demo", hashed_password))
+                      ("demo", get_password_hash("demo123")))
         print("Usuário demo criado: demo/demo123")
-    except sqlite3.IntegrityError:
-        print("Usuário demo já existe")
-    
-    conn.commit()
-    conn.close()
 
 # Funções auxiliares
-def get_db_connection():
-    return sqlite3.connect('buresidian.db')
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_hashing.verify_password(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_hashing.hash_password(password)
+
+class PasswordHasher:
+    """bcrypt num pool de processos, para não ocupar o event loop nem as threads do banco.
+
+    Admite no máximo PASSWORD_HASH_MAX_PENDING operações (na fila + rodando);
+    acima disso responde 429 em vez de acumular espera.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.in_flight = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.stats = {"hashed": 0, "verified": 0, "rejected": 0, "max_in_flight": 0}
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: o filho não herda threads, locks nem conexões SQLite do processo da API
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def _run(self, func, *args):
+        if self.in_flight >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many authentication requests, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.in_flight += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool(), func, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._run(password_hashing.hash_password, password)
+        self.stats["hashed"] += 1
+        return hashed
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        valid = await self._run(password_hashing.verify_password, plain_password, hashed_password)
+        self.stats["verified"] += 1
+        return valid
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def status(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "bcrypt_rounds": password_hashing.BCRYPT_ROUNDS,
+            "in_flight": self.in_flight,
+            **self.stats,
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -321,206 +804,1622 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def create_note_version(note_id: int, title: str, content: str, user_id: int, change_description: str = ""):
-    """Cria uma nova versão da nota no histórico"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Obter o próximo número de versão
-    cursor.execute("SELECT COALESCE(MAX(version_number), 0) + 1 FROM note_versions WHERE note_id = ?", (note_id,))
-    version_number = cursor.fetchone()[0]
+# =================== HISTÓRICO DE VERSÕES ===================
+#
+# A versão mais nova de cada nota é guardada inteira (zlib). As anteriores viram
+# deltas reversos (op no formato OT, JSON + zlib) contra a versão seguinte, exceto
+# a cada NOTE_VERSION_KEYFRAME_INTERVAL versões, que ficam inteiras: reconstruir
+# qualquer versão aplica no máximo esse número de deltas.
+#
+# content_encoding: NULL = legado (texto em content), "zlib" = inteira em payload,
+# "rdelta" = delta em payload que leva o conteúdo de base_version_id a esta versão.
+
+NOTE_VERSION_KEYFRAME_INTERVAL = int(os.getenv("BURESIDIAN_VERSION_KEYFRAME_INTERVAL", "20"))
+
+# Retenção: "idade:intervalo" do mais novo ao mais antigo; "all" mantém tudo, "*" = sem limite de idade
+VERSION_RETENTION_POLICY = os.getenv("BURESIDIAN_VERSION_RETENTION", "1h:all,1d:1h,30d:1d,*:7d")
+VERSION_COMPACT_INTERVAL = int(os.getenv("BURESIDIAN_VERSION_COMPACT_INTERVAL", "600"))  # segundos; 0 desliga
+VERSION_COMPACT_BATCH = int(os.getenv("BURESIDIAN_VERSION_COMPACT_BATCH", "20"))  # notas por transação
+AUTO_VERSION_DESCRIPTIONS = {"Auto-save", "Before restore"}  # só essas são podadas
+
+def text_delta(source: str, target: str) -> list:
+    """Op (formato OT) que transforma `source` em `target`, calculada por linhas"""
+    source_lines = source.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    op = []
+    matcher = difflib.SequenceMatcher(None, source_lines, target_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            _ot_push(op, sum(len(line) for line in source_lines[i1:i2]))
+            continue
+        if j2 > j1:
+            _ot_push(op, "".join(target_lines[j1:j2]))
+        if i2 > i1:
+            _ot_push(op, -sum(len(line) for line in source_lines[i1:i2]))
+    return op
+
+def pack_version_content(content: str) -> bytes:
+    return zlib.compress((content or "").encode("utf-8"))
+
+def pack_version_delta(op: list) -> bytes:
+    return zlib.compress(json.dumps(op, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+def unpack_version_delta(payload: bytes) -> list:
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+def unpack_full_version(content: Optional[str], encoding: Optional[str], payload: Optional[bytes]) -> str:
+    if encoding == "zlib":
+        return zlib.decompress(payload).decode("utf-8")
+    return content or ""
+
+def read_version_content(cursor, version_id: int) -> Optional[str]:
+    """Reconstrói o conteúdo de uma versão seguindo os deltas até a versão inteira mais próxima"""
+    deltas = []
+    current = version_id
+    while True:
+        cursor.execute("""
+            SELECT content, content_encoding, payload, base_version_id FROM note_versions WHERE id = ?
+        """, (current,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        content, encoding, payload, base_version_id = row
+        if encoding != "rdelta":
+            text = unpack_full_version(content, encoding, payload)
+            break
+        deltas.append(unpack_version_delta(payload))
+        current = base_version_id
+    
+    for op in reversed(deltas):
+        text = ot_apply(text, op)
+    return text
+
+def load_version_contents(cursor, note_id: int) -> dict:
+    """{version_id: conteúdo} de todas as versões da nota, aplicando cada delta uma vez só"""
+    cursor.execute("""
+        SELECT id, content, content_encoding, payload, base_version_id FROM note_versions
+        WHERE note_id = ? ORDER BY version_number DESC
+    """, (note_id,))
+    contents = {}
+    for version_id, content, encoding, payload, base_version_id in cursor.fetchall():
+        if encoding != "rdelta":
+            contents[version_id] = unpack_full_version(content, encoding, payload)
+        elif base_version_id in contents:
+            contents[version_id] = ot_apply(contents[base_version_id], unpack_version_delta(payload))
+        else:
+            contents[version_id] = read_version_content(cursor, version_id)
+    return contents
+
+def version_storage(version_number: int, content: str, newer: Optional[tuple]) -> tuple:
+    """(content_encoding, payload, base_version_id) de uma versão; `newer` = (id, conteúdo) da seguinte"""
+    full = pack_version_content(content)
+    if newer is None or version_number % NOTE_VERSION_KEYFRAME_INTERVAL == 0:
+        return "zlib", full, None
+    delta = pack_version_delta(text_delta(newer[1], content))
+    if len(delta) >= len(full):
+        return "zlib", full, None
+    return "rdelta", delta, newer[0]
+
+def create_note_version(cursor, note_id: int, title: str, content: str, user_id: int, change_description: str = ""):
+    """Cria uma nova versão da nota no histórico, na transação de quem chama (o cursor de db_write())"""
+    # Versão mais nova até agora (busca no índice único note_id, version_number):
+    # dá o próximo número e deixa de ser inteira, virando delta contra a nova
+    cursor.execute("""
+        SELECT id, version_number, content, content_encoding, payload FROM note_versions
+        WHERE note_id = ? ORDER BY version_number DESC LIMIT 1
+    """, (note_id,))
+    previous = cursor.fetchone()
+    version_number = previous[1] + 1 if previous else 1
     
     # Inserir nova versão
     cursor.execute("""
-        INSERT INTO note_versions (note_id, title, content, version_number, change_description, user_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (note_id, title, content, version_number, change_description, user_id))
-    
-    conn.commit()
-    conn.close()
+        INSERT INTO note_versions (note_id, title, content, version_number, change_description, user_id,
+                                   content_encoding, payload, content_length)
+        VALUES (?, ?, NULL, ?, ?, ?, 'zlib', ?, ?)
+    """, (note_id, title, version_number, change_description, user_id, pack_version_content(content),
+          len(content or "")))
+    version_id = cursor.lastrowid
+    
+    if previous and previous[3] != "rdelta":
+        previous_id, previous_number = previous[0], previous[1]
+        previous_content = unpack_full_version(previous[2], previous[3], previous[4])
+        encoding, payload, base_version_id = version_storage(
+            previous_number, previous_content, (version_id, content or "")
+        )
+        cursor.execute("""
+            UPDATE note_versions SET content = NULL, content_encoding = ?, payload = ?, base_version_id = ?
+            WHERE id = ?
+        """, (encoding, payload, base_version_id, previous_id))
     
     return version_number
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
-    
-    if user is None:
-        raise credentials_exception
-    return {"id": user[0], "username": user[1]}
+def renumber_duplicate_versions(cursor):
+    """Corrige números repetidos (de gravações concorrentes antigas) renumerando na ordem de criação"""
+    cursor.execute("""
+        SELECT DISTINCT note_id FROM note_versions
+        GROUP BY note_id, version_number HAVING COUNT(*) > 1
+    """)
+    for (note_id,) in cursor.fetchall():
+        cursor.execute("SELECT id FROM note_versions WHERE note_id = ? ORDER BY version_number, id", (note_id,))
+        ids = [row[0] for row in cursor.fetchall()]
+        # Dois passos para não colidir com números ainda em uso
+        cursor.executemany("UPDATE note_versions SET version_number = ? WHERE id = ?",
+                           [(-number, version_id) for number, version_id in enumerate(ids, 1)])
+        cursor.execute("UPDATE note_versions SET version_number = -version_number WHERE note_id = ?", (note_id,))
 
-# WebSocket Manager para colaboração em tempo real
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict = {}  # note_id -> list of connections
-        self.board_connections: dict = {}   # board_id -> list of connections
-        
-    async def connect(self, websocket: WebSocket, note_id: int, user_id: int, username: str):
-        await websocket.accept()
-        if note_id not in self.active_connections:
-            self.active_connections[note_id] = []
-        
-        connection_info = {
-            "websocket": websocket,
-            "user_id": user_id,
-            "username": username
-        }
-        self.active_connections[note_id].append(connection_info)
-        
-        # Enviar lista de usuários online para o novo usuário
-        await self.send_online_users(note_id)
-        
-        # Notificar outros usuários
-        await self.broadcast_to_note(note_id, {
-            "type": "user_joined",
-            "user_id": user_id,
-            "username": username
-        }, user_id)
+def backfill_version_lengths(cursor):
+    cursor.execute("SELECT DISTINCT note_id FROM note_versions WHERE content_length IS NULL")
+    for (note_id,) in cursor.fetchall():
+        for version_id, content in load_version_contents(cursor, note_id).items():
+            cursor.execute("UPDATE note_versions SET content_length = ? WHERE id = ?", (len(content), version_id))
+
+def compact_note_versions(cursor) -> dict:
+    """Converte versões legadas (texto puro) para o formato comprimido; devolve o relatório de espaço"""
+    cursor.execute("SELECT DISTINCT note_id FROM note_versions WHERE content_encoding IS NULL")
+    note_ids = [row[0] for row in cursor.fetchall()]
+    report = {"notes": len(note_ids), "versions": 0, "bytes_before": 0, "bytes_after": 0}
+    
+    for note_id in note_ids:
+        contents = load_version_contents(cursor, note_id)
+        cursor.execute("""
+            SELECT id, version_number, COALESCE(LENGTH(CAST(content AS BLOB)), 0) + COALESCE(LENGTH(payload), 0)
+            FROM note_versions WHERE note_id = ? ORDER BY version_number DESC
+        """, (note_id,))
+        newer = None
+        for version_id, version_number, stored_bytes in cursor.fetchall():
+            content = contents[version_id]
+            encoding, payload, base_version_id = version_storage(version_number, content, newer)
+            cursor.execute("""
+                UPDATE note_versions SET content = NULL, content_encoding = ?, payload = ?, base_version_id = ?,
+                                         content_length = ?
+                WHERE id = ?
+            """, (encoding, payload, base_version_id, len(content), version_id))
+            report["versions"] += 1
+            report["bytes_before"] += stored_bytes
+            report["bytes_after"] += len(payload)
+            newer = (version_id, content)
+    
+    before = report["bytes_before"]
+    report["saved_bytes"] = before - report["bytes_after"]
+    report["saved_percent"] = round(100 * report["saved_bytes"] / before, 1) if before else 0.0
+    return report
+
+# =================== RETENÇÃO DE VERSÕES ===================
+
+RETENTION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+def parse_duration(text: str) -> int:
+    match = re.fullmatch(r"(\d+)([smhdw])", text.strip())
+    if not match:
+        raise ValueError(f"Invalid duration: {text!r}")
+    return int(match.group(1)) * RETENTION_UNITS[match.group(2)]
+
+def parse_retention_policy(spec: str) -> List[tuple]:
+    """"1h:all,1d:1h,*:7d" -> [(3600, 0), (86400, 3600), (None, 604800)]; intervalo 0 = manter todas"""
+    tiers = []
+    for part in spec.split(","):
+        age, _, bucket = part.strip().partition(":")
+        tiers.append((
+            None if age.strip() == "*" else parse_duration(age),
+            0 if bucket.strip() == "all" else parse_duration(bucket)
+        ))
+    return tiers
+
+version_retention_tiers = parse_retention_policy(VERSION_RETENTION_POLICY)
+
+def version_timestamp(created_at) -> float:
+    """created_at do SQLite (CURRENT_TIMESTAMP, UTC) em segundos"""
+    return datetime.strptime(str(created_at)[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+
+def select_prunable_versions(rows: list, now: float, tiers: List[tuple]) -> List[int]:
+    """IDs a remover; `rows` = (id, created_at, change_description) da mais nova para a mais antiga.
+
+    Em cada intervalo da faixa de idade fica a versão mais nova. A versão mais
+    recente da nota e as que não são automáticas nunca saem (e ocupam o intervalo).
+    """
+    prunable = []
+    taken = set()
+    for index, (version_id, created_at, description) in enumerate(rows):
+        created = version_timestamp(created_at)
+        age = now - created
+        tier = next((i for i, (max_age, _) in enumerate(tiers) if max_age is None or age < max_age), None)
+        if tier is None:
+            # Mais velha que a última faixa: vale o intervalo da última
+            tier = len(tiers) - 1
+        bucket_size = tiers[tier][1]
+        if not bucket_size:
+            continue
+        
+        bucket = (tier, int(created // bucket_size))
+        if index == 0 or description not in AUTO_VERSION_DESCRIPTIONS or bucket not in taken:
+            taken.add(bucket)
+        else:
+            prunable.append(version_id)
+    return prunable
+
+def prune_note_versions(cursor, note_id: int, now: float, tiers: List[tuple], dry_run: bool = False) -> dict:
+    """Aplica a retenção a uma nota; versões que apontavam para removidas são refeitas contra a seguinte"""
+    cursor.execute("""
+        SELECT id, created_at, change_description FROM note_versions
+        WHERE note_id = ? ORDER BY version_number DESC
+    """, (note_id,))
+    prunable = select_prunable_versions(cursor.fetchall(), now, tiers)
+    if not prunable:
+        return {"pruned": 0, "bytes_reclaimed": 0}
     
-    async def connect_to_board(self, websocket: WebSocket, board_id: int, user_id: int, username: str):
-        await websocket.accept()
-        if board_id not in self.board_connections:
-            self.board_connections[board_id] = []
-        
-        connection_info = {
-            "websocket": websocket,
-            "user_id": user_id,
-            "username": username
+    size_query = """
+        SELECT COALESCE(SUM(COALESCE(LENGTH(CAST(content AS BLOB)), 0) + COALESCE(LENGTH(payload), 0)), 0)
+        FROM note_versions WHERE note_id = ?
+    """
+    cursor.execute(size_query, (note_id,))
+    size_before = cursor.fetchone()[0]
+    
+    if dry_run:
+        placeholders = ",".join("?" * len(prunable))
+        cursor.execute(f"""
+            SELECT COALESCE(SUM(COALESCE(LENGTH(CAST(content AS BLOB)), 0) + COALESCE(LENGTH(payload), 0)), 0)
+            FROM note_versions WHERE id IN ({placeholders})
+        """, prunable)
+        return {"pruned": len(prunable), "bytes_reclaimed": cursor.fetchone()[0]}
+    
+    contents = load_version_contents(cursor, note_id)
+    removed = set(prunable)
+    placeholders = ",".join("?" * len(prunable))
+    cursor.execute(f"DELETE FROM note_versions WHERE id IN ({placeholders})", prunable)
+    
+    # Os keyframes numerados podem ter sido removidos: conta os deltas desde a
+    # última versão inteira que sobrou e grava uma nova ao chegar no intervalo
+    cursor.execute("""
+        SELECT id, version_number, content_encoding, base_version_id FROM note_versions
+        WHERE note_id = ? ORDER BY version_number DESC
+    """, (note_id,))
+    newer = None
+    deltas_since_full = 0
+    for version_id, version_number, encoding, base_version_id in cursor.fetchall():
+        content = contents[version_id]
+        keyframe = newer is not None and deltas_since_full + 1 >= NOTE_VERSION_KEYFRAME_INTERVAL
+        if keyframe and encoding == "rdelta":
+            encoding, payload, new_base = "zlib", pack_version_content(content), None
+        elif base_version_id in removed:
+            encoding, payload, new_base = version_storage(version_number, content, newer)
+        else:
+            payload = None
+        if payload is not None:
+            cursor.execute("""
+                UPDATE note_versions SET content = NULL, content_encoding = ?, payload = ?, base_version_id = ?
+                WHERE id = ?
+            """, (encoding, payload, new_base, version_id))
+        deltas_since_full = deltas_since_full + 1 if encoding == "rdelta" else 0
+        newer = (version_id, content)
+    
+    cursor.execute(size_query, (note_id,))
+    return {"pruned": len(prunable), "bytes_reclaimed": size_before - cursor.fetchone()[0]}
+
+class VersionCompactor:
+    """Aplica a retenção em segundo plano, em lotes pequenos (uma transação curta por lote)"""
+
+    def __init__(self, tiers: List[tuple], batch_size: int):
+        self.tiers = tiers
+        self.batch_size = max(1, batch_size)
+        self._task = None
+        self.stats = {
+            "runs": 0,
+            "notes_scanned": 0,
+            "versions_pruned": 0,
+            "bytes_reclaimed": 0,
+            "last_run_at": None,
+            "last_run_seconds": None,
         }
-        self.board_connections[board_id].append(connection_info)
-        
-        # Enviar lista de usuários online para o novo usuário
-        await self.send_online_users_board(board_id)
-        
-        # Notificar outros usuários
-        await self.broadcast_to_board(board_id, {
-            "type": "user_joined",
-            "user_id": user_id,
-            "username": username
-        }, user_id)
-        
-    def disconnect(self, websocket: WebSocket, note_id: int):
-        if note_id in self.active_connections:
-            disconnected_user = None
-            self.active_connections[note_id] = [
-                conn for conn in self.active_connections[note_id] 
-                if conn["websocket"] != websocket or (disconnected_user := conn)
-            ]
-            
-            if not self.active_connections[note_id]:
-                del self.active_connections[note_id]
-            elif disconnected_user:
-                # Notificar outros usuários sobre a saída
-                asyncio.create_task(self.broadcast_to_note(note_id, {
-                    "type": "user_left",
-                    "user_id": disconnected_user["user_id"],
-                    "username": disconnected_user["username"]
-                }, disconnected_user["user_id"]))
-    
-    def disconnect_from_board(self, websocket: WebSocket, board_id: int):
-        if board_id in self.board_connections:
-            disconnected_user = None
-            self.board_connections[board_id] = [
-                conn for conn in self.board_connections[board_id] 
-                if conn["websocket"] != websocket or (disconnected_user := conn)
-            ]
-            
-            if not self.board_connections[board_id]:
-                del self.board_connections[board_id]
-            elif disconnected_user:
-                # Notificar outros usuários sobre a saída
-                asyncio.create_task(self.broadcast_to_board(board_id, {
-                    "type": "user_left",
-                    "user_id": disconnected_user["user_id"],
-                    "username": disconnected_user["username"]
-                }, disconnected_user["user_id"]))
-                
-    async def send_online_users(self, note_id: int):
-        if note_id in self.active_connections:
-            users = [
-                {"user_id": conn["user_id"], "username": conn["username"]}
-                for conn in self.active_connections[note_id]
-            ]
-            await self.broadcast_to_note(note_id, {
-                "type": "users_online",
-                "users": users
-            })
-    
-    async def send_online_users_board(self, board_id: int):
-        if board_id in self.board_connections:
-            users = [
-                {"user_id": conn["user_id"], "username": conn["username"]}
-                for conn in self.board_connections[board_id]
-            ]
-            await self.broadcast_to_board(board_id, {
-                "type": "users_online",
-                "users": users
-            })
-                
-    async def broadcast_to_note(self, note_id: int, message: dict, sender_user_id: int = None):
-        if note_id in self.active_connections:
-            disconnected = []
-            for connection in self.active_connections[note_id]:
-                if sender_user_id is None or connection["user_id"] != sender_user_id:
-                    try:
-                        await connection["websocket"].send_text(json.dumps(message))
-                    except:
-                        disconnected.append(connection["websocket"])
-            
-            # Remover conexões mortas
-            for ws in disconnected:
-                self.disconnect(ws, note_id)
-    
-    async def broadcast_to_board(self, board_id: int, message: dict, sender_user_id: int = None):
-        if board_id in self.board_connections:
-            disconnected = []
-            for connection in self.board_connections[board_id]:
-                if sender_user_id is None or connection["user_id"] != sender_user_id:
-                    try:
-                        await connection["websocket"].send_text(json.dumps(message))
-                    except:
-                        disconnected.append(connection["websocket"])
-            
-            # Remover conexões mortas
-            for ws in disconnected:
-                self.disconnect_from_board(ws, board_id)
 
-manager = ConnectionManager()
+    def compact_batch(self, after_note_id: int, dry_run: bool = False) -> tuple:
+        """Processa as próximas notas depois de `after_note_id`; devolve (última nota, {note_id: resultado})"""
+        now = time.time()
+        with db_write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT note_id FROM note_versions WHERE note_id > ?
+                GROUP BY note_id HAVING COUNT(*) > 1
+                ORDER BY note_id LIMIT ?
+            """, (after_note_id, self.batch_size))
+            note_ids = [row[0] for row in cursor.fetchall()]
+            results = {note_id: prune_note_versions(cursor, note_id, now, self.tiers, dry_run) for note_id in note_ids}
+        return (note_ids[-1] if note_ids else None), results
 
-# Rotas de Autenticação
-@app.post("/auth/register", response_model=Token)
-async def register(user: UserCreate):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def run_once(self, dry_run: bool = False) -> dict:
+        """Passada completa síncrona (CLI); no servidor use o loop em segundo plano"""
+        results = {}
+        last = 0
+        while last is not None:
+            last, batch = self.compact_batch(last, dry_run)
+            results.update(batch)
+        return results
+
+    async def run(self):
+        started = time.monotonic()
+        last = 0
+        while last is not None:
+            last, batch = await run_db(self.compact_batch, last)
+            self._record(batch)
+            await asyncio.sleep(0)  # deixa outras escritas entrarem entre os lotes
+        self.stats["runs"] += 1
+        self.stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+        self.stats["last_run_seconds"] = round(time.monotonic() - started, 3)
+
+    def _record(self, batch: dict):
+        self.stats["notes_scanned"] += len(batch)
+        for result in batch.values():
+            self.stats["versions_pruned"] += result["pruned"]
+            self.stats["bytes_reclaimed"] += result["bytes_reclaimed"]
+
+    async def _loop(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run()
+            except Exception as e:
+                print(f"Error compacting note versions: {e}")
+
+    def start(self, interval: int):
+        if interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop(interval))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def status(self) -> dict:
+        return {"policy": VERSION_RETENTION_POLICY, "interval_seconds": VERSION_COMPACT_INTERVAL, **self.stats}
+
+version_compactor = VersionCompactor(version_retention_tiers, VERSION_COMPACT_BATCH)
+
+# =================== ÍNDICE DE LINKS ===================
+
+WIKI_LINK_PATTERN = re.compile(r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]')
+
+def title_key(title: Optional[str]) -> str:
+    """Forma normalizada de um título para comparar com o alvo de [[links]]"""
+    return (title or "").strip().lower()
+
+def extract_wiki_links(content: Optional[str]) -> List[dict]:
+    """Extrai [[alvo]] e [[alvo|texto]] com a posição de cada ocorrência"""
+    links = []
+    for match in WIKI_LINK_PATTERN.finditer(content or ""):
+        target = match.group(1).strip()
+        links.append({
+            "target_title": target,
+            "target_key": title_key(target),
+            "display_text": match.group(2).strip() if match.group(2) else target,
+            "position": match.start(),
+            "length": match.end() - match.start()
+        })
+    return links
+
+def link_context(content: str, position: int, length: int, radius: int = 50) -> str:
+    """Até `radius` caracteres da mesma linha em volta do link"""
+    before = content[max(0, position - radius):position]
+    if "\n" in before:
+        before = before[before.rindex("\n") + 1:]
+    after = content[position + length:position + length + radius]
+    if "\n" in after:
+        after = after[:after.index("\n")]
+    return before + content[position:position + length] + after
+
+def resolve_title_keys(cursor, user_id: int, keys) -> dict:
+    """Mapeia title_key -> id da nota (a mais antiga em caso de títulos repetidos)"""
+    keys = list(set(keys))
+    resolved = {}
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        placeholders = ", ".join("?" for _ in chunk)
+        cursor.execute(f"""
+            SELECT title_key, MIN(id) FROM notes
+            WHERE user_id = ? AND title_key IN ({placeholders})
+            GROUP BY title_key
+        """, [user_id, *chunk])
+        resolved.update(dict(cursor.fetchall()))
+    return resolved
+
+def refresh_link_targets(cursor, user_id: int, keys):
+    """Reaponta os links cujo alvo tem um destes títulos (nota criada, renomeada ou removida)"""
+    keys = [key for key in set(keys) if key]
+    if not keys:
+        return
+    resolved = resolve_title_keys(cursor, user_id, keys)
+    cursor.executemany(
+        "UPDATE note_links SET target_note_id = ? WHERE user_id = ? AND target_key = ?",
+        [(resolved.get(key), user_id, key) for key in keys]
+    )
+
+def index_note_links(cursor, note_id: int, user_id: int, content: Optional[str]):
+    """Substitui as linhas de note_links da nota pelos links do conteúdo atual"""
+    cursor.execute("DELETE FROM note_links WHERE source_note_id = ?", (note_id,))
+    links = extract_wiki_links(content)
+    if not links:
+        return
+    resolved = resolve_title_keys(cursor, user_id, [link["target_key"] for link in links])
+    cursor.executemany("""
+        INSERT INTO note_links
+        (user_id, source_note_id, target_title, target_key, target_note_id, display_text, position, length)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (user_id, note_id, link["target_title"], link["target_key"], resolved.get(link["target_key"]),
+         link["display_text"], link["position"], link["length"])
+        for link in links
+    ])
+
+def rebuild_link_index(cursor):
+    """Reconstrói note_links e notes.title_key a partir do conteúdo de todas as notas"""
+    cursor.execute("SELECT id, title FROM notes")
+    cursor.executemany(
+        "UPDATE notes SET title_key = ? WHERE id = ?",
+        [(title_key(title), note_id) for note_id, title in cursor.fetchall()]
+    )
+    cursor.execute("DELETE FROM note_links")
+    for note_id, user_id, content in cursor.connection.execute("SELECT id, user_id, content FROM notes"):
+        index_note_links(cursor, note_id, user_id, content)
+
+# =================== ÍNDICE DE TAGS ===================
+
+TAG_PATTERN = re.compile(r'#([a-zA-Z0-9_/-]+)')
+
+def extract_tags(content: Optional[str]) -> dict:
+    """Mapeia cada #tag do conteúdo para (ocorrências, posição da primeira ocorrência)"""
+    tags = {}
+    for match in TAG_PATTERN.finditer(content or ""):
+        tag = match.group(1)
+        occurrences, position = tags.get(tag, (0, match.start()))
+        tags[tag] = (occurrences + 1, position)
+    return tags
+
+def tag_paths(tag: str) -> List[str]:
+    """Prefixos hierárquicos de uma tag: a/b/c -> [a, a/b, a/b/c]"""
+    parts = tag.split('/')
+    return ['/'.join(parts[:i + 1]) for i in range(len(parts))]
+
+def index_note_tags(cursor, note_id: int, user_id: int, content: Optional[str]):
+    """Substitui as linhas de note_tags da nota pelas tags do conteúdo atual"""
+    cursor.execute("DELETE FROM note_tags WHERE note_id = ?", (note_id,))
+    rows = []
+    for tag, (occurrences, position) in extract_tags(content).items():
+        for depth, path in enumerate(tag_paths(tag), start=1):
+            rows.append((note_id, user_id, tag, path, depth, occurrences, position))
+    if rows:
+        cursor.executemany("""
+            INSERT INTO note_tags (note_id, user_id, tag, path, depth, occurrences, position)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+def rebuild_tag_index(cursor):
+    """Reconstrói note_tags a partir do conteúdo de todas as notas"""
+    cursor.execute("DELETE FROM note_tags")
+    for note_id, user_id, content in cursor.connection.execute("SELECT id, user_id, content FROM notes"):
+        index_note_tags(cursor, note_id, user_id, content)
+
+# =================== BUSCA TEXTUAL (FTS5) ===================
+
+FTS_TOKEN_PATTERN = re.compile(r'\w+')
+
+# Peso do título e do conteúdo no bm25 (título conta mais)
+FTS_RANK = "bm25(notes_fts, 10.0, 1.0)"
+
+def fts_query(text: Optional[str]) -> Optional[str]:
+    """Converte a busca do usuário numa expressão FTS5: cada palavra vira prefixo e todas precisam aparecer"""
+    tokens = FTS_TOKEN_PATTERN.findall(text or "")
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+def rebuild_search_index(cursor):
+    """Repopula notes_fts a partir da tabela notes"""
+    cursor.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+# =================== MODELO DO GRAFO ===================
+
+# Títulos mais curtos casariam com quase qualquer texto
+MENTION_MIN_TITLE_LENGTH = 4
+
+class TitleMatcher:
+    """Autômato de Aho-Corasick sobre títulos em minúsculas.
+
+    Encontra todos os títulos citados num texto em uma única passada, independente
+    de quantos títulos existem.
+    """
+
+    def __init__(self, titles: dict):
+        # titles: título em minúsculas -> ids das notas com esse título
+        self._goto = [{}]
+        self._fail = [0]
+        self._match = [None]   # título que termina no estado
+        self._output = [0]     # próximo estado (via falhas) que termina um título
+        self.titles = titles
+
+        for title in titles:
+            state = 0
+            for char in title:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._match.append(None)
+                    self._output.append(0)
+                state = next_state
+            self._match[state] = title
+
+        # Links de falha em largura (BFS)
+        pending = list(self._goto[0].values())
+        for state in pending:
+            for char, next_state in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                fail_state = self._fail[next_state]
+                self._output[next_state] = fail_state if self._match[fail_state] is not None else self._output[fail_state]
+                pending.append(next_state)
+
+    def find(self, text: Optional[str]) -> set:
+        """Títulos que aparecem em `text` (comparação sem diferenciar maiúsculas)"""
+        goto, fail, match, output = self._goto, self._fail, self._match, self._output
+        root = goto[0]
+        found = set()
+        state = 0
+        for char in (text or "").lower():
+            if state == 0 and char not in root:
+                continue
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            hit = state if match[state] is not None else output[state]
+            while hit:
+                if match[hit] in found:
+                    break
+                found.add(match[hit])
+                hit = output[hit]
+        return found
+
+    def mentioned_ids(self, text: Optional[str]) -> set:
+        ids = set()
+        for title in self.find(text):
+            ids.update(self.titles[title])
+        return ids
+
+class UserGraph:
+    """Grafo de notas de um usuário em memória, montado a partir dos índices de links e tags.
+
+    Escritas só marcam o que mudou; a próxima leitura recarrega apenas essas notas.
+    As menções em texto puro são calculadas sob demanda com um TitleMatcher.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.notes = {}          # note_id -> metadados do nó
+        self.links = {}          # note_id -> ids das notas alvo dos [[links]] resolvidos
+        self.tags = {}           # note_id -> tags completas, na ordem do conteúdo
+        self.mentions = None     # note_id -> ids das notas cujo título aparece no conteúdo
+        self.mentioned_by = {}   # note_id -> ids das notas que citam o título dela
+        self.loaded = False
+        self._matcher = None
+        self._views = {}
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending_notes = set()
+        self._pending_removed = set()
+        self._pending_titles = set()
+
+    # Invalidação (chamada pelo escritor, depois do commit)
+    def note_changed(self, note_id: int, title_changed: bool):
+        with self._pending_lock:
+            self._pending_notes.add(note_id)
+            self._pending_removed.discard(note_id)
+            if title_changed:
+                self._pending_titles.add(note_id)
+
+    def note_removed(self, note_id: int):
+        with self._pending_lock:
+            self._pending_removed.add(note_id)
+            self._pending_notes.discard(note_id)
+            self._pending_titles.discard(note_id)
+
+    def view(self, name: str, builder: Callable[["UserGraph"], dict], needs_mentions: bool = False,
+             note_id: Optional[int] = None):
+        """Resposta pronta `name`, reconstruída só quando o grafo mudou.
+
+        Views de uma nota passam `note_id`: se a nota não existe devolve None sem
+        guardar nada, para ids inventados não crescerem o cache entre escritas.
+        """
+        with self._lock:
+            self._refresh()
+            if note_id is not None and note_id not in self.notes:
+                return None
+            if needs_mentions:
+                self._ensure_mentions()
+            if name not in self._views:
+                self._views[name] = builder(self)
+            return self._views[name]
+
+    def _refresh(self):
+        with self._pending_lock:
+            changed, removed, titles = self._pending_notes, self._pending_removed, self._pending_titles
+            self._pending_notes, self._pending_removed, self._pending_titles = set(), set(), set()
+
+        if self.loaded and not (changed or removed):
+            return
+
+        with db_read() as conn:
+            cursor = conn.cursor()
+            if not self.loaded or len(changed) > 500:
+                self._load(cursor)
+                self.mentions = None
+                self.loaded = True
+                self._views = {}
+                return
+
+            for note_id in removed:
+                for mapping in (self.notes, self.links, self.tags):
+                    mapping.pop(note_id, None)
+            contents = self._load(cursor, changed) if changed else {}
+            if titles or removed:
+                # Renomeações e remoções reapontam links de outras notas
+                self._load_links(cursor)
+                self._matcher = None
+
+            if self.mentions is not None:
+                for note_id in removed | titles:
+                    self._forget_mentions_of(note_id)
+                for note_id in removed:
+                    self._set_mentions(note_id, set())
+                    self.mentions.pop(note_id, None)
+                titles = {note_id for note_id in titles if note_id in self.notes}
+                if titles:
+                    # Só os títulos novos precisam ser procurados no restante das notas
+                    delta = self._build_matcher(titles)
+                    for note_id, content in cursor.execute("SELECT id, content FROM notes WHERE user_id = ?", (self.user_id,)):
+                        for target_id in delta.mentioned_ids(content):
+                            self._add_mention(note_id, target_id)
+                matcher = self._get_matcher()
+                for note_id, content in contents.items():
+                    self._set_mentions(note_id, matcher.mentioned_ids(content))
+            self._views = {}
+
+    def _load(self, cursor, note_ids=None) -> dict:
+        """Carrega nós, links e tags (de todas as notas ou só de `note_ids`); devolve os conteúdos lidos"""
+        query = """
+            SELECT n.id, n.title, n.content, n.folder_id, f.name, n.created_at, n.updated_at
+            FROM notes n
+            LEFT JOIN folders f ON n.folder_id = f.id
+            WHERE n.user_id = ?
+        """
+        params = [self.user_id]
+        if note_ids is not None:
+            note_ids = list(note_ids)
+            query += f" AND n.id IN ({', '.join('?' for _ in note_ids)})"
+            params += note_ids
+            for note_id in note_ids:
+                for mapping in (self.notes, self.links, self.tags):
+                    mapping.pop(note_id, None)
+        else:
+            self.notes, self.links, self.tags = {}, {}, {}
+            self._matcher = None
+
+        contents = {}
+        for note_id, title, content, folder_id, folder_name, created_at, updated_at in cursor.execute(query, params):
+            content = content or ""
+            self.notes[note_id] = {
+                "title": title,
+                "title_lower": title.lower(),
+                "folder_id": folder_id,
+                "folder_name": folder_name,
+                "created_at": created_at,
+                "updated_at": updated_at,
+                "preview": content[:100],
+                "length": len(content),
+                "word_count": len(content.split())
+            }
+            if note_ids is not None:
+                contents[note_id] = content
+
+        self._load_links(cursor, note_ids)
+        self._load_tags(cursor, note_ids)
+        return contents
+
+    def _load_links(self, cursor, note_ids=None):
+        query = """
+            SELECT source_note_id, target_note_id FROM note_links
+            WHERE user_id = ? AND target_note_id IS NOT NULL
+        """
+        params = [self.user_id]
+        if note_ids is not None:
+            query += f" AND source_note_id IN ({', '.join('?' for _ in note_ids)})"
+            params += note_ids
+        else:
+            self.links = {}
+        for source_id, target_id in cursor.execute(query + " ORDER BY source_note_id, position", params):
+            targets = self.links.setdefault(source_id, [])
+            if target_id not in targets:
+                targets.append(target_id)
+
+    def _load_tags(self, cursor, note_ids=None):
+        query = "SELECT note_id, tag FROM note_tags WHERE user_id = ? AND path = tag"
+        params = [self.user_id]
+        if note_ids is not None:
+            query += f" AND note_id IN ({', '.join('?' for _ in note_ids)})"
+            params += note_ids
+        for note_id, tag in cursor.execute(query + " ORDER BY note_id, position", params):
+            self.tags.setdefault(note_id, []).append(tag)
+
+    # Menções em texto puro
+    def _build_matcher(self, note_ids) -> TitleMatcher:
+        titles = {}
+        for note_id in note_ids:
+            title = self.notes[note_id]["title_lower"]
+            if len(title) >= MENTION_MIN_TITLE_LENGTH:
+                titles.setdefault(title, []).append(note_id)
+        return TitleMatcher(titles)
+
+    def _get_matcher(self) -> TitleMatcher:
+        if self._matcher is None:
+            self._matcher = self._build_matcher(self.notes)
+        return self._matcher
+
+    def _ensure_mentions(self):
+        if self.mentions is not None:
+            return
+        matcher = self._get_matcher()
+        self.mentions, self.mentioned_by = {}, {}
+        with db_read() as conn:
+            for note_id, content in conn.execute("SELECT id, content FROM notes WHERE user_id = ?", (self.user_id,)):
+                self._set_mentions(note_id, matcher.mentioned_ids(content))
+
+    def _set_mentions(self, note_id: int, targets: set):
+        for target_id in self.mentions.get(note_id, ()):
+            self.mentioned_by.get(target_id, set()).discard(note_id)
+        targets.discard(note_id)
+        self.mentions[note_id] = targets
+        for target_id in targets:
+            self.mentioned_by.setdefault(target_id, set()).add(note_id)
+
+    def _add_mention(self, note_id: int, target_id: int):
+        if note_id != target_id:
+            self.mentions.setdefault(note_id, set()).add(target_id)
+            self.mentioned_by.setdefault(target_id, set()).add(note_id)
+
+    def _forget_mentions_of(self, target_id: int):
+        for source_id in self.mentioned_by.pop(target_id, set()):
+            self.mentions.get(source_id, set()).discard(target_id)
+
+    def ordered_ids(self) -> List[int]:
+        """Notas da mais recentemente editada para a mais antiga"""
+        return sorted(self.notes, key=lambda note_id: (self.notes[note_id]["updated_at"] or "", note_id), reverse=True)
+
+class NoteGraphCache:
+    """Grafos por usuário mantidos em memória (LRU limitado a GRAPH_CACHE_USERS)"""
+
+    def __init__(self, max_users: int):
+        self.max_users = max(1, max_users)
+        self._graphs: "OrderedDict[int, UserGraph]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, user_id: int) -> UserGraph:
+        with self._lock:
+            graph = self._graphs.get(user_id)
+            if graph is not None:
+                self._graphs.move_to_end(user_id)
+                self.stats["hits"] += 1
+                return graph
+            self.stats["misses"] += 1
+            graph = self._graphs[user_id] = UserGraph(user_id)
+            if len(self._graphs) > self.max_users:
+                self._graphs.popitem(last=False)
+                self.stats["evictions"] += 1
+            return graph
+
+    def _cached(self, user_id: int) -> Optional[UserGraph]:
+        with self._lock:
+            return self._graphs.get(user_id)
+
+    def note_changed(self, user_id: int, note_id: int, title_changed: bool = False):
+        graph = self._cached(user_id)
+        if graph is not None:
+            graph.note_changed(note_id, title_changed)
+
+    def note_removed(self, user_id: int, note_id: int):
+        graph = self._cached(user_id)
+        if graph is not None:
+            graph.note_removed(note_id)
+
+    def forget_user(self, user_id: int):
+        with self._lock:
+            self._graphs.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._graphs.clear()
+
+    def status(self) -> dict:
+        return {"users_cached": len(self._graphs), "max_users": self.max_users, **self.stats}
+
+graph_cache = NoteGraphCache(GRAPH_CACHE_USERS)
+
+# =================== ETAGS (GET CONDICIONAL) ===================
+# Cada escopo ("user", id), ("note", id) ou ("board", id) tem um contador que
+# sobe a cada escrita confirmada; o ETag é esse contador mais a época do
+# processo (contadores ficam em memória e recomeçam a cada início).
+# O ETag é lido ANTES dos dados: se uma escrita entrar no meio, o cliente leva
+# dados novos com ETag velho e só perde um 304 na próxima vez, nunca o contrário.
+
+class ChangeCounters:
+    def __init__(self):
+        self._epoch = os.urandom(4).hex()
+        self._counters: dict = {}
+        self._lock = threading.Lock()
+        self.stats = {"bumps": 0, "not_modified": 0, "full_responses": 0}
+
+    def bump(self, *scopes):
+        with self._lock:
+            for scope in scopes:
+                self._counters[scope] = self._counters.get(scope, 0) + 1
+            self.stats["bumps"] += 1
+
+    def etag(self, *scopes) -> str:
+        with self._lock:
+            counters = ".".join(str(self._counters.get(scope, 0)) for scope in scopes)
+            return f'"{self._epoch}-{counters}"'
+
+    def reset(self):
+        """Invalida todos os ETags já emitidos (ex.: reconstrução dos índices)"""
+        with self._lock:
+            self._epoch = os.urandom(4).hex()
+            self._counters.clear()
+
+    def status(self) -> dict:
+        return {"scopes": len(self._counters), **self.stats}
+
+change_counters = ChangeCounters()
+
+def conditional_get(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Devolve um 304 se o cliente já tem essa versão; senão marca a resposta com o ETag"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        change_counters.stats["not_modified"] += 1
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    change_counters.stats["full_responses"] += 1
+    response.headers.update(headers)
+    return None
+
+# Encoder em Python puro (iterencode), escrito aos pedaços: o json.dumps em C (e o
+# join de uma lista enorme) segura o GIL até o fim e, numa resposta de vários MB,
+# para o event loop mesmo rodando noutra thread
+json_view_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+def rendered_json(payload, response: Response) -> Response:
+    """Serializa já no worker do endpoint síncrono: devolvendo o dict, o FastAPI roda
+    o jsonable_encoder no event loop, e num grafo grande isso trava os WebSockets"""
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    body = io.StringIO()
+    for chunk in json_view_encoder.iterencode(payload):
+        body.write(chunk)
+    return Response(body.getvalue().encode("utf-8"), media_type="application/json", headers=headers)
+
+def board_changed(board_id: int):
+    db_pool.after_commit(lambda: change_counters.bump(("board", board_id)))
+
+# =================== CACHE DAS VISÕES DERIVADAS ===================
+# Respostas calculadas a partir das notas (hierarquia e ranking de tags, links
+# quebrados, busca global), por usuário. Invalidadas por usuário depois do
+# commit de qualquer escrita de nota (sync/forget_note_indexes) ou pasta, e com
+# TTL como rede de segurança. O grafo tem cache próprio (NoteGraphCache).
+
+class MemoryViewCacheBackend:
+    """LRU em memória: chave -> (usuário, expira_em, valor)"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def set(self, key: str, user_id: int, expires_at: float, value) -> int:
+        with self._lock:
+            self._entries[key] = (user_id, expires_at, value)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_user(self, user_id: int) -> int:
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[0] == user_id]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskViewCacheBackend:
+    """Mesmo contrato do backend em memória, num SQLite à parte (valores em JSON).
+
+    Começa vazio a cada início: as invalidações só existem enquanto o processo
+    roda, então o que ficou no arquivo pode estar velho.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS view_cache (
+                key TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                value TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_view_cache_user ON view_cache (user_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_view_cache_accessed ON view_cache (accessed_at)")
+        self._conn.execute("DELETE FROM view_cache")
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT expires_at, value FROM view_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE view_cache SET accessed_at = ? WHERE key = ?", (time.monotonic(), key))
+            return row[0], json.loads(row[1])
+
+    def set(self, key: str, user_id: int, expires_at: float, value) -> int:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO view_cache (key, user_id, expires_at, accessed_at, value) VALUES (?, ?, ?, ?, ?)",
+                (key, user_id, expires_at, time.monotonic(), json.dumps(value))
+            )
+            excess = self._conn.execute("SELECT COUNT(*) FROM view_cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute("""
+                    DELETE FROM view_cache WHERE key IN (
+                        SELECT key FROM view_cache ORDER BY accessed_at LIMIT ?
+                    )
+                """, (excess,))
+            return max(excess, 0)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM view_cache WHERE key = ?", (key,))
+
+    def invalidate_user(self, user_id: int) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM view_cache WHERE user_id = ?", (user_id,)).rowcount
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM view_cache")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM view_cache").fetchone()[0]
+
+class DerivedViewCache:
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, user_id: int, view: str, params: tuple, compute: Callable[[], dict]) -> dict:
+        """Devolve a visão em cache ou calcula com compute(); o valor não deve ser alterado por quem recebe"""
+        if self.backend is None:
+            return compute()
+        key = f"{user_id}:{view}:{json.dumps(params)}"
+        entry = self.backend.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if time.monotonic() < expires_at:
+                self.stats["hits"] += 1
+                return value
+            self.stats["expired"] += 1
+            self.backend.delete(key)
+        self.stats["misses"] += 1
+        value = compute()
+        self.stats["evictions"] += self.backend.set(key, user_id, time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate_user(self, user_id: int):
+        if self.backend is not None:
+            self.stats["invalidations"] += self.backend.invalidate_user(user_id)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def status(self) -> dict:
+        return {
+            "backend": VIEW_CACHE_BACKEND if self.backend is not None else "off",
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "max_entries": self.backend.max_entries if self.backend is not None else 0,
+            "ttl_seconds": self.ttl,
+            **self.stats,
+        }
+
+def create_view_cache_backend():
+    if VIEW_CACHE_BACKEND == "off":
+        return None
+    if VIEW_CACHE_BACKEND == "disk":
+        return DiskViewCacheBackend(VIEW_CACHE_PATH, VIEW_CACHE_SIZE)
+    return MemoryViewCacheBackend(VIEW_CACHE_SIZE)
+
+view_cache = DerivedViewCache(create_view_cache_backend(), VIEW_CACHE_TTL)
+
+# =================== SINCRONIZAÇÃO DOS ÍNDICES ===================
+
+def sync_note_indexes(cursor, note_id: int, user_id: int, title: Optional[str] = None,
+                      content: Optional[str] = None, previous_title: Optional[str] = None):
+    """Atualiza os índices derivados após uma escrita; None significa campo inalterado"""
+    if title is not None:
+        cursor.execute("UPDATE notes SET title_key = ? WHERE id = ?", (title_key(title), note_id))
+        refresh_link_targets(cursor, user_id, [title_key(title), title_key(previous_title)])
+    if content is not None:
+        index_note_links(cursor, note_id, user_id, content)
+        index_note_tags(cursor, note_id, user_id, content)
+    title_changed = title is not None
+    db_pool.after_commit(lambda: graph_cache.note_changed(user_id, note_id, title_changed))
+    db_pool.after_commit(lambda: change_counters.bump(("user", user_id), ("note", note_id)))
+    db_pool.after_commit(lambda: view_cache.invalidate_user(user_id))
+
+def forget_note_indexes(cursor, note_id: int, user_id: int, title: str):
+    """Remove as linhas de uma nota apagada e desfaz a resolução dos links que apontavam para ela"""
+    cursor.execute("DELETE FROM note_links WHERE source_note_id = ?", (note_id,))
+    cursor.execute("DELETE FROM note_tags WHERE note_id = ?", (note_id,))
+    refresh_link_targets(cursor, user_id, [title_key(title)])
+    db_pool.after_commit(lambda: graph_cache.note_removed(user_id, note_id))
+    db_pool.after_commit(lambda: change_counters.bump(("user", user_id), ("note", note_id)))
+    db_pool.after_commit(lambda: view_cache.invalidate_user(user_id))
+
+def rebuild_note_indexes(cursor):
+    """Reconstrói todos os índices derivados do conteúdo das notas"""
+    rebuild_link_index(cursor)
+    rebuild_tag_index(cursor)
+    rebuild_search_index(cursor)
+    db_pool.after_commit(graph_cache.clear)
+    db_pool.after_commit(change_counters.reset)
+    db_pool.after_commit(view_cache.clear)
+
+# =================== CACHE DE AUTENTICAÇÃO ===================
+
+class AuthCache:
+    """Tokens já validados -> usuário (LRU com TTL), para não repetir jwt.decode + SELECT a cada requisição.
+
+    A entrada vale até AUTH_CACHE_TTL ou o exp do token, o que vier antes.
+    Quem alterar/remover um usuário deve chamar invalidate_user(username).
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # token -> (expira em, usuário)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(token)
+                self.stats["hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[token]
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, token: str, user: dict, token_exp: Optional[float] = None):
+        expires = time.time() + self.ttl
+        if token_exp is not None:
+            expires = min(expires, token_exp)
+        with self._lock:
+            self._entries[token] = (expires, user)
+            self._entries.move_to_end(token)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate_user(self, username: str):
+        with self._lock:
+            stale = [token for token, (_, user) in self._entries.items() if user["username"] == username]
+            for token in stale:
+                del self._entries[token]
+            self.stats["invalidations"] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def status(self) -> dict:
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "ttl_seconds": self.ttl, **self.stats}
+
+auth_cache = AuthCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+def authenticate_token(token: str) -> Optional[dict]:
+    """Usuário do token JWT, ou None se o token for inválido/expirado ou o usuário não existir"""
+    user = auth_cache.get(token)
+    return user if user is not None else verify_token(token)
+
+def verify_token(token: str) -> Optional[dict]:
+    """Caminho frio: decodifica o JWT, busca o usuário no banco e guarda no cache"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    if username is None:
+        return None
+    
+    # O "sub" do token é o username (ver create_access_token no login)
+    row = fetch_user_by_username(username)
+    if row is None:
+        return None
+    
+    user = {"id": row[0], "username": row[1]}
+    auth_cache.put(token, user, payload.get("exp"))
+    return user
+
+def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    user = authenticate_token(credentials.credentials)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+# =================== FILAS DE ENVIO DOS WEBSOCKETS ===================
+
+ws_send_stats = {
+    "queued": 0,
+    "sent": 0,
+    "dropped": 0,
+    "coalesced": 0,
+    "slow_disconnects": 0,
+    "send_errors": 0,
+    "max_queue_depth": 0,
+}
+
+class ClientSender:
+    """Fila de saída limitada de uma conexão, esvaziada por uma task própria.
+
+    Broadcasts só enfileiram texto já serializado; um cliente lento não atrasa os
+    outros. Com a fila cheia aplica WS_SLOW_CONSUMER_POLICY:
+    - drop_presence: descarta a mensagem de presença/cursor mais antiga da fila;
+    - coalesce: além disso, substitui a mensagem de presença ainda não enviada da mesma origem;
+    - disconnect: fecha a conexão.
+    Se só houver mensagens que não podem ser descartadas, a conexão é fechada.
+    """
+
+    active: set = set()
+
+    def __init__(self, websocket: WebSocket, on_error: Optional[Callable[[], None]] = None,
+                 max_size: int = WS_SEND_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY):
+        self.websocket = websocket
+        self.on_error = on_error
+        self.max_size = max(1, max_size)
+        self.policy = policy
+        self.closed = False
+        self._queue = deque()  # [texto, chave de presença ou None]
+        self._keys = {}        # chave de presença -> item ainda na fila
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._drain())
+        ClientSender.active.add(self)
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def send(self, text: str, presence_key=None):
+        """Enfileira `text`; `presence_key` marca a mensagem como presença (descartável/coalescível)"""
+        if self.closed:
+            return
+        
+        if presence_key is not None and self.policy == "coalesce" and presence_key in self._keys:
+            self._keys[presence_key][0] = text
+            ws_send_stats["coalesced"] += 1
+            return
+        
+        if len(self._queue) >= self.max_size and not self._make_room(presence_key is not None):
+            return
+        
+        item = [text, presence_key]
+        self._queue.append(item)
+        if presence_key is not None:
+            self._keys[presence_key] = item
+        ws_send_stats["queued"] += 1
+        ws_send_stats["max_queue_depth"] = max(ws_send_stats["max_queue_depth"], len(self._queue))
+        self._ready.set()
+
+    def _make_room(self, is_presence: bool) -> bool:
+        """Libera espaço na fila cheia; False se a mensagem nova não deve entrar"""
+        if self.policy == "disconnect":
+            self._disconnect_slow()
+            return False
+        # A presença mais antiga na fila sai primeiro: o cliente fica com a posição mais recente
+        for item in self._queue:
+            if item[1] is not None:
+                self._queue.remove(item)
+                self._keys.pop(item[1], None)
+                ws_send_stats["dropped"] += 1
+                return True
+        if is_presence:
+            ws_send_stats["dropped"] += 1
+            return False
+        self._disconnect_slow()
+        return False
+
+    def _disconnect_slow(self):
+        ws_send_stats["slow_disconnects"] += 1
+        self.close()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=1013, reason="Client too slow")
+        except Exception:
+            pass
+
+    async def _drain(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                text, presence_key = self._queue.popleft()
+                if presence_key is not None and self._keys.get(presence_key) is not None:
+                    del self._keys[presence_key]
+                await self.websocket.send_text(text)
+                ws_send_stats["sent"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            ws_send_stats["send_errors"] += 1
+            self.close()
+            if self.on_error:
+                self.on_error()
+
+    def close(self):
+        """Para de enviar e descarta o que ainda estiver na fila"""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._keys.clear()
+        ClientSender.active.discard(self)
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
+def ws_send_status() -> dict:
+    depths = [sender.depth for sender in ClientSender.active]
+    return {
+        "connections": len(depths),
+        "queued_now": sum(depths),
+        "deepest_queue": max(depths, default=0),
+        "queue_size": WS_SEND_QUEUE_SIZE,
+        "policy": WS_SLOW_CONSUMER_POLICY,
+        **ws_send_stats,
+    }
+
+# =================== AGREGAÇÃO DE PRESENÇA ===================
+
+class PresenceAggregator:
+    """Junta cursores/presença por sala e envia um frame por tick.
+
+    Cada origem (usuário ou conexão) guarda só a última atualização de cada chave;
+    no tick cada participante recebe as atualizações dos outros num frame só
+    ({"type": "presence_batch", "updates": [...]}, ou a mensagem original se houver
+    apenas uma). `targets` devolve [(origem, ClientSender)] da sala no momento do envio.
+    """
+
+    def __init__(self, hz: float):
+        self.interval = 1.0 / hz if hz > 0 else 0.0
+        self.rooms: dict = {}  # sala -> {"updates": {chave: (origem, texto)}, "targets": callable}
+        self.ticks = 0
+        self._task = None
+        self.stats = {
+            "received": 0,
+            "coalesced": 0,
+            "frames_sent": 0,
+            "bytes_sent": 0,
+            "direct_messages": 0,  # o que seria enviado repassando cada mensagem
+            "direct_bytes": 0,
+        }
+
+    def publish(self, room, origin, key, message: dict, targets: Callable[[], list]):
+        text = json.dumps(message)
+        recipients = sum(1 for target, _ in targets() if origin is None or target != origin)
+        self.stats["received"] += 1
+        self.stats["direct_messages"] += recipients
+        self.stats["direct_bytes"] += recipients * len(text)
+        
+        if not self.interval:
+            self._deliver({key: (origin, text)}, targets)
+            return
+        
+        entry = self.rooms.setdefault(room, {"updates": {}, "targets": targets})
+        entry["targets"] = targets
+        if key in entry["updates"]:
+            self.stats["coalesced"] += 1
+        entry["updates"][key] = (origin, text)
+        
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.rooms:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        rooms, self.rooms = self.rooms, {}
+        for entry in rooms.values():
+            self._deliver(entry["updates"], entry["targets"])
+
+    def _deliver(self, updates: dict, targets: Callable[[], list]):
+        self.ticks += 1
+        items = list(updates.values())
+        authors = {origin for origin, _ in items if origin is not None}
+        frames = {}  # quem não publicou recebe o mesmo frame; cada autor recebe sem as próprias
+        
+        for target, sender in targets():
+            group = target if target in authors else None
+            if group not in frames:
+                texts = [text for origin, text in items if group is None or origin != group]
+                if not texts:
+                    frames[group] = None
+                elif len(texts) == 1:
+                    frames[group] = texts[0]
+                else:
+                    frames[group] = '{"type": "presence_batch", "updates": [' + ", ".join(texts) + ']}'
+            
+            text = frames[group]
+            if text is None:
+                continue
+            # Chave única por tick: descartável sob pressão, mas nunca coalescido com outro tick
+            sender.send(text, ("presence_tick", self.ticks))
+            self.stats["frames_sent"] += 1
+            self.stats["bytes_sent"] += len(text)
+
+    def status(self) -> dict:
+        return {
+            "tick_hz": PRESENCE_TICK_HZ,
+            "pending_rooms": len(self.rooms),
+            **self.stats,
+            "messages_saved": self.stats["direct_messages"] - self.stats["frames_sent"],
+            "bytes_saved": self.stats["direct_bytes"] - self.stats["bytes_sent"],
+        }
+
+presence_aggregator = PresenceAggregator(PRESENCE_TICK_HZ)
+
+# WebSocket Manager para colaboração em tempo real
+class ConnectionManager:
+    def __init__(self):
+        self.active_connections: dict = {}  # note_id -> list of connections
+        self.board_connections: dict = {}   # board_id -> list of connections
+        
+    async def connect(self, websocket: WebSocket, note_id: int, user_id: int, username: str):
+        await websocket.accept()
+        if note_id not in self.active_connections:
+            self.active_connections[note_id] = []
+        
+        connection_info = {
+            "websocket": websocket,
+            "user_id": user_id,
+            "username": username,
+            "sender": ClientSender(websocket, lambda: self.disconnect(websocket, note_id))
+        }
+        self.active_connections[note_id].append(connection_info)
+        
+        # Enviar lista de usuários online para o novo usuário
+        await self.send_online_users(note_id)
+        
+        # Notificar outros usuários
+        await self.broadcast_to_note(note_id, {
+            "type": "user_joined",
+            "user_id": user_id,
+            "username": username
+        }, user_id)
     
-    # Verificar se usuário já existe
-    cursor.execute("SELECT id FROM users WHERE username = ?", (user.username,))
-    if cursor.fetchone():
-        conn.close()
+    async def connect_to_board(self, websocket: WebSocket, board_id: int, user_id: int, username: str):
+        await websocket.accept()
+        if board_id not in self.board_connections:
+            self.board_connections[board_id] = []
+        
+        connection_info = {
+            "websocket": websocket,
+            "user_id": user_id,
+            "username": username,
+            "sender": ClientSender(websocket, lambda: self.disconnect_from_board(websocket, board_id))
+        }
+        self.board_connections[board_id].append(connection_info)
+        
+        # Enviar lista de usuários online para o novo usuário
+        await self.send_online_users_board(board_id)
+        
+        # Notificar outros usuários
+        await self.broadcast_to_board(board_id, {
+            "type": "user_joined",
+            "user_id": user_id,
+            "username": username
+        }, user_id)
+    
+    def _remove(self, connections: dict, key: int, websocket: WebSocket):
+        """Tira a conexão da sala, fecha sua fila e devolve o connection_info removido"""
+        disconnected_user = None
+        remaining = []
+        for conn in connections.get(key, []):
+            if conn["websocket"] is websocket:
+                disconnected_user = conn
+                conn["sender"].close()
+            else:
+                remaining.append(conn)
+        
+        if remaining:
+            connections[key] = remaining
+        else:
+            connections.pop(key, None)
+        return disconnected_user if remaining else None
+        
+    def disconnect(self, websocket: WebSocket, note_id: int):
+        disconnected_user = self._remove(self.active_connections, note_id, websocket)
+        if disconnected_user:
+            # Notificar outros usuários sobre a saída
+            asyncio.create_task(self.broadcast_to_note(note_id, {
+                "type": "user_left",
+                "user_id": disconnected_user["user_id"],
+                "username": disconnected_user["username"]
+            }, disconnected_user["user_id"]))
+    
+    def disconnect_from_board(self, websocket: WebSocket, board_id: int):
+        disconnected_user = self._remove(self.board_connections, board_id, websocket)
+        if disconnected_user:
+            # Notificar outros usuários sobre a saída
+            asyncio.create_task(self.broadcast_to_board(board_id, {
+                "type": "user_left",
+                "user_id": disconnected_user["user_id"],
+                "username": disconnected_user["username"]
+            }, disconnected_user["user_id"]))
+                
+    async def send_online_users(self, note_id: int):
+        if note_id in self.active_connections:
+            users = [
+                {"user_id": conn["user_id"], "username": conn["username"]}
+                for conn in self.active_connections[note_id]
+            ]
+            await self.broadcast_to_note(note_id, {
+                "type": "users_online",
+                "users": users
+            })
+    
+    async def send_online_users_board(self, board_id: int):
+        if board_id in self.board_connections:
+            users = [
+                {"user_id": conn["user_id"], "username": conn["username"]}
+                for conn in self.board_connections[board_id]
+            ]
+            await self.broadcast_to_board(board_id, {
+                "type": "users_online",
+                "users": users
+            })
+    
+    @staticmethod
+    def _fan_out(connections: list, message: dict, sender_user_id: Optional[int], presence_key):
+        """Serializa uma vez e enfileira para cada destinatário; não espera nenhum envio"""
+        text = json.dumps(message)
+        for connection in list(connections):
+            if sender_user_id is None or connection["user_id"] != sender_user_id:
+                connection["sender"].send(text, presence_key)
+                
+    async def broadcast_to_note(self, note_id: int, message: dict, sender_user_id: int = None, presence_key=None):
+        if note_id in self.active_connections:
+            self._fan_out(self.active_connections[note_id], message, sender_user_id, presence_key)
+    
+    async def broadcast_to_board(self, board_id: int, message: dict, sender_user_id: int = None, presence_key=None):
+        if board_id in self.board_connections:
+            self._fan_out(self.board_connections[board_id], message, sender_user_id, presence_key)
+    
+    def presence_to_note(self, note_id: int, message: dict, sender_user_id: Optional[int], key):
+        """Presença vai pelo agregador: só a última por usuário/chave, um frame por tick"""
+        presence_aggregator.publish(
+            ("note", note_id), sender_user_id, (sender_user_id, key), message,
+            lambda: [(conn["user_id"], conn["sender"]) for conn in self.active_connections.get(note_id, [])]
+        )
+    
+    def presence_to_board(self, board_id: int, message: dict, sender_user_id: Optional[int], key):
+        presence_aggregator.publish(
+            ("board", board_id), sender_user_id, (sender_user_id, key), message,
+            lambda: [(conn["user_id"], conn["sender"]) for conn in self.board_connections.get(board_id, [])]
+        )
+    
+    def _note_connection(self, note_id: int, websocket: WebSocket) -> Optional[dict]:
+        for conn in self.active_connections.get(note_id, []):
+            if conn["websocket"] is websocket:
+                return conn
+        return None
+    
+    def use_ot(self, note_id: int, websocket: WebSocket):
+        """Marca a conexão como cliente do protocolo de ops (recebe ops em vez do conteúdo inteiro)"""
+        conn = self._note_connection(note_id, websocket)
+        if conn:
+            conn["ot"] = True
+    
+    def send_to_note_connection(self, note_id: int, websocket: WebSocket, message: dict):
+        conn = self._note_connection(note_id, websocket)
+        if conn:
+            conn["sender"].send(json.dumps(message))
+    
+    def broadcast_note_edit(self, note_id: int, op_message: dict, content_message: dict, origin: WebSocket = None):
+        """Edição de texto: clientes OT recebem a op, os antigos o conteúdo inteiro"""
+        texts = {}
+        for conn in list(self.active_connections.get(note_id, [])):
+            if conn["websocket"] is origin:
+                continue
+            ot = conn.get("ot", False)
+            if ot not in texts:
+                texts[ot] = json.dumps(op_message if ot else content_message)
+            conn["sender"].send(texts[ot])
+
+manager = ConnectionManager()
+
+# Rotas de Autenticação
+def insert_user(username: str, hashed_password: str):
+    with db_write() as conn:
+        cursor = conn.cursor()
+        
+        # Verificar se usuário já existe
+        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+        if cursor.fetchone():
+            raise HTTPException(status_code=400, detail="Username already registered")
+        
+        # Criar usuário
+        cursor.execute("INSERT INTO users (username, hashed_password) VALUES (?, ?)",
+                      (username, hashed_password))
+        # Tokens antigos com esse username (usuário removido e recriado) não valem para o novo
+        db_pool.after_commit(lambda: auth_cache.invalidate_user(username))
+
+def fetch_user_password(username: str):
+    with db_read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT username, hashed_password FROM users WHERE username = ?", (username,))
+        return cursor.fetchone()
+
+@app.post("/auth/register", response_model=Token)
+async def register(user: UserCreate):
+    # Nome já usado: responde sem gastar um bcrypt
+    if await run_db(fetch_user_by_username, user.username):
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    # Criar usuário
-    hashed_password = get_password_hash(user.password)
-    cursor.execute("INSERT INTO users (username, hashed_password) VALUES (?, ?)",
-                  (user.username, hashed_password))
-    conn.commit()
-    conn.close()
+    hashed_password = await password_hasher.hash(user.password)
+    await run_db(insert_user, user.username, hashed_password)
     
     # Criar token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -531,13 +2430,9 @@ async def register(user: UserCreate):
 
 @app.post("/auth/login", response_model=Token)
 async def login(user: UserLogin):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT username, hashed_password FROM users WHERE username = ?", (user.username,))
-    db_user = cursor.fetchone()
-    conn.close()
+    db_user = await run_db(fetch_user_password, user.username)
     
-    if not db_user or not verify_password(user.password, db_user[1]):
+    if not db_user or not await password_hasher.verify(user.password, db_user[1]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -556,208 +2451,369 @@ async def read_users_me(current_user: dict = Depends(get_current_user)):
 
 # Rotas de Pastas
 @app.post("/folders")
-async def create_folder(folder: FolderCreate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO folders (name, parent_id, user_id) VALUES (?, ?, ?)",
-                  (folder.name, folder.parent_id, current_user["id"]))
-    folder_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+def create_folder(folder: FolderCreate, current_user: dict = Depends(get_current_user)):
+    with db_write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO folders (name, parent_id, user_id) VALUES (?, ?, ?)",
+                      (folder.name, folder.parent_id, current_user["id"]))
+        folder_id = cursor.lastrowid
+        # A busca global também lista pastas
+        db_pool.after_commit(lambda: view_cache.invalidate_user(current_user["id"]))
     return {"id": folder_id, "name": folder.name, "parent_id": folder.parent_id}
 
 @app.get("/folders")
-async def get_folders(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name, parent_id FROM folders WHERE user_id = ?", (current_user["id"],))
-    folders = [{"id": row[0], "name": row[1], "parent_id": row[2]} for row in cursor.fetchall()]
-    conn.close()
+def get_folders(current_user: dict = Depends(get_current_user)):
+    with db_read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, parent_id FROM folders WHERE user_id = ?", (current_user["id"],))
+        folders = [{"id": row[0], "name": row[1], "parent_id": row[2]} for row in cursor.fetchall()]
     return folders
 
 # Rotas de Notas
 @app.post("/notes")
-async def create_note(note: NoteCreate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO notes (title, content, folder_id, user_id) VALUES (?, ?, ?, ?)",
-                  (note.title, note.content, note.folder_id, current_user["id"]))
-    note_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+def create_note(note: NoteCreate, current_user: dict = Depends(get_current_user)):
+    with db_write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO notes (title, content, folder_id, user_id) VALUES (?, ?, ?, ?)",
+                      (note.title, note.content, note.folder_id, current_user["id"]))
+        note_id = cursor.lastrowid
+        sync_note_indexes(cursor, note_id, current_user["id"], title=note.title, content=note.content)
     return {"id": note_id, "title": note.title, "content": note.content, "folder_id": note.folder_id}
 
+# Campos que a listagem de notas aceita em fields= (id vem sempre)
+NOTE_LIST_FIELDS = {
+    "title": "n.title",
+    "content": "n.content",
+    "folder_id": "n.folder_id",
+    "folder_name": "f.name",
+    "created_at": "n.created_at",
+    "updated_at": "n.updated_at",
+}
+
+def encode_list_cursor(*values) -> str:
+    """Cursor opaco para o cliente: JSON em base64 url-safe"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_list_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
 @app.get("/notes")
-async def get_notes(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT n.id, n.title, n.content, n.folder_id, f.name as folder_name, n.created_at, n.updated_at
+def get_notes(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Tamanho da página; sem limit devolve todas"),
+    cursor: Optional[str] = Query(None, description="next_cursor da página anterior"),
+    fields: Optional[str] = Query(None, description="Campos separados por vírgula, ex.: title,updated_at"),
+    folder_id: Optional[int] = Query(None),
+    since: Optional[str] = Query(None, description="sync_cursor de uma listagem anterior: só o que mudou desde então"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Notas do usuário, mais recentes primeiro, com paginação por (updated_at, id).
+
+    Com since, devolve só as notas alteradas desde aquele sync_cursor e os ids
+    apagados nesse meio tempo (o cliente deve guardar o sync_cursor da primeira
+    página). Notas alteradas no mesmo segundo do cursor podem vir de novo.
+    """
+    if fields is None:
+        selected = list(NOTE_LIST_FIELDS)
+    else:
+        selected = [field.strip() for field in fields.split(",") if field.strip() and field.strip() != "id"]
+        unknown = [field for field in selected if field not in NOTE_LIST_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown field: {unknown[0]}")
+    
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
+    
+    conditions = ["n.user_id = ?"]
+    params: list = [current_user["id"]]
+    if folder_id is not None:
+        conditions.append("n.folder_id = ?")
+        params.append(folder_id)
+    since_at = decode_list_cursor(since, 1)[0] if since else None
+    if since_at is not None:
+        conditions.append("n.updated_at >= ?")
+        params.append(since_at)
+    if cursor:
+        conditions.append("(n.updated_at, n.id) < (?, ?)")
+        params.extend(decode_list_cursor(cursor, 2))
+    
+    # Conteúdo só é lido do banco se foi pedido; o JOIN com pastas também
+    columns = ", ".join(["n.id", "n.updated_at"] + [NOTE_LIST_FIELDS[field] for field in selected])
+    join = "LEFT JOIN folders f ON n.folder_id = f.id" if "folder_name" in selected else ""
+    query = f"""
+        SELECT {columns}
         FROM notes n
-        LEFT JOIN folders f ON n.folder_id = f.id
-        WHERE n.user_id = ?
-        ORDER BY n.updated_at DESC
-    """, (current_user["id"],))
-    notes = []
-    for row in cursor.fetchall():
-        notes.append({
-            "id": row[0],
-            "title": row[1],
-            "content": row[2],
-            "folder_id": row[3],
-            "folder_name": row[4],
-            "created_at": row[5],
-            "updated_at": row[6]
-        })
-    conn.close()
-    return notes
+        {join}
+        WHERE {" AND ".join(conditions)}
+        ORDER BY n.updated_at DESC, n.id DESC
+    """
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+    
+    with db_read() as conn:
+        db_cursor = conn.cursor()
+        # Lido na mesma transação da listagem: o que mudar depois disso entra no próximo since
+        db_cursor.execute("SELECT CURRENT_TIMESTAMP")
+        sync_at = db_cursor.fetchone()[0]
+        db_cursor.execute(query, params)
+        rows = db_cursor.fetchall()
+        deleted = []
+        if since_at is not None and not cursor:
+            db_cursor.execute("SELECT note_id FROM note_tombstones WHERE user_id = ? AND deleted_at >= ?",
+                              (current_user["id"], since_at))
+            deleted = [row[0] for row in db_cursor.fetchall()]
+    
+    page = rows[:limit] if limit is not None else rows
+    notes = [{"id": row[0], **dict(zip(selected, row[2:]))} for row in page]
+    listing = {
+        "notes": notes,
+        "next_cursor": encode_list_cursor(page[-1][1], page[-1][0]) if limit is not None and len(rows) > limit else None,
+        "sync_cursor": encode_list_cursor(sync_at),
+    }
+    if since_at is not None:
+        listing["deleted"] = deleted
+    return listing
+
+# /notes/graph e /notes/search são registradas antes de /notes/{note_id}: senão
+# "graph"/"search" caem no note_id e viram 422
+@app.get("/notes/graph")
+def get_notes_graph(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
+    """Gerar dados do grafo de conexões entre notas"""
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
+    return rendered_json(
+        graph_cache.get(current_user["id"]).view("notes_graph", build_notes_graph, needs_mentions=True), response
+    )
+
+@app.get("/notes/search")
+def search_notes(
+    query: str = Query(..., min_length=1),
+    limit: int = Query(10, le=50),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Busca específica em notas para compatibilidade
+    """
+    try:
+        with db_read() as conn:
+            cursor = conn.cursor()
+        
+            query_lower = query.lower()
+            match = fts_query(query)
+            notes = []
+        
+            if match is not None:
+                cursor.execute(f"""
+                    SELECT n.id, n.title, n.content, n.created_at, n.updated_at, n.folder_id 
+                    FROM notes_fts
+                    JOIN notes n ON n.id = notes_fts.rowid
+                    WHERE notes_fts MATCH ? AND n.user_id = ?
+                    ORDER BY 
+                        CASE 
+                            WHEN LOWER(n.title) = ? THEN 1
+                            WHEN LOWER(n.title) LIKE ? THEN 2
+                            ELSE 3
+                        END,
+                        {FTS_RANK}
+                    LIMIT ?
+                """, (
+                    match,
+                    current_user["id"],
+                    query_lower,
+                    f"{query_lower}%",
+                    limit
+                ))
+                notes = cursor.fetchall()
+        
+            results = []
+        
+            for note in notes:
+                note_id, title, content, created_at, updated_at, folder_id = note
+                results.append({
+                    "id": note_id,
+                    "title": title,
+                    "content": content[:200] + ("..." if len(content or "") > 200 else ""),
+                    "created_at": created_at,
+                    "updated_at": updated_at,
+                    "folder_id": folder_id
+                })
+        
+        return results
+        
+    except Exception as e:
+        print(f"Erro na busca de notas: {str(e)}")
+        raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
 @app.get("/notes/{note_id}")
-async def get_note(note_id: int, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, title, content, folder_id FROM notes WHERE id = ? AND user_id = ?",
-                  (note_id, current_user["id"]))
-    note = cursor.fetchone()
-    conn.close()
+def get_note(note_id: int, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
+    with db_read() as conn:
+        cursor = conn.cursor()
+        # Checa a posse sem ler o conteúdo; com ETag válido nem chega a ler a nota
+        cursor.execute("SELECT 1 FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
+        not_modified = conditional_get(request, response, change_counters.etag(("note", note_id)))
+        if not_modified:
+            return not_modified
+        cursor.execute("SELECT id, title, content, folder_id FROM notes WHERE id = ? AND user_id = ?",
+                      (note_id, current_user["id"]))
+        note = cursor.fetchone()
     
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
     
-    return {"id": note[0], "title": note[1], "content": note[2], "folder_id": note[3]}
+    # Edição via WebSocket ainda não gravada tem precedência
+    content = note_write_buffer.pending_content(note_id)
+    return {"id": note[0], "title": note[1], "content": note[2] if content is None else content, "folder_id": note[3]}
 
 @app.put("/notes/{note_id}")
-async def update_note(note_id: int, note: NoteUpdate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar se a nota existe e obter dados atuais
-    cursor.execute("SELECT title, content FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
-    current_note = cursor.fetchone()
-    if not current_note:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    current_title, current_content = current_note
-    
-    # Preparar dados para atualização
-    new_title = note.title if note.title is not None else current_title
-    new_content = note.content if note.content is not None else current_content
-    
-    # Criar versão no histórico antes de atualizar (apenas se houve mudança significativa)
-    if (note.title and note.title != current_title) or (note.content and note.content != current_content):
-        create_note_version(note_id, current_title, current_content, current_user["id"], "Auto-save")
+def update_note(note_id: int, note: NoteUpdate, current_user: dict = Depends(get_current_user)):
+    note_write_buffer.flush([note_id])
+    with db_write() as conn:
+        cursor = conn.cursor()
+        
+        # Verificar se a nota existe e obter dados atuais
+        cursor.execute("SELECT title, content FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
+        current_note = cursor.fetchone()
+        if not current_note:
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        current_title, current_content = current_note
+        
+        # Preparar dados para atualização
+        new_title = note.title if note.title is not None else current_title
+        new_content = note.content if note.content is not None else current_content
+        
+        # Criar versão no histórico antes de atualizar (apenas se houve mudança significativa)
+        if (note.title and note.title != current_title) or (note.content and note.content != current_content):
+            create_note_version(cursor, note_id, current_title, current_content, current_user["id"], "Auto-save")
+        
+        # Atualizar campos fornecidos
+        updates = []
+        params = []
+        if note.title is not None:
+            updates.append("title = ?")
+            params.append(note.title)
+        if note.content is not None:
+            updates.append("content = ?")
+            params.append(note.content)
+        if note.folder_id is not None:
+            updates.append("folder_id = ?")
+            params.append(note.folder_id)
+        
+        if updates:
+            updates.append("updated_at = CURRENT_TIMESTAMP")
+            query = f"UPDATE notes SET {', '.join(updates)} WHERE id = ?"
+            params.append(note_id)
+            cursor.execute(query, params)
+            sync_note_indexes(
+                cursor, note_id, current_user["id"],
+                title=note.title if note.title is not None and note.title != current_title else None,
+                content=note.content,
+                previous_title=current_title
+            )
     
-    # Atualizar campos fornecidos
-    updates = []
-    params = []
-    if note.title is not None:
-        updates.append("title = ?")
-        params.append(note.title)
     if note.content is not None:
-        updates.append("content = ?")
-        params.append(note.content)
-    if note.folder_id is not None:
-        updates.append("folder_id = ?")
-        params.append(note.folder_id)
-    
-    if updates:
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        query = f"UPDATE notes SET {', '.join(updates)} WHERE id = ?"
-        params.append(note_id)
-        cursor.execute(query, params)
-        conn.commit()
-    
-    conn.close()
+        note_documents.external_update(note_id, note.content)
     return {"message": "Note updated successfully"}
 
 @app.delete("/notes/{note_id}")
-async def delete_note(note_id: int, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
-    conn.commit()
-    conn.close()
+def delete_note(note_id: int, current_user: dict = Depends(get_current_user)):
+    note_write_buffer.flush([note_id])
+    with db_write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT title FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
+        existing = cursor.fetchone()
+        cursor.execute("DELETE FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Note not found")
+        forget_note_indexes(cursor, note_id, current_user["id"], existing[0])
+        # Para o modo since de GET /notes
+        cursor.execute("INSERT OR REPLACE INTO note_tombstones (note_id, user_id) VALUES (?, ?)",
+                      (note_id, current_user["id"]))
     return {"message": "Note deleted successfully"}
 
 # Rotas de Comentários
 @app.post("/comments")
-async def create_comment(comment: CommentCreate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO comments (content, note_id, user_id) VALUES (?, ?, ?)",
-                  (comment.content, comment.note_id, current_user["id"]))
-    comment_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+def create_comment(comment: CommentCreate, current_user: dict = Depends(get_current_user)):
+    with db_write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO comments (content, note_id, user_id) VALUES (?, ?, ?)",
+                      (comment.content, comment.note_id, current_user["id"]))
+        comment_id = cursor.lastrowid
     return {"id": comment_id, "content": comment.content, "note_id": comment.note_id}
 
 @app.get("/notes/{note_id}/comments")
-async def get_comments(note_id: int, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT c.id, c.content, c.created_at, u.username
-        FROM comments c
-        JOIN users u ON c.user_id = u.id
-        WHERE c.note_id = ?
-        ORDER BY c.created_at ASC
-    """, (note_id,))
-    comments = []
-    for row in cursor.fetchall():
-        comments.append({
-            "id": row[0],
-            "content": row[1],
-            "created_at": row[2],
-            "username": row[3]
-        })
-    conn.close()
+def get_comments(note_id: int, current_user: dict = Depends(get_current_user)):
+    with db_read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT c.id, c.content, c.created_at, u.username
+            FROM comments c
+            JOIN users u ON c.user_id = u.id
+            WHERE c.note_id = ?
+            ORDER BY c.created_at ASC
+        """, (note_id,))
+        comments = []
+        for row in cursor.fetchall():
+            comments.append({
+                "id": row[0],
+                "content": row[1],
+                "created_at": row[2],
+                "username": row[3]
+            })
     return comments
 
 # Endpoints de reações
 @app.post("/notes/{note_id}/reactions")
 async def toggle_reaction(note_id: int, reaction: ReactionToggle, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verifica se a nota existe
-    cursor.execute("SELECT id FROM notes WHERE id = ?", (note_id,))
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    # Verifica se já existe uma reação do usuário para essa nota
-    cursor.execute(
-        "SELECT id FROM reactions WHERE note_id = ? AND user_id = ? AND emoji = ?",
-        (note_id, current_user["id"], reaction.emoji)
-    )
-    existing_reaction = cursor.fetchone()
-    
-    if existing_reaction:
-        # Remove a reação existente
-        cursor.execute("DELETE FROM reactions WHERE id = ?", (existing_reaction[0],))
-        action = "removed"
-    else:
-        # Adiciona nova reação
-        cursor.execute(
-            "INSERT INTO reactions (note_id, user_id, emoji) VALUES (?, ?, ?)",
-            (note_id, current_user["id"], reaction.emoji)
-        )
-        action = "added"
-    
-    conn.commit()
-    
-    # Busca o número atualizado de reações para esse emoji
-    cursor.execute(
-        "SELECT COUNT(*) FROM reactions WHERE note_id = ? AND emoji = ?",
-        (note_id, reaction.emoji)
-    )
-    count = cursor.fetchone()[0]
+    def apply_reaction():
+        with db_write() as conn:
+            cursor = conn.cursor()
+        
+            # Verifica se a nota existe
+            cursor.execute("SELECT id FROM notes WHERE id = ?", (note_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Note not found")
+        
+            # Verifica se já existe uma reação do usuário para essa nota
+            cursor.execute(
+                "SELECT id FROM reactions WHERE note_id = ? AND user_id = ? AND emoji = ?",
+                (note_id, current_user["id"], reaction.emoji)
+            )
+            existing_reaction = cursor.fetchone()
+        
+            if existing_reaction:
+                # Remove a reação existente
+                cursor.execute("DELETE FROM reactions WHERE id = ?", (existing_reaction[0],))
+                action = "removed"
+            else:
+                # Adiciona nova reação
+                cursor.execute(
+                    "INSERT INTO reactions (note_id, user_id, emoji) VALUES (?, ?, ?)",
+                    (note_id, current_user["id"], reaction.emoji)
+                )
+                action = "added"
+        
+            # Busca o número atualizado de reações para esse emoji
+            cursor.execute(
+                "SELECT COUNT(*) FROM reactions WHERE note_id = ? AND emoji = ?",
+                (note_id, reaction.emoji)
+            )
+            count = cursor.fetchone()[0]
+            return action, count
     
-    conn.close()
+    action, count = await run_db(apply_reaction)
     
     # Notifica via WebSocket sobre a atualização
     await manager.broadcast_to_note(note_id, {
@@ -772,30 +2828,28 @@ async def toggle_reaction(note_id: int, reaction: ReactionToggle, current_user:
     return {"action": action, "emoji": reaction.emoji, "count": count}
 
 @app.get("/notes/{note_id}/reactions")
-async def get_note_reactions(note_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verifica se a nota existe
-    cursor.execute("SELECT id FROM notes WHERE id = ?", (note_id,))
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    # Busca todas as reações da nota agrupadas por emoji
-    cursor.execute("""
-        SELECT emoji, COUNT(*) as count
-        FROM reactions 
-        WHERE note_id = ? 
-        GROUP BY emoji
-        ORDER BY emoji
-    """, (note_id,))
-    
-    reactions = {}
-    for row in cursor.fetchall():
-        reactions[row[0]] = row[1]
+def get_note_reactions(note_id: int):
+    with db_read() as conn:
+        cursor = conn.cursor()
+        
+        # Verifica se a nota existe
+        cursor.execute("SELECT id FROM notes WHERE id = ?", (note_id,))
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        # Busca todas as reações da nota agrupadas por emoji
+        cursor.execute("""
+            SELECT emoji, COUNT(*) as count
+            FROM reactions 
+            WHERE note_id = ? 
+            GROUP BY emoji
+            ORDER BY emoji
+        """, (note_id,))
+        
+        reactions = {}
+        for row in cursor.fetchall():
+            reactions[row[0]] = row[1]
     
-    conn.close()
     return reactions
 
 # Upload de imagens
@@ -819,108 +2873,586 @@ async def upload_file(file: UploadFile = File(...), current_user: dict = Depends
 
 # Rotas de Histórico de Versões
 @app.get("/notes/{note_id}/versions")
-async def get_note_versions(note_id: int, current_user: dict = Depends(get_current_user)):
-    """Obter histórico de versões de uma nota"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar se a nota existe e pertence ao usuário
-    cursor.execute("SELECT id FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    # Buscar versões
-    cursor.execute("""
-        SELECT nv.id, nv.version_number, nv.title, nv.content, nv.change_description, 
-               nv.created_at, u.username
-        FROM note_versions nv
-        JOIN users u ON nv.user_id = u.id
-        WHERE nv.note_id = ?
-        ORDER BY nv.version_number DESC
-    """, (note_id,))
+def get_note_versions(
+    note_id: int,
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[int] = Query(None, description="version_number do último item da página anterior"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Histórico de versões de uma nota (só metadados, paginado do mais novo para o mais antigo)"""
+    with db_read() as conn:
+        cursor = conn.cursor()
+        
+        # Verificar se a nota existe e pertence ao usuário
+        cursor.execute("SELECT id FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        # Buscar versões (uma a mais para saber se há próxima página)
+        cursor.execute("""
+            SELECT nv.id, nv.version_number, nv.title, nv.change_description, 
+                   nv.created_at, u.username, COALESCE(nv.content_length, LENGTH(nv.content), 0)
+            FROM note_versions nv
+            JOIN users u ON nv.user_id = u.id
+            WHERE nv.note_id = ? AND (? IS NULL OR nv.version_number < ?)
+            ORDER BY nv.version_number DESC
+            LIMIT ?
+        """, (note_id, before, before, limit + 1))
+        rows = cursor.fetchall()
     
     versions = []
-    for row in cursor.fetchall():
+    for row in rows[:limit]:
         versions.append({
             "id": row[0],
             "version_number": row[1],
             "title": row[2],
-            "content": row[3],
-            "change_description": row[4],
-            "created_at": row[5],
-            "username": row[6]
+            "change_description": row[3],
+            "created_at": row[4],
+            "username": row[5],
+            "content_length": row[6]
         })
     
-    conn.close()
-    return versions
+    return {
+        "versions": versions,
+        "next_cursor": versions[-1]["version_number"] if len(rows) > limit else None
+    }
 
-@app.post("/notes/{note_id}/versions")
-async def create_manual_version(note_id: int, version_data: NoteVersionCreate, current_user: dict = Depends(get_current_user)):
-    """Criar versão manual com descrição personalizada"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar se a nota existe e obter dados atuais
-    cursor.execute("SELECT title, content FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
-    note_data = cursor.fetchone()
-    if not note_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
+VERSION_DIFF_CACHE_SIZE = int(os.getenv("BURESIDIAN_VERSION_DIFF_CACHE", "256"))
+WORD_DIFF_PATTERN = re.compile(r"\s+|\w+|[^\w\s]", re.UNICODE)
+
+class VersionDiffCache:
+    """Diffs já calculados por (versão de origem, versão de destino, modo); versões não mudam"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._diffs: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: tuple, compute: Callable[[], dict]) -> dict:
+        with self._lock:
+            diff = self._diffs.get(key)
+            if diff is not None:
+                self._diffs.move_to_end(key)
+                self.stats["hits"] += 1
+                return diff
+            self.stats["misses"] += 1
+        
+        diff = compute()
+        with self._lock:
+            self._diffs[key] = diff
+            if len(self._diffs) > self.max_entries:
+                self._diffs.popitem(last=False)
+                self.stats["evictions"] += 1
+        return diff
+
+    def status(self) -> dict:
+        return {"entries": len(self._diffs), "max_entries": self.max_entries, **self.stats}
+
+version_diff_cache = VersionDiffCache(VERSION_DIFF_CACHE_SIZE)
+
+def unified_version_diff(old: str, new: str, old_label: str, new_label: str) -> dict:
+    lines = list(difflib.unified_diff(
+        old.splitlines(keepends=True), new.splitlines(keepends=True),
+        fromfile=old_label, tofile=new_label
+    ))
+    added = sum(1 for line in lines if line.startswith("+") and not line.startswith("+++"))
+    removed = sum(1 for line in lines if line.startswith("-") and not line.startswith("---"))
+    text = "".join(line if line.endswith("\n") else line + "\n\\ No newline at end of file\n" for line in lines)
+    return {"diff": text, "added": added, "removed": removed}
+
+def word_version_diff(old: str, new: str) -> dict:
+    old_tokens = WORD_DIFF_PATTERN.findall(old)
+    new_tokens = WORD_DIFF_PATTERN.findall(new)
+    segments = []
+    added = removed = 0
+    
+    def push(kind: str, text: str):
+        if segments and segments[-1]["op"] == kind:
+            segments[-1]["text"] += text
+        else:
+            segments.append({"op": kind, "text": text})
+    
+    matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            push("equal", "".join(old_tokens[i1:i2]))
+            continue
+        if i2 > i1:
+            push("delete", "".join(old_tokens[i1:i2]))
+            removed += sum(1 for token in old_tokens[i1:i2] if not token.isspace())
+        if j2 > j1:
+            push("insert", "".join(new_tokens[j1:j2]))
+            added += sum(1 for token in new_tokens[j1:j2] if not token.isspace())
+    return {"segments": segments, "added": added, "removed": removed}
+
+@app.get("/notes/{note_id}/versions/diff")
+def get_note_version_diff(
+    note_id: int,
+    from_version: int = Query(..., alias="from", description="id da versão de origem"),
+    to_version: int = Query(..., alias="to", description="id da versão de destino"),
+    mode: str = Query("unified", pattern="^(unified|word)$"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Diff entre duas versões da nota (unified por linhas ou por palavras)"""
+    with db_read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT nv.id, nv.version_number FROM note_versions nv
+            JOIN notes n ON n.id = nv.note_id
+            WHERE nv.note_id = ? AND n.user_id = ? AND nv.id IN (?, ?)
+        """, (note_id, current_user["id"], from_version, to_version))
+        numbers = dict(cursor.fetchall())
+        if from_version not in numbers or to_version not in numbers:
+            raise HTTPException(status_code=404, detail="Version not found")
+        
+        def compute() -> dict:
+            old = read_version_content(cursor, from_version)
+            new = read_version_content(cursor, to_version)
+            if mode == "word":
+                return word_version_diff(old, new)
+            return unified_version_diff(
+                old, new, f"v{numbers[from_version]}", f"v{numbers[to_version]}"
+            )
+        
+        diff = version_diff_cache.get((from_version, to_version, mode), compute)
     
-    title, content = note_data
-    conn.close()
+    return {"from": from_version, "to": to_version, "mode": mode, **diff}
+
+@app.get("/notes/{note_id}/versions/{version_id}")
+def get_note_version(note_id: int, version_id: int, current_user: dict = Depends(get_current_user)):
+    """Uma versão com o conteúdo completo"""
+    with db_read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT nv.id, nv.version_number, nv.title, nv.change_description, nv.created_at, u.username
+            FROM note_versions nv
+            JOIN notes n ON n.id = nv.note_id
+            JOIN users u ON nv.user_id = u.id
+            WHERE nv.id = ? AND nv.note_id = ? AND n.user_id = ?
+        """, (version_id, note_id, current_user["id"]))
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Version not found")
+        content = read_version_content(cursor, version_id)
     
-    # Criar versão
-    version_number = create_note_version(
-        note_id, title, content, current_user["id"], 
-        version_data.change_description or "Manual save"
-    )
+    return {
+        "id": row[0],
+        "version_number": row[1],
+        "title": row[2],
+        "content": content,
+        "change_description": row[3],
+        "created_at": row[4],
+        "username": row[5]
+    }
+
+@app.post("/notes/{note_id}/versions")
+def create_manual_version(note_id: int, version_data: NoteVersionCreate, current_user: dict = Depends(get_current_user)):
+    """Criar versão manual com descrição personalizada"""
+    note_write_buffer.flush([note_id])
+    with db_write() as conn:
+        cursor = conn.cursor()
+        
+        # Verificar se a nota existe e obter dados atuais
+        cursor.execute("SELECT title, content FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
+        note_data = cursor.fetchone()
+        if not note_data:
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        title, content = note_data
+        
+        # Criar versão (mesma transação da leitura: o conteúdo salvo é o que foi lido)
+        version_number = create_note_version(
+            cursor, note_id, title, content, current_user["id"], 
+            version_data.change_description or "Manual save"
+        )
     
     return {"message": "Version created successfully", "version_number": version_number}
 
 @app.post("/notes/{note_id}/restore")
-async def restore_note_version(note_id: int, restore_data: NoteVersionRestore, current_user: dict = Depends(get_current_user)):
+def restore_note_version(note_id: int, restore_data: NoteVersionRestore, current_user: dict = Depends(get_current_user)):
     """Restaurar uma versão específica da nota"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar se a nota existe e pertence ao usuário
-    cursor.execute("SELECT id FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    # Buscar dados da versão
-    cursor.execute("""
-        SELECT title, content FROM note_versions 
-        WHERE id = ? AND note_id = ?
-    """, (restore_data.version_id, note_id))
-    
-    version_data = cursor.fetchone()
-    if not version_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Version not found")
-    
-    title, content = version_data
-    
-    # Criar backup da versão atual antes de restaurar
-    cursor.execute("SELECT title, content FROM notes WHERE id = ?", (note_id,))
-    current_note = cursor.fetchone()
-    if current_note:
-        create_note_version(note_id, current_note[0], current_note[1], current_user["id"], "Before restore")
-    
-    # Restaurar versão
-    cursor.execute("""
-        UPDATE notes SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP 
-        WHERE id = ?
-    """, (title, content, note_id))
-    
-    conn.commit()
-    conn.close()
+    note_write_buffer.flush([note_id])
+    with db_write() as conn:
+        cursor = conn.cursor()
+        
+        # Verificar se a nota existe e pertence ao usuário
+        cursor.execute("SELECT id FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Note not found")
+        
+        # Buscar dados da versão
+        cursor.execute("""
+            SELECT title FROM note_versions 
+            WHERE id = ? AND note_id = ?
+        """, (restore_data.version_id, note_id))
+        
+        version_data = cursor.fetchone()
+        if not version_data:
+            raise HTTPException(status_code=404, detail="Version not found")
+        
+        title = version_data[0]
+        content = read_version_content(cursor, restore_data.version_id)
+        
+        # Criar backup da versão atual antes de restaurar
+        cursor.execute("SELECT title, content FROM notes WHERE id = ?", (note_id,))
+        current_note = cursor.fetchone()
+        if current_note:
+            create_note_version(cursor, note_id, current_note[0], current_note[1], current_user["id"], "Before restore")
+        
+        # Restaurar versão
+        cursor.execute("""
+            UPDATE notes SET title = ?, content = ?, updated_at = CURRENT_TIMESTAMP 
+            WHERE id = ?
+        """, (title, content, note_id))
+        sync_note_indexes(
+            cursor, note_id, current_user["id"], title=title, content=content,
+            previous_title=current_note[0] if current_note else None
+        )
     
+    note_documents.external_update(note_id, content)
     return {"message": "Version restored successfully", "title": title}
 
+def save_note_contents(contents: dict):
+    """Grava o conteúdo de várias notas ({note_id: content}) numa transação só"""
+    with db_write() as conn:
+        cursor = conn.cursor()
+        placeholders = ",".join("?" * len(contents))
+        cursor.execute(f"SELECT id, user_id FROM notes WHERE id IN ({placeholders})", list(contents))
+        owners = dict(cursor.fetchall())
+        
+        for note_id, content in contents.items():
+            if note_id not in owners:
+                continue  # nota apagada enquanto a edição esperava
+            cursor.execute("UPDATE notes SET content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                          (content, note_id))
+            sync_note_indexes(cursor, note_id, owners[note_id], content=content)
+
+# =================== ESCRITA ADIADA DAS EDIÇÕES ===================
+
+class NoteWriteBuffer:
+    """Write-behind das edições recebidas por WebSocket.
+
+    Guarda só o último conteúdo de cada nota e grava quando a nota fica
+    NOTE_WRITE_IDLE_MS sem edições, quando a primeira edição pendente passa de
+    NOTE_WRITE_MAX_DELAY_MS, quando alguém desconecta ou no shutdown. Notas de
+    todas as salas que vencem juntas vão na mesma transação. Rotas REST que
+    leem/escrevem a nota chamam flush([note_id]) antes para não ver ou
+    sobrescrever conteúdo velho.
+    """
+
+    def __init__(self, idle_ms: int, max_delay_ms: int):
+        self.idle = idle_ms / 1000
+        self.max_delay = max_delay_ms / 1000
+        self._pending: dict = {}  # note_id -> {"content", "first", "last"}
+        self._lock = threading.Lock()        # protege _pending (loop e threads do pool)
+        self._flush_lock = threading.Lock()  # um flush por vez: grava na ordem das edições
+        self._task = None
+        self.stats = {
+            "edits": 0,
+            "coalesced": 0,
+            "writes": 0,
+            "flushes": 0,
+            "failures": 0,
+            "max_flush_notes": 0,
+        }
+
+    def add(self, note_id: int, content: str):
+        now = time.monotonic()
+        with self._lock:
+            self.stats["edits"] += 1
+            entry = self._pending.get(note_id)
+            if entry:
+                self.stats["coalesced"] += 1
+                entry["content"] = content
+                entry["last"] = now
+            else:
+                self._pending[note_id] = {"content": content, "first": now, "last": now}
+        # GET /notes/{id} já devolve o conteúdo pendente, então o ETag da nota muda agora
+        change_counters.bump(("note", note_id))
+        
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def pending_content(self, note_id: int) -> Optional[str]:
+        with self._lock:
+            entry = self._pending.get(note_id)
+            return entry["content"] if entry else None
+
+    def discard(self, note_id: int):
+        with self._lock:
+            self._pending.pop(note_id, None)
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(min(self.idle, self.max_delay) / 2)
+            try:
+                await run_db(self.flush_due)
+            except Exception as e:
+                print(f"Error flushing note edits: {e}")
+
+    def flush_due(self):
+        now = time.monotonic()
+        self._flush(lambda entry: now - entry["last"] >= self.idle or now - entry["first"] >= self.max_delay)
+
+    def flush(self, note_ids: Optional[list] = None):
+        """Grava já as notas indicadas (ou todas); chamar fora de db_write()"""
+        wanted = set(note_ids) if note_ids is not None else None
+        self._flush(lambda entry: True, wanted)
+
+    def _flush(self, is_due: Callable[[dict], bool], note_ids: Optional[set] = None):
+        with self._flush_lock:
+            with self._lock:
+                due = {
+                    note_id: entry for note_id, entry in self._pending.items()
+                    if (note_ids is None or note_id in note_ids) and is_due(entry)
+                }
+                for note_id in due:
+                    del self._pending[note_id]
+            if not due:
+                return
+            
+            try:
+                save_note_contents({note_id: entry["content"] for note_id, entry in due.items()})
+            except Exception:
+                self.stats["failures"] += 1
+                # Devolver o que não foi substituído por edições mais novas
+                with self._lock:
+                    for note_id, entry in due.items():
+                        self._pending.setdefault(note_id, entry)
+                raise
+            
+            self.stats["flushes"] += 1
+            self.stats["writes"] += len(due)
+            self.stats["max_flush_notes"] = max(self.stats["max_flush_notes"], len(due))
+
+    def status(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending_notes": pending,
+            "idle_ms": NOTE_WRITE_IDLE_MS,
+            "max_delay_ms": NOTE_WRITE_MAX_DELAY_MS,
+            **self.stats,
+        }
+
+note_write_buffer = NoteWriteBuffer(NOTE_WRITE_IDLE_MS, NOTE_WRITE_MAX_DELAY_MS)
+
+# =================== SINCRONIZAÇÃO DE TEXTO (OT) ===================
+#
+# Uma op é uma lista de componentes sobre o documento inteiro, como no ot.js:
+# int > 0 mantém n caracteres, int < 0 apaga n, str insere o texto. Posições
+# contam code points (não unidades UTF-16).
+
+def ot_validate(op, length: int) -> bool:
+    if not isinstance(op, list):
+        return False
+    consumed = 0
+    for component in op:
+        if isinstance(component, str):
+            if not component:
+                return False
+        elif isinstance(component, int) and not isinstance(component, bool) and component != 0:
+            consumed += abs(component)
+        else:
+            return False
+    return consumed == length
+
+def ot_apply(text: str, op: list) -> str:
+    result = []
+    position = 0
+    for component in op:
+        if isinstance(component, str):
+            result.append(component)
+        elif component > 0:
+            result.append(text[position:position + component])
+            position += component
+        else:
+            position -= component
+    return "".join(result)
+
+def _ot_push(op: list, component):
+    """Acrescenta juntando componentes vizinhos do mesmo tipo"""
+    if op and isinstance(component, str) and isinstance(op[-1], str):
+        op[-1] += component
+    elif op and isinstance(component, int) and isinstance(op[-1], int) and (component > 0) == (op[-1] > 0):
+        op[-1] += component
+    else:
+        op.append(component)
+
+def ot_transform(a: list, b: list) -> tuple:
+    """(a', b') tais que apply(apply(s, a), b') == apply(apply(s, b), a').
+
+    Inserções na mesma posição: a de `a` fica antes.
+    """
+    a_prime, b_prime = [], []
+    ia, ib = iter(a), iter(b)
+    ca, cb = next(ia, None), next(ib, None)
+    
+    while ca is not None or cb is not None:
+        if isinstance(ca, str):
+            _ot_push(a_prime, ca)
+            _ot_push(b_prime, len(ca))
+            ca = next(ia, None)
+            continue
+        if isinstance(cb, str):
+            _ot_push(a_prime, len(cb))
+            _ot_push(b_prime, cb)
+            cb = next(ib, None)
+            continue
+        if ca is None or cb is None:
+            raise ValueError("Operations do not apply to the same document")
+        
+        n = min(abs(ca), abs(cb))
+        if ca > 0 and cb > 0:
+            _ot_push(a_prime, n)
+            _ot_push(b_prime, n)
+        elif ca < 0 and cb > 0:
+            _ot_push(a_prime, -n)
+        elif ca > 0 and cb < 0:
+            _ot_push(b_prime, -n)
+        # ambos apagam o mesmo trecho: nada a fazer
+        
+        ca = ca - n if ca > 0 else ca + n
+        cb = cb - n if cb > 0 else cb + n
+        if ca == 0:
+            ca = next(ia, None)
+        if cb == 0:
+            cb = next(ib, None)
+    
+    return a_prime, b_prime
+
+def ot_from_replace(old: str, new: str) -> list:
+    """Op mínima (prefixo/sufixo comuns) que transforma `old` em `new`"""
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    
+    op = []
+    if prefix:
+        op.append(prefix)
+    if len(new) - prefix - suffix:
+        op.append(new[prefix:len(new) - suffix])
+    if len(old) - prefix - suffix:
+        op.append(-(len(old) - prefix - suffix))
+    if suffix:
+        op.append(suffix)
+    return op
+
+NOTE_OT_HISTORY = int(os.getenv("BURESIDIAN_NOTE_OT_HISTORY", "500"))  # ops guardadas para catch-up
+
+class NoteDocument:
+    """Documento autoritativo de uma nota aberta, com as últimas ops para catch-up"""
+
+    def __init__(self, content: str, revision: int):
+        self.content = content
+        self.revision = revision
+        self.history = deque(maxlen=NOTE_OT_HISTORY)  # op que levou a cada revisão, em ordem
+
+    def ops_since(self, revision: int) -> Optional[list]:
+        """Ops de `revision` até a atual, ou None se já saíram do histórico"""
+        oldest = self.revision - len(self.history)
+        if revision < oldest or revision > self.revision:
+            return None
+        return list(self.history)[revision - oldest:]
+
+    def apply(self, revision: int, op: list) -> list:
+        """Aplica uma op feita sobre `revision`; devolve a op transformada para a revisão atual"""
+        concurrent = self.ops_since(revision)
+        if concurrent is None:
+            raise ValueError("Unknown revision")
+        if not ot_validate(op, self._length_at(revision)):
+            raise ValueError("Invalid operation")
+        for past in concurrent:
+            op = ot_transform(op, past)[0]
+        return self._commit(op)
+
+    def replace(self, content: str) -> list:
+        """Troca o conteúdo inteiro (clientes antigos/REST) registrando a op equivalente"""
+        return self._commit(ot_from_replace(self.content, content))
+
+    def _commit(self, op: list) -> list:
+        self.content = ot_apply(self.content, op)
+        self.history.append(op)
+        self.revision += 1
+        return op
+
+    def _length_at(self, revision: int) -> int:
+        """Tamanho do documento em `revision`, desfazendo o efeito das ops seguintes"""
+        length = len(self.content)
+        for op in self.ops_since(revision):
+            for component in op:
+                if isinstance(component, str):
+                    length -= len(component)
+                elif component < 0:
+                    length -= component
+        return length
+
+class NoteDocumentStore:
+    """Documentos das notas com alguém conectado; o conteúdo vai ao banco pelo note_write_buffer.
+
+    Revisões começam no relógio (ms) e nunca voltam para a mesma nota, então um
+    cliente com revisão de uma sessão anterior recebe snapshot em vez de ops erradas.
+    """
+
+    def __init__(self):
+        self.docs: dict = {}
+        self._locks: dict = {}
+        self._last_revision: dict = {}
+        self._loop = None
+
+    async def get(self, note_id: int) -> Optional[NoteDocument]:
+        doc = self.docs.get(note_id)
+        if doc:
+            return doc
+        
+        lock = self._locks.setdefault(note_id, asyncio.Lock())
+        async with lock:
+            if note_id not in self.docs:
+                content = await run_db(fetch_note_content, note_id)
+                if content is None:
+                    return None
+                pending = note_write_buffer.pending_content(note_id)
+                revision = max(int(time.time() * 1000), self._last_revision.get(note_id, 0) + 1)
+                self.docs[note_id] = NoteDocument(pending if pending is not None else content, revision)
+                self._loop = asyncio.get_running_loop()
+        return self.docs.get(note_id)
+
+    def unload(self, note_id: int):
+        doc = self.docs.pop(note_id, None)
+        self._locks.pop(note_id, None)
+        if doc:
+            self._last_revision[note_id] = doc.revision
+
+    def external_update(self, note_id: int, content: str):
+        """Conteúdo gravado fora do WebSocket (REST); pode ser chamado das threads do pool"""
+        if note_id in self.docs and self._loop:
+            self._loop.call_soon_threadsafe(self._apply_external, note_id, content)
+
+    def _apply_external(self, note_id: int, content: str):
+        doc = self.docs.get(note_id)
+        if not doc or doc.content == content:
+            return
+        op = doc.replace(content)
+        manager.broadcast_note_edit(
+            note_id,
+            {"type": "op", "revision": doc.revision, "op": op, "user_id": None, "username": None},
+            {"type": "content_change", "content": content, "user_id": None, "username": None}
+        )
+
+note_documents = NoteDocumentStore()
+
+def fetch_note_content(note_id: int) -> Optional[str]:
+    with db_read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT content FROM notes WHERE id = ?", (note_id,))
+        row = cursor.fetchone()
+        return row[0] or "" if row else None
+
 # WebSocket para colaboração em tempo real
 @app.websocket("/ws/notes/{note_id}")
 async def websocket_endpoint(websocket: WebSocket, note_id: int, user_id: int = 1, username: str = "user"):
@@ -933,20 +3465,77 @@ async def websocket_endpoint(websocket: WebSocket, note_id: int, user_id: int =
             
             # Atualizar nota no banco se for uma mudança de conteúdo
             if message.get("type") == "content_change":
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("UPDATE notes SET content = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-                              (message.get("content", ""), note_id))
-                conn.commit()
-                conn.close()
+                # Protocolo antigo (conteúdo inteiro): vira uma op no documento da sala
+                content = message.get("content", "")
+                doc = await note_documents.get(note_id)
+                op = doc.replace(content) if doc else ot_from_replace("", content)
                 
-                # Broadcast para outros usuários
-                await manager.broadcast_to_note(note_id, {
+                # Gravação adiada: edições seguidas viram uma escrita só
+                note_write_buffer.add(note_id, content)
+                
+                manager.broadcast_note_edit(note_id, {
+                    "type": "op",
+                    "revision": doc.revision if doc else None,
+                    "op": op,
+                    "user_id": message.get("user_id"),
+                    "username": message.get("username")
+                }, {
                     "type": "content_change",
-                    "content": message.get("content", ""),
+                    "content": content,
                     "user_id": message.get("user_id"),
                     "username": message.get("username")
-                }, message.get("user_id"))
+                }, origin=websocket)
+            
+            elif message.get("type") == "op":
+                # Edição incremental: {"revision": base, "op": [...]} -> ack para o autor, op para os outros
+                manager.use_ot(note_id, websocket)
+                doc = await note_documents.get(note_id)
+                if not doc:
+                    await websocket.close(code=1008, reason="Note not found")
+                    break
+                
+                try:
+                    op = doc.apply(message.get("revision"), message.get("op"))
+                except (TypeError, ValueError) as e:
+                    # Cliente fora de sincronia: manda o estado atual para recomeçar
+                    manager.send_to_note_connection(note_id, websocket, {
+                        "type": "snapshot", "revision": doc.revision, "content": doc.content, "error": str(e)
+                    })
+                    continue
+                
+                note_write_buffer.add(note_id, doc.content)
+                manager.send_to_note_connection(note_id, websocket, {"type": "ack", "revision": doc.revision})
+                manager.broadcast_note_edit(note_id, {
+                    "type": "op",
+                    "revision": doc.revision,
+                    "op": op,
+                    "user_id": message.get("user_id"),
+                    "username": message.get("username")
+                }, {
+                    "type": "content_change",
+                    "content": doc.content,
+                    "user_id": message.get("user_id"),
+                    "username": message.get("username")
+                }, origin=websocket)
+            
+            elif message.get("type") == "sync":
+                # Catch-up: ops desde "revision" se ainda estiverem no histórico, senão snapshot
+                manager.use_ot(note_id, websocket)
+                doc = await note_documents.get(note_id)
+                if not doc:
+                    await websocket.close(code=1008, reason="Note not found")
+                    break
+                
+                revision = message.get("revision")
+                ops = doc.ops_since(revision) if isinstance(revision, int) else None
+                if ops is not None:
+                    manager.send_to_note_connection(note_id, websocket, {
+                        "type": "ops", "from": revision, "revision": doc.revision, "ops": ops
+                    })
+                else:
+                    manager.send_to_note_connection(note_id, websocket, {
+                        "type": "snapshot", "revision": doc.revision, "content": doc.content
+                    })
             
             elif message.get("type") == "version_created":
                 # Notificar outros usuários sobre nova versão
@@ -967,20 +3556,31 @@ async def websocket_endpoint(websocket: WebSocket, note_id: int, user_id: int =
                 }, message.get("user_id"))
             
             elif message.get("type") == "cursor_position":
-                # Broadcast posição do cursor
-                await manager.broadcast_to_note(note_id, {
+                # Posição do cursor: agregada e enviada no próximo tick
+                manager.presence_to_note(note_id, {
                     "type": "cursor_position",
                     "position": message.get("position"),
                     "user_id": message.get("user_id"),
                     "username": message.get("username")
-                }, message.get("user_id"))
+                }, message.get("user_id"), "cursor_position")
             
     except WebSocketDisconnect:
-        manager.disconnect(websocket, note_id)
+        pass
+    
+    manager.disconnect(websocket, note_id)
+    if note_id not in manager.active_connections:
+        note_documents.unload(note_id)
+    await run_db(note_write_buffer.flush, [note_id])
 
 # WebSocket para colaboração em Canvas boards
 @app.websocket("/ws/canvas/{board_id}")
-async def canvas_websocket_endpoint(websocket: WebSocket, board_id: int, user_id: int = 1, username: str = "user"):
+async def canvas_websocket_endpoint(websocket: WebSocket, board_id: int, user_id: int = 1, username: str = "user",
+                                    token: Optional[str] = None):
+    # Clientes com token usam o protocolo de ops do canvas (mesma rota, registrada abaixo)
+    if token is not None:
+        await canvas_websocket(websocket, board_id, token)
+        return
+    
     # Em produção, seria necessário validar o token JWT aqui
     await manager.connect_to_board(websocket, board_id, user_id, username)
     try:
@@ -990,135 +3590,112 @@ async def canvas_websocket_endpoint(websocket: WebSocket, board_id: int, user_id
             
             # Broadcast para outros usuários baseado no tipo de mensagem
             if message.get("type") in ["node_moved", "node_resized", "edge_created", "edge_deleted", "viewport_changed"]:
-                await manager.broadcast_to_board(board_id, {
+                relay = {
                     "type": message.get("type"),
                     "board_id": board_id,
                     "data": message.get("data"),
                     "user_id": message.get("user_id"),
                     "username": message.get("username")
-                }, message.get("user_id"))
+                }
+                data = message.get("data")
+                if message.get("type") == "viewport_changed":
+                    # Viewport e arrasto só importam pela última posição: vão pelo agregador
+                    manager.presence_to_board(board_id, relay, message.get("user_id"), "viewport_changed")
+                elif message.get("type") == "node_moved" and isinstance(data, dict) and "id" in data:
+                    manager.presence_to_board(board_id, relay, message.get("user_id"), ("node_moved", data["id"]))
+                else:
+                    await manager.broadcast_to_board(board_id, relay, message.get("user_id"))
             
             elif message.get("type") == "cursor_position":
-                # Broadcast posição do cursor no canvas
-                await manager.broadcast_to_board(board_id, {
+                # Posição do cursor no canvas: agregada e enviada no próximo tick
+                manager.presence_to_board(board_id, {
                     "type": "cursor_position",
                     "position": message.get("position"),
                     "user_id": message.get("user_id"),
                     "username": message.get("username")
-                }, message.get("user_id"))
+                }, message.get("user_id"), "cursor_position")
             
     except WebSocketDisconnect:
         manager.disconnect_from_board(websocket, board_id)
 
 # Busca
 @app.get("/search")
-async def search_notes(q: str, folder_id: int = None, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    search_term = f"%{q}%"
+def search_notes(q: str, folder_id: int = None, current_user: dict = Depends(get_current_user)):
+    match = fts_query(q)
+    if match is None:
+        return []
     
-    # Construir query baseada nos filtros
-    base_query = """
-        SELECT n.id, n.title, n.content, n.folder_id, f.name as folder_name
-        FROM notes n
-        LEFT JOIN folders f ON n.folder_id = f.id
-        WHERE n.user_id = ? AND (n.title LIKE ? OR n.content LIKE ?)
-    """
+    with db_read() as conn:
+        cursor = conn.cursor()
+    
+        # Construir query baseada nos filtros
+        base_query = f"""
+            SELECT n.id, n.title, n.content, n.folder_id, f.name as folder_name
+            FROM notes_fts
+            JOIN notes n ON n.id = notes_fts.rowid
+            LEFT JOIN folders f ON n.folder_id = f.id
+            WHERE notes_fts MATCH ? AND n.user_id = ?
+        """
     
-    params = [current_user["id"], search_term, search_term]
+        params = [match, current_user["id"]]
     
-    if folder_id is not None:
-        base_query += " AND n.folder_id = ?"
-        params.append(folder_id)
+        if folder_id is not None:
+            base_query += " AND n.folder_id = ?"
+            params.append(folder_id)
     
-    base_query += " ORDER BY n.updated_at DESC"
+        base_query += f" ORDER BY {FTS_RANK}, n.updated_at DESC"
     
-    cursor.execute(base_query, params)
+        cursor.execute(base_query, params)
     
-    results = []
-    for row in cursor.fetchall():
-        results.append({
-            "id": row[0],
-            "title": row[1],
-            "content": row[2][:200] + "..." if len(row[2]) > 200 else row[2],  # Preview
-            "folder_id": row[3],
-            "folder_name": row[4]
-        })
-    conn.close()
+        results = []
+        for row in cursor.fetchall():
+            results.append({
+                "id": row[0],
+                "title": row[1],
+                "content": row[2][:200] + "..." if len(row[2]) > 200 else row[2],  # Preview
+                "folder_id": row[3],
+                "folder_name": row[4]
+            })
     return results
 
 # Endpoints para grafo de conexões
-@app.get("/notes/graph")
-async def get_notes_graph(current_user: dict = Depends(get_current_user)):
-    """Gerar dados do grafo de conexões entre notas"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Buscar todas as notas do usuário
-    cursor.execute("""
-        SELECT n.id, n.title, n.content, n.folder_id, f.name as folder_name
-        FROM notes n
-        LEFT JOIN folders f ON n.folder_id = f.id
-        WHERE n.user_id = ?
-        ORDER BY n.updated_at DESC
-    """, (current_user["id"],))
-    
-    notes = {}
+def build_notes_graph(graph: UserGraph) -> dict:
+    """Nós e arestas (menções e [[links]]) do grafo de conexões"""
     nodes = []
     edges = []
     
-    # Criar nodes
-    for row in cursor.fetchall():
-        note_id, title, content, folder_id, folder_name = row
-        notes[note_id] = {
-            "id": note_id,
-            "title": title,
-            "content": content,
-            "folder_id": folder_id,
-            "folder_name": folder_name
-        }
-        
+    for note_id in graph.ordered_ids():
+        note = graph.notes[note_id]
+        folder_name = note["folder_name"]
         nodes.append({
             "id": note_id,
-            "label": title,
+            "label": note["title"],
             "group": folder_name or "Sem pasta",
-            "title": f"📝 {title}\n📁 {folder_name or 'Sem pasta'}\n✏️ {len(content)} caracteres"
+            "title": f"📝 {note['title']}\n📁 {folder_name or 'Sem pasta'}\n✏️ {note['length']} caracteres"
         })
-    
-    # Detectar conexões através de menções de títulos
-    import re
-    for note_id, note in notes.items():
-        content = note["content"].lower()
         
-        # Buscar menções a outros títulos
-        for other_id, other_note in notes.items():
-            if note_id != other_id:
-                other_title = other_note["title"].lower()
-                
-                # Detectar menções diretas do título
-                if len(other_title) > 3 and other_title in content:
-                    edges.append({
-                        "from": note_id,
-                        "to": other_id,
-                        "label": "menciona",
-                        "color": {"color": "#8b5cf6"},
-                        "arrows": "to"
-                    })
-                
-                # Detectar links markdown [[titulo]]
-                markdown_links = re.findall(r'\[\[([^\]]+)\]\]', note["content"])
-                for link in markdown_links:
-                    if link.lower() == other_title:
-                        edges.append({
-                            "from": note_id,
-                            "to": other_id,
-                            "label": "link",
-                            "color": {"color": "#10b981"},
-                            "arrows": "to",
-                            "width": 2
-                        })
-    
-    conn.close()
+        # Menções diretas do título
+        for other_id in sorted(graph.mentions.get(note_id, ())):
+            if other_id != note_id and other_id in graph.notes:
+                edges.append({
+                    "from": note_id,
+                    "to": other_id,
+                    "label": "menciona",
+                    "color": {"color": "#8b5cf6"},
+                    "arrows": "to"
+                })
+        
+        # Links markdown [[titulo]]
+        for other_id in graph.links.get(note_id, []):
+            if other_id != note_id and other_id in graph.notes:
+                edges.append({
+                    "from": note_id,
+                    "to": other_id,
+                    "label": "link",
+                    "color": {"color": "#10b981"},
+                    "arrows": "to",
+                    "width": 2
+                })
     
     return {
         "nodes": nodes,
@@ -1126,84 +3703,71 @@ async def get_notes_graph(current_user: dict = Depends(get_current_user)):
         "stats": {
             "total_notes": len(nodes),
             "total_connections": len(edges),
-            "folders": len(set(note["folder_name"] for note in notes.values()))
+            "folders": len(set(note["folder_name"] for note in graph.notes.values()))
         }
     }
 
-@app.get("/notes/{note_id}/connections")
-async def get_note_connections(note_id: int, current_user: dict = Depends(get_current_user)):
-    """Obter conexões específicas de uma nota"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def build_note_connections(graph: UserGraph, note_id: int) -> dict:
+    """Notas que citam/linkam a nota (entrada) e notas citadas/linkadas por ela (saída)"""
+    incoming_ids = set(graph.mentioned_by.get(note_id, ()))
+    incoming_ids.update(source_id for source_id, targets in graph.links.items() if note_id in targets)
+    incoming_ids.discard(note_id)
     
-    # Verificar se a nota existe
-    cursor.execute("SELECT title, content FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user["id"]))
-    note_data = cursor.fetchone()
-    if not note_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    title, content = note_data
-    
-    # Buscar notas que mencionam esta nota
-    cursor.execute("""
-        SELECT id, title, content FROM notes 
-        WHERE user_id = ? AND id != ? AND (LOWER(content) LIKE ? OR LOWER(content) LIKE ?)
-    """, (current_user["id"], note_id, f"%{title.lower()}%", f"%[[{title.lower()}]]%"))
+    outgoing_ids = set(graph.mentions.get(note_id, ()))
+    outgoing_ids.update(graph.links.get(note_id, []))
+    outgoing_ids.discard(note_id)
     
     incoming = []
-    for row in cursor.fetchall():
-        incoming.append({
-            "id": row[0],
-            "title": row[1],
-            "preview": row[2][:100] + "..." if len(row[2]) > 100 else row[2]
-        })
-    
-    # Buscar notas mencionadas por esta nota
-    cursor.execute("""
-        SELECT id, title FROM notes WHERE user_id = ? AND id != ?
-    """, (current_user["id"], note_id))
+    for other_id in sorted(incoming_ids):
+        other = graph.notes.get(other_id)
+        if other:
+            incoming.append({
+                "id": other_id,
+                "title": other["title"],
+                "preview": other["preview"] + "..." if other["length"] > 100 else other["preview"]
+            })
     
     outgoing = []
-    all_notes = cursor.fetchall()
-    
-    import re
-    content_lower = content.lower()
-    markdown_links = re.findall(r'\[\[([^\]]+)\]\]', content)
-    
-    for row in all_notes:
-        other_id, other_title = row
-        other_title_lower = other_title.lower()
-        
-        # Verificar menções diretas ou links markdown
-        if (len(other_title) > 3 and other_title_lower in content_lower) or \
-           any(link.lower() == other_title_lower for link in markdown_links):
+    for other_id in sorted(outgoing_ids):
+        other = graph.notes.get(other_id)
+        if other:
             outgoing.append({
                 "id": other_id,
-                "title": other_title
+                "title": other["title"]
             })
     
-    conn.close()
-    
     return {
         "note_id": note_id,
-        "note_title": title,
+        "note_title": graph.notes[note_id]["title"],
         "incoming_connections": incoming,
         "outgoing_connections": outgoing,
         "total_connections": len(incoming) + len(outgoing)
     }
 
+@app.get("/notes/{note_id}/connections")
+def get_note_connections(note_id: int, current_user: dict = Depends(get_current_user)):
+    """Obter conexões específicas de uma nota"""
+    graph = graph_cache.get(current_user["id"])
+    connections = graph.view(
+        f"connections:{note_id}",
+        lambda graph: build_note_connections(graph, note_id),
+        needs_mentions=True,
+        note_id=note_id
+    )
+    if connections is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    return connections
+
 # Performance e Health Check Endpoints
 @app.get("/health")
-async def health_check():
+def health_check():
     """Endpoint de health check para monitoramento"""
     try:
         # Teste básico de conexão com banco
-        conn = sqlite3.connect('buresidian.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM notes")
-        note_count = cursor.fetchone()[0]
-        conn.close()
+        with db_read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM notes")
+            note_count = cursor.fetchone()[0]
         
         return {
             "status": "healthy",
@@ -1218,11 +3782,8 @@ async def health_check():
             detail=f"Health check failed: {str(e)}"
         )
 
-@app.get("/metrics")
-async def get_metrics():
-    """Endpoint de métricas para monitoramento de performance"""
-    try:
-        conn = sqlite3.connect('buresidian.db')
+def collect_database_metrics() -> dict:
+    with db_read() as conn:
         cursor = conn.cursor()
         
         # Estatísticas básicas
@@ -1250,24 +3811,45 @@ async def get_metrics():
             WHERE updated_at > ?
         """, (week_ago,))
         active_users = cursor.fetchone()[0]
-        
-        conn.close()
+    
+    return {
+        "database": {
+            "users": user_count,
+            "notes": note_count,
+            "folders": folder_count,
+            "comments": comment_count
+        },
+        "activity": {
+            "notes_last_24h": notes_24h,
+            "active_users_last_7d": active_users
+        }
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Endpoint de métricas para monitoramento de performance"""
+    try:
+        database_metrics = await run_db(collect_database_metrics)
         
         return {
             "timestamp": datetime.now().isoformat(),
-            "database": {
-                "users": user_count,
-                "notes": note_count,
-                "folders": folder_count,
-                "comments": comment_count
-            },
-            "activity": {
-                "notes_last_24h": notes_24h,
-                "active_users_last_7d": active_users
-            },
+            **database_metrics,
             "websocket": {
                 "connected_clients": len(manager.active_connections)
-            }
+            },
+            "database_pool": db_pool.status(),
+            "database_executor": db_executor_status(),
+            "graph_cache": graph_cache.status(),
+            "canvas_persistence": canvas_persist_status(),
+            "websocket_send": ws_send_status(),
+            "presence": presence_aggregator.status(),
+            "note_write_buffer": note_write_buffer.status(),
+            "version_diff_cache": version_diff_cache.status(),
+            "version_retention": version_compactor.status(),
+            "auth_cache": auth_cache.status(),
+            "etags": change_counters.status(),
+            "view_cache": view_cache.status(),
+            "password_hashing": password_hasher.status()
         }
     except Exception as e:
         raise HTTPException(
@@ -1277,14 +3859,13 @@ async def get_metrics():
 
 # Endpoint de saúde do sistema
 @app.get("/health")
-async def health_check():
+def health_check():
     try:
         # Verificar banco de dados
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.fetchone()
-        conn.close()
+        with db_read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
         database_status = "healthy"
     except Exception:
         database_status = "error"
@@ -1308,7 +3889,7 @@ async def health_check():
 
 # Endpoint para busca avançada com cache
 @app.get("/search/advanced")
-async def advanced_search(
+def advanced_search(
     q: str = Query(..., min_length=2),
     folder_id: Optional[int] = None,
     user_id: Optional[int] = None,
@@ -1320,52 +3901,55 @@ async def advanced_search(
 ):
     """Busca avançada com filtros adicionais"""
     try:
-        conn = sqlite3.connect('buresidian.db')
-        cursor = conn.cursor()
+        match = fts_query(q)
+        notes = []
+        total_count = 0
         
-        # Query base
-        query = """
-            SELECT DISTINCT n.id, n.title, n.content, n.created_at, n.updated_at, 
-                   n.user_id, n.folder_id, f.name as folder_name
-            FROM notes n
-            LEFT JOIN folders f ON n.folder_id = f.id
-            WHERE (n.title LIKE ? OR n.content LIKE ?)
-        """
-        params = [f"%{q}%", f"%{q}%"]
+        with db_read() as conn:
+            cursor = conn.cursor()
         
-        # Adicionar filtros opcionais
-        if folder_id:
-            query += " AND n.folder_id = ?"
-            params.append(folder_id)
+            # Filtros: a busca textual vem do índice FTS5
+            where = "WHERE notes_fts MATCH ?"
+            params = [match]
+        
+            # Adicionar filtros opcionais
+            if folder_id:
+                where += " AND n.folder_id = ?"
+                params.append(folder_id)
             
-        if user_id:
-            query += " AND n.user_id = ?"
-            params.append(user_id)
+            if user_id:
+                where += " AND n.user_id = ?"
+                params.append(user_id)
             
-        if date_from:
-            query += " AND n.created_at >= ?"
-            params.append(date_from)
+            if date_from:
+                where += " AND n.created_at >= ?"
+                params.append(date_from)
             
-        if date_to:
-            query += " AND n.created_at <= ?"
-            params.append(date_to)
-        
-        # Ordenação e paginação
-        query += " ORDER BY n.updated_at DESC LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
-        
-        cursor.execute(query, params)
-        notes = cursor.fetchall()
-        
-        # Contar total de resultados
-        count_query = query.replace(
-            "SELECT DISTINCT n.id, n.title, n.content, n.created_at, n.updated_at, n.user_id, n.folder_id, f.name as folder_name",
-            "SELECT COUNT(DISTINCT n.id)"
-        ).replace("ORDER BY n.updated_at DESC LIMIT ? OFFSET ?", "")
-        cursor.execute(count_query, params[:-2])  # Remover limit e offset
-        total_count = cursor.fetchone()[0]
-        
-        conn.close()
+            if date_to:
+                where += " AND n.created_at <= ?"
+                params.append(date_to)
+        
+            if match is not None:
+                # Ordenação por relevância (bm25) e paginação
+                cursor.execute(f"""
+                    SELECT n.id, n.title, n.content, n.created_at, n.updated_at,
+                           n.user_id, n.folder_id, f.name as folder_name
+                    FROM notes_fts
+                    JOIN notes n ON n.id = notes_fts.rowid
+                    LEFT JOIN folders f ON n.folder_id = f.id
+                    {where}
+                    ORDER BY {FTS_RANK}, n.updated_at DESC
+                    LIMIT ? OFFSET ?
+                """, params + [limit, offset])
+                notes = cursor.fetchall()
+            
+                # Contar total de resultados
+                cursor.execute(f"""
+                    SELECT COUNT(*) FROM notes_fts
+                    JOIN notes n ON n.id = notes_fts.rowid
+                    {where}
+                """, params)
+                total_count = cursor.fetchone()[0]
         
         results = []
         for note in notes:
@@ -1394,57 +3978,674 @@ async def advanced_search(
             detail=f"Advanced search failed: {str(e)}"
         )
 
+# =================== EXPORTAÇÃO DO VAULT ===================
+# GET /export percorre as notas do usuário em lotes por id (cada lote numa
+# leitura curta) e vai escrevendo a saída conforme lê: memória limitada a um
+# lote de notas e às versões de uma nota. Formatos:
+#   ndjson: um registro JSON por linha (vault, folder, note, version, upload,
+#           upload_chunk, cursor, end); após cada nota vem um registro cursor
+#   zip:    folders.ndjson, notes/<pasta>/<título>.md, meta/<id>.json,
+#           versions/<id>.ndjson e uploads/<arquivo>
+# Para retomar, ?cursor= recebe o último cursor visto (ou o X-Export-Next-Cursor
+# de uma exportação com limit) e continua a partir da nota seguinte.
+
+EXPORT_BATCH_NOTES = int(os.getenv("BURESIDIAN_EXPORT_BATCH", "200"))
+EXPORT_CHUNK_BYTES = 256 * 1024
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "zip": "application/zip"}
+UPLOAD_REFERENCE_PATTERN = re.compile(r"/uploads/([A-Za-z0-9][A-Za-z0-9._-]*)")
+UNSAFE_FILENAME_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Destino não-seekable para o zipfile: guarda o que foi escrito até o próximo drain()"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def export_folder_paths(user_id: int) -> dict:
+    """{folder_id: {"name", "parent_id", "path"}} das pastas do usuário"""
+    with db_read() as conn:
+        rows = conn.execute("SELECT id, name, parent_id FROM folders WHERE user_id = ? ORDER BY id",
+                            (user_id,)).fetchall()
+    folders = {folder_id: {"name": name, "parent_id": parent_id} for folder_id, name, parent_id in rows}
+    
+    def path_of(folder_id, seen=()):
+        folder = folders.get(folder_id)
+        if folder is None or folder_id in seen:
+            return []
+        return path_of(folder["parent_id"], seen + (folder_id,)) + [safe_export_name(folder["name"])]
+    
+    for folder_id, folder in folders.items():
+        folder["path"] = "/".join(path_of(folder_id))
+    return folders
+
+def safe_export_name(name: Optional[str]) -> str:
+    cleaned = UNSAFE_FILENAME_CHARS.sub("-", name or "").strip(" .")
+    return cleaned[:120] or "Sem título"
+
+def export_duplicate_titles(user_id: int) -> set:
+    """(folder_id, title_key) repetidos na mesma pasta: esses arquivos levam o id no nome"""
+    with db_read() as conn:
+        return set(conn.execute("""
+            SELECT folder_id, title_key FROM notes WHERE user_id = ?
+            GROUP BY folder_id, title_key HAVING COUNT(*) > 1
+        """, (user_id,)).fetchall())
+
+def export_range(user_id: int, after_id: int, limit: Optional[int]) -> tuple:
+    """(último id desta exportação ou None para ir até o fim, há mais notas depois dele?)"""
+    if limit is None:
+        return None, False
+    with db_read() as conn:
+        row = conn.execute(
+            "SELECT id FROM notes WHERE user_id = ? AND id > ? ORDER BY id LIMIT 1 OFFSET ?",
+            (user_id, after_id, limit - 1)
+        ).fetchone()
+        if row is None:
+            return None, False
+        more = conn.execute("SELECT 1 FROM notes WHERE user_id = ? AND id > ? LIMIT 1",
+                            (user_id, row[0])).fetchone() is not None
+    return row[0], more
+
+def iter_export_notes(user_id: int, after_id: int, until_id: Optional[int]):
+    """Notas com tags e versões, em ordem de id, lendo EXPORT_BATCH_NOTES por vez"""
+    while True:
+        with db_read() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, title, content, folder_id, created_at, updated_at, title_key FROM notes
+                WHERE user_id = ? AND id > ? AND (? IS NULL OR id <= ?)
+                ORDER BY id LIMIT ?
+            """, (user_id, after_id, until_id, until_id, EXPORT_BATCH_NOTES))
+            batch = cursor.fetchall()
+            if not batch:
+                return
+            placeholders = ",".join("?" * len(batch))
+            cursor.execute(f"""
+                SELECT note_id, tag FROM note_tags
+                WHERE note_id IN ({placeholders}) AND path = tag ORDER BY note_id, position
+            """, [row[0] for row in batch])
+            tags: dict = {}
+            for note_id, tag in cursor.fetchall():
+                tags.setdefault(note_id, []).append(tag)
+        
+        for note_id, title, content, folder_id, created_at, updated_at, key in batch:
+            with db_read() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT id, version_number, title, change_description, created_at FROM note_versions
+                    WHERE note_id = ? ORDER BY version_number
+                """, (note_id,))
+                metadata = cursor.fetchall()
+                contents = load_version_contents(cursor, note_id) if metadata else {}
+            versions = [{
+                "type": "version",
+                "note_id": note_id,
+                "id": version_id,
+                "version_number": number,
+                "title": version_title,
+                "content": contents.get(version_id),
+                "change_description": description,
+                "created_at": version_created_at,
+            } for version_id, number, version_title, description, version_created_at in metadata]
+            note = {
+                "type": "note",
+                "id": note_id,
+                "title": title,
+                "content": content or "",
+                "folder_id": folder_id,
+                "created_at": created_at,
+                "updated_at": updated_at,
+                "tags": tags.get(note_id, []),
+            }
+            yield note, key, versions
+        after_id = batch[-1][0]
+
+def export_upload_names(note: dict, versions: list, already_sent: set) -> List[str]:
+    """Anexos citados na nota ou em alguma versão dela que ainda não foram exportados"""
+    names = []
+    for text in [note["content"]] + [version["content"] or "" for version in versions]:
+        for filename in UPLOAD_REFERENCE_PATTERN.findall(text):
+            if filename not in already_sent and (uploads_dir / filename).is_file():
+                already_sent.add(filename)
+                names.append(filename)
+    return names
+
+def iter_upload_chunks(filename: str):
+    path = uploads_dir / filename
+    if not path.is_file():
+        return
+    with open(path, "rb") as upload:
+        while True:
+            chunk = upload.read(EXPORT_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
+
+def export_ndjson(user: dict, after_id: int, until_id: Optional[int], next_cursor: Optional[str]):
+    def line(record: dict) -> bytes:
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode()
+    
+    yield line({"type": "vault", "format_version": 1, "username": user["username"],
+                "exported_at": datetime.now(timezone.utc).isoformat(), "resumed": after_id > 0})
+    if after_id == 0:
+        for folder_id, folder in export_folder_paths(user["id"]).items():
+            yield line({"type": "folder", "id": folder_id, "name": folder["name"],
+                        "parent_id": folder["parent_id"], "path": folder["path"]})
+    
+    exported = 0
+    uploads_sent = set()
+    for note, _, versions in iter_export_notes(user["id"], after_id, until_id):
+        yield line(note)
+        for version in versions:
+            yield line(version)
+        for filename in export_upload_names(note, versions, uploads_sent):
+            yield line({"type": "upload", "filename": filename, "size": (uploads_dir / filename).stat().st_size})
+            offset = 0
+            for chunk in iter_upload_chunks(filename):
+                yield line({"type": "upload_chunk", "filename": filename, "offset": offset,
+                            "data": base64.b64encode(chunk).decode()})
+                offset += len(chunk)
+        exported += 1
+        yield line({"type": "cursor", "cursor": encode_list_cursor(note["id"])})
+    yield line({"type": "end", "notes": exported, "next_cursor": next_cursor})
+
+def export_zip(user: dict, after_id: int, until_id: Optional[int]):
+    buffer = ZipStreamBuffer()
+    archive = zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED)
+    
+    def entry(name: str, timestamp: Optional[str] = None, compress: bool = True):
+        try:
+            date_time = datetime.strptime(timestamp or "", "%Y-%m-%d %H:%M:%S").timetuple()[:6]
+        except ValueError:
+            date_time = datetime.now().timetuple()[:6]
+        info = zipfile.ZipInfo(name, date_time=date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        return archive.open(info, mode="w", force_zip64=True)
+    
+    folders = export_folder_paths(user["id"])
+    if after_id == 0:
+        with entry("folders.ndjson") as output:
+            for folder_id, folder in folders.items():
+                output.write((json.dumps({"id": folder_id, "name": folder["name"], "parent_id": folder["parent_id"],
+                                          "path": folder["path"]}, ensure_ascii=False) + "\n").encode())
+        yield buffer.drain()
+    
+    duplicates = export_duplicate_titles(user["id"])
+    uploads_sent = set()
+    for note, key, versions in iter_export_notes(user["id"], after_id, until_id):
+        folder_path = folders.get(note["folder_id"], {}).get("path", "")
+        filename = safe_export_name(note["title"])
+        if (note["folder_id"], key) in duplicates:
+            filename += f" ({note['id']})"
+        note_path = "/".join(part for part in ("notes", folder_path, filename + ".md") if part)
+        
+        with entry(note_path, note["updated_at"]) as output:
+            output.write(note["content"].encode())
+        with entry(f"meta/{note['id']}.json", note["updated_at"]) as output:
+            meta = {field: value for field, value in note.items() if field not in ("type", "content")}
+            output.write(json.dumps({**meta, "path": note_path}, ensure_ascii=False).encode())
+        yield buffer.drain()
+        if versions:
+            with entry(f"versions/{note['id']}.ndjson", note["updated_at"]) as output:
+                for version in versions:
+                    output.write((json.dumps(version, ensure_ascii=False) + "\n").encode())
+            yield buffer.drain()
+        
+        for upload in export_upload_names(note, versions, uploads_sent):
+            # Imagens já vêm comprimidas: só armazena
+            with entry(f"uploads/{upload}", compress=False) as output:
+                for chunk in iter_upload_chunks(upload):
+                    output.write(chunk)
+                    yield buffer.drain()
+            yield buffer.drain()
+    
+    archive.close()
+    yield buffer.drain()
+
+@app.get("/export")
+def export_vault(
+    format: str = Query("ndjson", description="ndjson ou zip"),
+    cursor: Optional[str] = Query(None, description="Retoma depois da nota deste cursor"),
+    limit: Optional[int] = Query(None, ge=1, description="Máximo de notas nesta resposta"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Exporta o vault do usuário (pastas, notas, tags, versões e anexos) como stream"""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported export format")
+    after_id = decode_list_cursor(cursor, 1)[0] if cursor else 0
+    if not isinstance(after_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    # Edições via WebSocket ainda no buffer entram na exportação
+    note_write_buffer.flush()
+    until_id, more = export_range(current_user["id"], after_id, limit)
+    next_cursor = encode_list_cursor(until_id) if more else None
+    
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    headers = {"Content-Disposition": f'attachment; filename="buresidian-{stamp}.{format}"'}
+    if next_cursor:
+        headers["X-Export-Next-Cursor"] = next_cursor
+    if format == "zip":
+        body = export_zip(current_user, after_id, until_id)
+    else:
+        body = export_ndjson(current_user, after_id, until_id, next_cursor)
+    return StreamingResponse(body, media_type=EXPORT_FORMATS[format], headers=headers)
+
+# =================== IMPORTAÇÃO DO VAULT ===================
+# POST /import recebe um zip de Markdown (pastas viram pastas, o nome do
+# arquivo vira o título) ou NDJSON (o formato do GET /export, ou linhas soltas
+# com title/content/folder). O arquivo é lido como stream numa tarefa em
+# segundo plano:
+#   1. lotes de IMPORT_BATCH_NOTES notas, cada lote um executemany numa transação
+#   2. com todas as notas no banco (títulos resolvíveis), uma passada só pelas
+#      notas importadas monta note_links e note_tags, também em lotes
+# Lotes já gravados ficam se a importação falhar no meio. Versões do NDJSON
+# são ignoradas (a nota entra com o conteúdo atual). GET /import/{id} mostra
+# o andamento.
+
+IMPORT_BATCH_NOTES = int(os.getenv("BURESIDIAN_IMPORT_BATCH", "500"))
+IMPORT_MAX_BYTES = int(os.getenv("BURESIDIAN_IMPORT_MAX_MB", "512")) * 1024 * 1024
+IMPORT_MAX_NOTE_BYTES = 10 * 1024 * 1024
+IMPORT_JOBS_KEPT = 50
+MARKDOWN_EXTENSIONS = (".md", ".markdown", ".txt")
+SAFE_UPLOAD_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+class VaultImport:
+    def __init__(self, job_id: str, user_id: int, path: str, format: str, size: int):
+        self.id = job_id
+        self.user_id = user_id
+        self.path = path
+        self.format = format
+        self.state = "queued"
+        self.error: Optional[str] = None
+        self.stats = {
+            "bytes_total": size,
+            "bytes_read": 0,
+            "notes_imported": 0,
+            "notes_indexed": 0,
+            "folders_created": 0,
+            "uploads_saved": 0,
+            "skipped": 0,
+        }
+        self.warnings: List[str] = []
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None  # o loop só guarda referência fraca à tarefa
+        self._records = None
+        self._folder_ids: Optional[dict] = None  # (id da pasta mãe, nome) -> id
+        self._safe_folder_ids: Optional[dict] = None  # (id da pasta mãe, safe_export_name(nome)) -> id
+        self._id_ranges: List[tuple] = []  # (primeiro, último) id de cada lote inserido
+        self._title_keys: set = set()
+
+    # ---------- leitura do arquivo ----------
+
+    def _warn(self, message: str):
+        self.stats["skipped"] += 1
+        if len(self.warnings) < 20:
+            self.warnings.append(message)
+
+    def _zip_records(self):
+        with zipfile.ZipFile(self.path) as archive:
+            names = set(archive.namelist())
+            # Zip gerado pelo GET /export: notas ficam em notes/
+            exported = "folders.ndjson" in names
+            for info in archive.infolist():
+                self.stats["bytes_read"] += info.compress_size
+                parts = info.filename.split("/")
+                if info.is_dir() or any(part.startswith(".") or part == "__MACOSX" for part in parts):
+                    continue
+                if exported and parts[0] == "uploads" and len(parts) == 2:
+                    with archive.open(info) as source:
+                        self._save_upload(parts[1], source)
+                    continue
+                if exported:
+                    if parts[0] != "notes":
+                        continue
+                    parts = parts[1:]
+                if not info.filename.lower().endswith(MARKDOWN_EXTENSIONS):
+                    continue
+                if info.file_size > IMPORT_MAX_NOTE_BYTES:
+                    self._warn(f"{info.filename}: larger than {IMPORT_MAX_NOTE_BYTES} bytes")
+                    continue
+                title = os.path.splitext(parts[-1])[0]
+                content = archive.read(info).decode("utf-8", errors="replace")
+                yield {"title": title, "content": content, "folder": "/".join(parts[:-1])}
+
+    def _ndjson_records(self):
+        exported_folders = {}  # id da pasta no arquivo -> registro
+        folders_pending = False  # pastas lidas e ainda não enviadas para criação
+        upload = None
+        
+        def folder_of(folder_id):
+            """Nomes reais da raiz até a pasta (id/parent_id/name do export) ou, sem eles, o path"""
+            names, seen = [], set()
+            while folder_id is not None and folder_id not in seen:
+                folder = exported_folders.get(folder_id)
+                if folder is None:
+                    break
+                if not isinstance(folder.get("name"), str) or "parent_id" not in folder:
+                    return str(folder.get("path") or "")
+                seen.add(folder_id)
+                names.append(folder["name"])
+                folder_id = folder["parent_id"]
+            return names[::-1]
+        
+        with open(self.path, "rb") as source:
+            for line_number, line in enumerate(source, start=1):
+                self.stats["bytes_read"] += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self._warn(f"line {line_number}: invalid JSON")
+                    continue
+                if not isinstance(record, dict):
+                    self._warn(f"line {line_number}: expected an object")
+                    continue
+                kind = record.get("type", "note")
+                if kind != "upload_chunk" and upload is not None:
+                    upload.close()
+                    upload = None
+                if kind != "folder" and folders_pending:
+                    # As pastas vêm antes das notas no export: a árvore já está completa
+                    folders_pending = False
+                    for folder_id in exported_folders:
+                        yield {"type": "folder", "folder": folder_of(folder_id)}
+                if kind == "folder":
+                    exported_folders[record.get("id")] = record
+                    folders_pending = True
+                elif kind == "note":
+                    folder = record.get("folder")
+                    if folder is None:
+                        folder = folder_of(record.get("folder_id"))
+                    yield {
+                        "title": str(record.get("title") or "Sem título"),
+                        "content": str(record.get("content") or ""),
+                        "folder": folder,
+                        "created_at": record.get("created_at"),
+                        "updated_at": record.get("updated_at"),
+                    }
+                elif kind == "upload":
+                    upload = self._open_upload(str(record.get("filename", "")))
+                elif kind == "upload_chunk" and upload is not None:
+                    upload.write(base64.b64decode(record.get("data", "")))
+        if upload is not None:
+            upload.close()
+        if folders_pending:
+            for folder_id in exported_folders:
+                yield {"type": "folder", "folder": folder_of(folder_id)}
+
+    def _open_upload(self, filename: str):
+        """Arquivo novo em uploads/ (nunca sobrescreve um existente); None se o nome não serve"""
+        if not SAFE_UPLOAD_NAME.match(filename) or (uploads_dir / filename).exists():
+            return None
+        self.stats["uploads_saved"] += 1
+        return open(uploads_dir / filename, "wb")
+
+    def _save_upload(self, filename: str, source):
+        target = self._open_upload(filename)
+        if target is not None:
+            with target:
+                shutil.copyfileobj(source, target, EXPORT_CHUNK_BYTES)
+
+    # ---------- gravação ----------
+
+    def _folder_id(self, cursor, folder) -> Optional[int]:
+        """Id da pasta, criando as que faltarem.
+
+        `folder` é a lista de nomes reais (pastas do NDJSON exportado), comparados
+        como estão, ou um caminho a/b/c (zip, linhas soltas), comparado pelos nomes
+        normalizados com safe_export_name como nos caminhos do export: reimportar
+        um vault não duplica pastas com nomes saneados.
+        """
+        if self._folder_ids is None:
+            self._folder_ids, self._safe_folder_ids = {}, {}
+            for folder_id, existing in export_folder_paths(self.user_id).items():
+                self._folder_ids.setdefault((existing["parent_id"], existing["name"]), folder_id)
+                self._safe_folder_ids.setdefault((existing["parent_id"], safe_export_name(existing["name"])),
+                                                 folder_id)
+        if isinstance(folder, str):
+            names = [part.strip() for part in folder.split("/") if part.strip()]
+            index, normalize = self._safe_folder_ids, safe_export_name
+        else:
+            names = [str(name) for name in folder]
+            index, normalize = self._folder_ids, str
+        folder_id = None
+        for name in names:
+            key = (folder_id, normalize(name))
+            if key not in index:
+                cursor.execute("INSERT INTO folders (name, parent_id, user_id) VALUES (?, ?, ?)",
+                               (name, folder_id, self.user_id))
+                self._folder_ids.setdefault((folder_id, name), cursor.lastrowid)
+                self._safe_folder_ids.setdefault((folder_id, safe_export_name(name)), cursor.lastrowid)
+                self.stats["folders_created"] += 1
+            folder_id = index[key]
+        return folder_id
+
+    def import_batch(self) -> bool:
+        """Lê e insere o próximo lote de notas; False quando o arquivo acabou"""
+        if self._records is None:
+            self._records = self._zip_records() if self.format == "zip" else self._ndjson_records()
+        batch = []
+        for record in self._records:
+            batch.append(record)
+            if len(batch) >= IMPORT_BATCH_NOTES:
+                break
+        if not batch:
+            return False
+        
+        with db_write() as conn:
+            cursor = conn.cursor()
+            rows = []
+            for record in batch:
+                if record.get("type") == "folder":
+                    self._folder_id(cursor, record["folder"])  # pastas do export, mesmo vazias
+                    continue
+                title = record["title"].strip() or "Sem título"
+                self._title_keys.add(title_key(title))
+                rows.append((title, record["content"], self._folder_id(cursor, record["folder"]), self.user_id,
+                             title_key(title), record.get("created_at"), record.get("updated_at")))
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM notes")
+            before = cursor.fetchone()[0]
+            cursor.executemany("""
+                INSERT INTO notes (title, content, folder_id, user_id, title_key, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))
+            """, rows)
+            # Escritor único (BEGIN IMMEDIATE): os ids do lote são os que vieram depois de `before`
+            if rows:
+                cursor.execute("SELECT MIN(id), MAX(id) FROM notes WHERE id > ? AND user_id = ?",
+                               (before, self.user_id))
+                self._id_ranges.append(cursor.fetchone())
+        self.stats["notes_imported"] += len(rows)
+        return True
+
+    def index_batch(self, range_index: int) -> None:
+        """Monta links e tags das notas de um lote importado (lidas de volta do banco)"""
+        first_id, last_id = self._id_ranges[range_index]
+        with db_write() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, content FROM notes WHERE user_id = ? AND id BETWEEN ? AND ?",
+                           (self.user_id, first_id, last_id))
+            notes = cursor.fetchall()
+            link_rows, tag_rows, keys = [], [], set()
+            for note_id, content in notes:
+                for link in extract_wiki_links(content):
+                    keys.add(link["target_key"])
+                    link_rows.append((note_id, link))
+                for tag, (occurrences, position) in extract_tags(content).items():
+                    for depth, path in enumerate(tag_paths(tag), start=1):
+                        tag_rows.append((note_id, self.user_id, tag, path, depth, occurrences, position))
+            resolved = resolve_title_keys(cursor, self.user_id, keys)
+            cursor.executemany("""
+                INSERT INTO note_links
+                (user_id, source_note_id, target_title, target_key, target_note_id, display_text, position, length)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (self.user_id, note_id, link["target_title"], link["target_key"], resolved.get(link["target_key"]),
+                 link["display_text"], link["position"], link["length"])
+                for note_id, link in link_rows
+            ])
+            cursor.executemany("""
+                INSERT INTO note_tags (note_id, user_id, tag, path, depth, occurrences, position)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, tag_rows)
+        self.stats["notes_indexed"] += len(notes)
+
+    def finish(self):
+        """Links já existentes que apontavam para títulos importados passam a resolver"""
+        user_id = self.user_id
+        with db_write() as conn:
+            refresh_link_targets(conn.cursor(), user_id, self._title_keys)
+            db_pool.after_commit(lambda: graph_cache.forget_user(user_id))
+            db_pool.after_commit(lambda: view_cache.invalidate_user(user_id))
+            db_pool.after_commit(lambda: change_counters.bump(("user", user_id)))
+
+    async def run(self):
+        self.state = "running"
+        self.started_at = time.monotonic()
+        try:
+            while await run_db(self.import_batch):
+                await asyncio.sleep(0)  # deixa outras escritas entrarem entre os lotes
+            self.state = "indexing"
+            for range_index in range(len(self._id_ranges)):
+                await run_db(self.index_batch, range_index)
+                await asyncio.sleep(0)
+            await run_db(self.finish)
+            self.state = "done"
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"Erro na importação {self.id}: {e}")
+        finally:
+            self.finished_at = time.monotonic()
+            self.task = None
+            self._records = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def status(self) -> dict:
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0
+        return {
+            "import_id": self.id,
+            "state": self.state,
+            "format": self.format,
+            "error": self.error,
+            **self.stats,
+            "elapsed_seconds": round(elapsed, 3),
+            "notes_per_second": round(self.stats["notes_imported"] / elapsed, 1) if elapsed else None,
+            "warnings": self.warnings,
+        }
+
+import_jobs: OrderedDict = OrderedDict()  # import_id -> VaultImport (só as mais recentes)
+
+@app.post("/import", status_code=202)
+async def import_vault(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, description="zip ou ndjson (padrão: pela extensão do arquivo)"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Importa um vault (zip de Markdown ou NDJSON) em segundo plano"""
+    import_format = format or ("zip" if (file.filename or "").lower().endswith(".zip") else "ndjson")
+    if import_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported import format")
+    if any(job.user_id == current_user["id"] and job.state in ("queued", "running", "indexing")
+           for job in import_jobs.values()):
+        raise HTTPException(status_code=409, detail="An import is already running")
+    
+    # Copia o upload para um arquivo próprio: a tarefa continua depois da resposta
+    handle, path = tempfile.mkstemp(prefix="buresidian-import-", suffix=f".{import_format}")
+    os.close(handle)
+    size = 0
+    async with aiofiles.open(path, "wb") as target:
+        while size <= IMPORT_MAX_BYTES and (chunk := await file.read(1024 * 1024)):
+            size += len(chunk)
+            await target.write(chunk)
+    if size > IMPORT_MAX_BYTES:
+        os.unlink(path)
+        raise HTTPException(status_code=413, detail="Import file too large")
+    if import_format == "zip" and not zipfile.is_zipfile(path):
+        os.unlink(path)
+        raise HTTPException(status_code=400, detail="Invalid zip file")
+    
+    job = VaultImport(uuid.uuid4().hex, current_user["id"], path, import_format, size)
+    import_jobs[job.id] = job
+    # Só descarta importações terminadas: as em andamento seguem com a tarefa e o status
+    finished = [job_id for job_id, kept in import_jobs.items() if kept.finished_at is not None]
+    for job_id in finished[:max(0, len(import_jobs) - IMPORT_JOBS_KEPT)]:
+        del import_jobs[job_id]
+    job.task = asyncio.create_task(job.run())
+    return {"import_id": job.id, "status_url": f"/import/{job.id}"}
+
+@app.get("/import/{import_id}")
+def get_import_status(import_id: str, current_user: dict = Depends(get_current_user)):
+    """Andamento de uma importação"""
+    job = import_jobs.get(import_id)
+    if job is None or job.user_id != current_user["id"]:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return job.status()
+
 # =================== CANVAS ENDPOINTS ===================
 
 # 1) Boards REST
 @app.get("/canvas/boards")
-async def get_canvas_boards(current_user: dict = Depends(get_current_user)):
+def get_canvas_boards(current_user: dict = Depends(get_current_user)):
     """Listar boards do usuário"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_read() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute("""
-        SELECT id, name, owner_id, created_at, updated_at
-        FROM canvas_boards 
-        WHERE owner_id = ? OR owner_id IS NULL
-        ORDER BY updated_at DESC
-    """, (current_user["id"],))
-    
-    boards = []
-    for row in cursor.fetchall():
-        boards.append({
-            "id": row[0],
-            "name": row[1],
-            "owner_id": row[2],
-            "created_at": row[3],
-            "updated_at": row[4]
-        })
+        cursor.execute("""
+            SELECT id, name, owner_id, created_at, updated_at
+            FROM canvas_boards 
+            WHERE owner_id = ? OR owner_id IS NULL
+            ORDER BY updated_at DESC
+        """, (current_user["id"],))
+    
+        boards = []
+        for row in cursor.fetchall():
+            boards.append({
+                "id": row[0],
+                "name": row[1],
+                "owner_id": row[2],
+                "created_at": row[3],
+                "updated_at": row[4]
+            })
     
-    conn.close()
     return boards
 
 @app.post("/canvas/boards")
-async def create_canvas_board(board: CanvasBoardCreate, current_user: dict = Depends(get_current_user)):
+def create_canvas_board(board: CanvasBoardCreate, current_user: dict = Depends(get_current_user)):
     """Criar novo board"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_write() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute("""
-        INSERT INTO canvas_boards (name, owner_id)
-        VALUES (?, ?)
-    """, (board.name, current_user["id"]))
+        cursor.execute("""
+            INSERT INTO canvas_boards (name, owner_id)
+            VALUES (?, ?)
+        """, (board.name, current_user["id"]))
     
-    board_id = cursor.lastrowid
-    conn.commit()
+        board_id = cursor.lastrowid
     
-    # Retornar o board criado
-    cursor.execute("""
-        SELECT id, name, owner_id, created_at, updated_at
-        FROM canvas_boards WHERE id = ?
-    """, (board_id,))
+        # Retornar o board criado
+        cursor.execute("""
+            SELECT id, name, owner_id, created_at, updated_at
+            FROM canvas_boards WHERE id = ?
+        """, (board_id,))
     
-    row = cursor.fetchone()
-    conn.close()
+        row = cursor.fetchone()
     
     return {
         "id": row[0],
@@ -1455,40 +4656,35 @@ async def create_canvas_board(board: CanvasBoardCreate, current_user: dict = Dep
     }
 
 @app.put("/canvas/boards/{board_id}")
-async def update_canvas_board(board_id: int, board: CanvasBoardUpdate, current_user: dict = Depends(get_current_user)):
+def update_canvas_board(board_id: int, board: CanvasBoardUpdate, current_user: dict = Depends(get_current_user)):
     """Renomear board"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar se o usuário é owner
-    cursor.execute("SELECT owner_id FROM canvas_boards WHERE id = ?", (board_id,))
-    result = cursor.fetchone()
+    with db_write() as conn:
+        cursor = conn.cursor()
     
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Board not found")
+        # Verificar se o usuário é owner
+        cursor.execute("SELECT owner_id FROM canvas_boards WHERE id = ?", (board_id,))
+        result = cursor.fetchone()
     
-    if result[0] != current_user["id"]:
-        conn.close()
-        raise HTTPException(status_code=403, detail="Not authorized")
+        if not result:
+            raise HTTPException(status_code=404, detail="Board not found")
     
-    # Atualizar
-    cursor.execute("""
-        UPDATE canvas_boards 
-        SET name = ?, updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-    """, (board.name, board_id))
+        if result[0] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="Not authorized")
     
-    conn.commit()
+        # Atualizar
+        cursor.execute("""
+            UPDATE canvas_boards 
+            SET name = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (board.name, board_id))
     
-    # Retornar board atualizado
-    cursor.execute("""
-        SELECT id, name, owner_id, created_at, updated_at
-        FROM canvas_boards WHERE id = ?
-    """, (board_id,))
+        # Retornar board atualizado
+        cursor.execute("""
+            SELECT id, name, owner_id, created_at, updated_at
+            FROM canvas_boards WHERE id = ?
+        """, (board_id,))
     
-    row = cursor.fetchone()
-    conn.close()
+        row = cursor.fetchone()
     
     return {
         "id": row[0],
@@ -1499,302 +4695,290 @@ async def update_canvas_board(board_id: int, board: CanvasBoardUpdate, current_u
     }
 
 @app.delete("/canvas/boards/{board_id}")
-async def delete_canvas_board(board_id: int, current_user: dict = Depends(get_current_user)):
+def delete_canvas_board(board_id: int, current_user: dict = Depends(get_current_user)):
     """Deletar board"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_write() as conn:
+        cursor = conn.cursor()
     
-    # Verificar se o usuário é owner
-    cursor.execute("SELECT owner_id FROM canvas_boards WHERE id = ?", (board_id,))
-    result = cursor.fetchone()
+        # Verificar se o usuário é owner
+        cursor.execute("SELECT owner_id FROM canvas_boards WHERE id = ?", (board_id,))
+        result = cursor.fetchone()
     
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Board not found")
+        if not result:
+            raise HTTPException(status_code=404, detail="Board not found")
     
-    if result[0] != current_user["id"]:
-        conn.close()
-        raise HTTPException(status_code=403, detail="Not authorized")
+        if result[0] != current_user["id"]:
+            raise HTTPException(status_code=403, detail="Not authorized")
     
-    # Deletar (CASCADE remove nós e arestas)
-    cursor.execute("DELETE FROM canvas_boards WHERE id = ?", (board_id,))
-    conn.commit()
-    conn.close()
+        # Deletar (CASCADE remove nós e arestas)
+        cursor.execute("DELETE FROM canvas_boards WHERE id = ?", (board_id,))
+        board_changed(board_id)
     
     return {"message": "Board deleted successfully"}
 
 # 2) Board state (nós + arestas)
 @app.get("/canvas/boards/{board_id}/state")
-async def get_canvas_board_state(board_id: int, current_user: dict = Depends(get_current_user)):
+def get_canvas_board_state(board_id: int, request: Request, response: Response,
+                           current_user: dict = Depends(get_current_user)):
     """Obter estado completo do board (nós + arestas)"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_read() as conn:
+        cursor = conn.cursor()
     
-    # Verificar acesso ao board
-    cursor.execute("""
-        SELECT id FROM canvas_boards 
-        WHERE id = ? AND (owner_id = ? OR owner_id IS NULL)
-    """, (board_id, current_user["id"]))
+        # Verificar acesso ao board
+        cursor.execute("""
+            SELECT id FROM canvas_boards 
+            WHERE id = ? AND (owner_id = ? OR owner_id IS NULL)
+        """, (board_id, current_user["id"]))
     
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Board not found or not authorized")
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Board not found or not authorized")
+        
+        not_modified = conditional_get(request, response, change_counters.etag(("board", board_id)))
+        if not_modified:
+            return not_modified
     
-    # Buscar nós
-    cursor.execute("""
-        SELECT id, type, ref_note_id, text, url, x, y, width, height, color, z_index
-        FROM canvas_nodes WHERE board_id = ?
-        ORDER BY z_index, id
-    """, (board_id,))
+        # Buscar nós
+        cursor.execute("""
+            SELECT id, type, ref_note_id, text, url, x, y, width, height, color, z_index
+            FROM canvas_nodes WHERE board_id = ?
+            ORDER BY z_index, id
+        """, (board_id,))
     
-    nodes = []
-    for row in cursor.fetchall():
-        nodes.append({
-            "id": row[0],
-            "type": row[1],
-            "ref_note_id": row[2],
-            "text": row[3],
-            "url": row[4],
-            "x": row[5],
-            "y": row[6],
-            "width": row[7],
-            "height": row[8],
-            "color": row[9],
-            "z_index": row[10]
-        })
+        nodes = []
+        for row in cursor.fetchall():
+            nodes.append({
+                "id": row[0],
+                "type": row[1],
+                "ref_note_id": row[2],
+                "text": row[3],
+                "url": row[4],
+                "x": row[5],
+                "y": row[6],
+                "width": row[7],
+                "height": row[8],
+                "color": row[9],
+                "z_index": row[10]
+            })
     
-    # Buscar arestas
-    cursor.execute("""
-        SELECT id, source_node_id, target_node_id, label, style
-        FROM canvas_edges WHERE board_id = ?
-    """, (board_id,))
+        # Buscar arestas
+        cursor.execute("""
+            SELECT id, source_node_id, target_node_id, label, style
+            FROM canvas_edges WHERE board_id = ?
+        """, (board_id,))
     
-    edges = []
-    for row in cursor.fetchall():
-        edges.append({
-            "id": row[0],
-            "source_node_id": row[1],
-            "target_node_id": row[2],
-            "label": row[3],
-            "style": row[4]
-        })
+        edges = []
+        for row in cursor.fetchall():
+            edges.append({
+                "id": row[0],
+                "source_node_id": row[1],
+                "target_node_id": row[2],
+                "label": row[3],
+                "style": row[4]
+            })
     
-    conn.close()
     return {"nodes": nodes, "edges": edges}
 
 @app.put("/canvas/boards/{board_id}/state")
-async def update_canvas_board_state(board_id: int, state: CanvasBoardState, current_user: dict = Depends(get_current_user)):
+def update_canvas_board_state(board_id: int, state: CanvasBoardState, current_user: dict = Depends(get_current_user)):
     """Salvar estado completo do board (substitui tudo)"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar acesso ao board
-    cursor.execute("""
-        SELECT id FROM canvas_boards 
-        WHERE id = ? AND (owner_id = ? OR owner_id IS NULL)
-    """, (board_id, current_user["id"]))
-    
-    if not cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Board not found or not authorized")
-    
-    try:
-        # Limpar estado atual
-        cursor.execute("DELETE FROM canvas_edges WHERE board_id = ?", (board_id,))
-        cursor.execute("DELETE FROM canvas_nodes WHERE board_id = ?", (board_id,))
-        
-        # Inserir nós
-        for node in state.nodes:
-            cursor.execute("""
-                INSERT INTO canvas_nodes 
-                (id, board_id, type, ref_note_id, text, url, x, y, width, height, color, z_index)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                node.get("id"), board_id, node["type"], node.get("ref_note_id"),
-                node.get("text"), node.get("url"), node["x"], node["y"],
-                node.get("width"), node.get("height"), node.get("color"), 
-                node.get("z_index", 0)
-            ))
-        
-        # Inserir arestas
-        for edge in state.edges:
-            cursor.execute("""
-                INSERT INTO canvas_edges 
-                (id, board_id, source_node_id, target_node_id, label, style)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                edge.get("id"), board_id, edge["source_node_id"], 
-                edge["target_node_id"], edge.get("label"), edge.get("style")
-            ))
+    with db_write() as conn:
+        cursor = conn.cursor()
         
-        # Atualizar timestamp do board
+        # Verificar acesso ao board
         cursor.execute("""
-            UPDATE canvas_boards SET updated_at = CURRENT_TIMESTAMP WHERE id = ?
-        """, (board_id,))
+            SELECT id FROM canvas_boards 
+            WHERE id = ? AND (owner_id = ? OR owner_id IS NULL)
+        """, (board_id, current_user["id"]))
         
-        conn.commit()
-        conn.close()
+        if not cursor.fetchone():
+            raise HTTPException(status_code=404, detail="Board not found or not authorized")
         
-        return {"message": "Board state updated successfully"}
-        
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        raise HTTPException(status_code=400, detail=f"Error updating board state: {str(e)}")
+        try:
+            # Comparar com o estado salvo e gravar só as diferenças
+            cursor.execute("""
+                SELECT id, board_id, type, ref_note_id, text, url, x, y, width, height, color, z_index
+                FROM canvas_nodes WHERE board_id = ?
+            """, (board_id,))
+            saved_nodes = {row[0]: row for row in cursor.fetchall()}
+            cursor.execute("""
+                SELECT id, board_id, source_node_id, target_node_id, label, style
+                FROM canvas_edges WHERE board_id = ?
+            """, (board_id,))
+            saved_edges = {row[0]: row for row in cursor.fetchall()}
+            
+            node_rows = {row[0]: row for row in (canvas_node_row(board_id, node) for node in state.nodes)}
+            edge_rows = {row[0]: row for row in (canvas_edge_row(board_id, edge) for edge in state.edges)}
+            
+            write_canvas_changes(
+                cursor, board_id,
+                [row for node_id, row in node_rows.items() if saved_nodes.get(node_id) != row],
+                [node_id for node_id in saved_nodes if node_id not in node_rows],
+                [row for edge_id, row in edge_rows.items() if saved_edges.get(edge_id) != row],
+                [edge_id for edge_id in saved_edges if edge_id not in edge_rows]
+            )
+            
+            # Atualizar timestamp do board
+            cursor.execute("""
+                UPDATE canvas_boards SET updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            """, (board_id,))
+            canvas_state_written(board_id)
+            
+        except Exception as e:
+            # O rollback é feito pelo db_write ao propagar a exceção
+            raise HTTPException(status_code=400, detail=f"Error updating board state: {str(e)}")
+    
+    return {"message": "Board state updated successfully"}
 
 # =================== CANVAS WEBSOCKET ===================
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar permissão
-    cursor.execute("""
-        SELECT b.*, u.username as owner
-        FROM canvas_boards b
-        LEFT JOIN users u ON b.user_id = u.id
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id
-        WHERE b.id = ? AND (b.user_id = ? OR c.user_id = ?)
-    """, (board_id, current_user["id"], current_user["id"]))
-    
-    board_data = cursor.fetchone()
-    if not board_data:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Canvas board not found")
-    
-    # Buscar nós
-    cursor.execute("""
-        SELECT id, type, position_x, position_y, width, height, data, style, z_index
-        FROM canvas_nodes WHERE board_id = ?
-        ORDER BY z_index, created_at
-    """, (board_id,))
+    with db_read() as conn:
+        cursor = conn.cursor()
     
-    nodes = []
-    for row in cursor.fetchall():
-        nodes.append({
-            "id": row[0],
-            "type": row[1],
-            "position": {"x": row[2], "y": row[3]},
-            "data": json.loads(row[6]),
-            "style": json.loads(row[7]) if row[7] else {},
-            "width": row[4],
-            "height": row[5],
-            "zIndex": row[8]
-        })
+        # Verificar permissão
+        cursor.execute("""
+            SELECT b.*, u.username as owner
+            FROM canvas_boards b
+            LEFT JOIN users u ON b.user_id = u.id
+            LEFT JOIN canvas_collaborators c ON b.id = c.board_id
+            WHERE b.id = ? AND (b.user_id = ? OR c.user_id = ?)
+        """, (board_id, current_user["id"], current_user["id"]))
+    
+        board_data = cursor.fetchone()
+        if not board_data:
+            raise HTTPException(status_code=404, detail="Canvas board not found")
+    
+        # Buscar nós
+        cursor.execute("""
+            SELECT id, type, position_x, position_y, width, height, data, style, z_index
+            FROM canvas_nodes WHERE board_id = ?
+            ORDER BY z_index, created_at
+        """, (board_id,))
     
-    # Buscar arestas
-    cursor.execute("""
-        SELECT id, source_node_id, target_node_id, source_handle, target_handle, label, style, animated
-        FROM canvas_edges WHERE board_id = ?
-    """, (board_id,))
+        nodes = []
+        for row in cursor.fetchall():
+            nodes.append({
+                "id": row[0],
+                "type": row[1],
+                "position": {"x": row[2], "y": row[3]},
+                "data": json.loads(row[6]),
+                "style": json.loads(row[7]) if row[7] else {},
+                "width": row[4],
+                "height": row[5],
+                "zIndex": row[8]
+            })
     
-    edges = []
-    for row in cursor.fetchall():
-        edges.append({
-            "id": row[0],
-            "source": row[1],
-            "target": row[2],
-            "sourceHandle": row[3],
-            "targetHandle": row[4],
-            "label": row[5],
-            "style": json.loads(row[6]) if row[6] else {},
-            "animated": bool(row[7])
-        })
+        # Buscar arestas
+        cursor.execute("""
+            SELECT id, source_node_id, target_node_id, source_handle, target_handle, label, style, animated
+            FROM canvas_edges WHERE board_id = ?
+        """, (board_id,))
     
-    board = {
-        "id": board_data[0],
-        "name": board_data[1],
-        "description": board_data[2],
-        "owner": board_data[9],
-        "viewport": {
-            "x": board_data[4],
-            "y": board_data[5],
-            "zoom": board_data[6]
-        },
-        "nodes": nodes,
-        "edges": edges,
-        "created_at": board_data[7],
-        "updated_at": board_data[8]
-    }
+        edges = []
+        for row in cursor.fetchall():
+            edges.append({
+                "id": row[0],
+                "source": row[1],
+                "target": row[2],
+                "sourceHandle": row[3],
+                "targetHandle": row[4],
+                "label": row[5],
+                "style": json.loads(row[6]) if row[6] else {},
+                "animated": bool(row[7])
+            })
+    
+        board = {
+            "id": board_data[0],
+            "name": board_data[1],
+            "description": board_data[2],
+            "owner": board_data[9],
+            "viewport": {
+                "x": board_data[4],
+                "y": board_data[5],
+                "zoom": board_data[6]
+            },
+            "nodes": nodes,
+            "edges": edges,
+            "created_at": board_data[7],
+            "updated_at": board_data[8]
+        }
     
-    conn.close()
     return board
 
 @app.put("/canvas/boards/{board_id}")
-async def update_canvas_board(board_id: int, board: CanvasBoardUpdate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Verificar se é o dono ou tem permissão de edição
-    cursor.execute("""
-        SELECT b.user_id, c.permission
-        FROM canvas_boards b
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
-        WHERE b.id = ?
-    """, (current_user["id"], board_id))
-    
-    result = cursor.fetchone()
-    if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
-        conn.close()
-        raise HTTPException(status_code=403, detail="No permission to edit this board")
-    
-    # Construir query de update dinamicamente
-    updates = []
-    params = []
-    
-    if board.name is not None:
-        updates.append("name = ?")
-        params.append(board.name)
-    if board.description is not None:
-        updates.append("description = ?")
-        params.append(board.description)
-    if board.viewport_x is not None:
-        updates.append("viewport_x = ?")
-        params.append(board.viewport_x)
-    if board.viewport_y is not None:
-        updates.append("viewport_y = ?")
-        params.append(board.viewport_y)
-    if board.viewport_zoom is not None:
-        updates.append("viewport_zoom = ?")
-        params.append(board.viewport_zoom)
+def update_canvas_board(board_id: int, board: CanvasBoardUpdate, current_user: dict = Depends(get_current_user)):
+    with db_write() as conn:
+        cursor = conn.cursor()
     
-    if updates:
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        params.append(board_id)
-        
-        query = f"UPDATE canvas_boards SET {', '.join(updates)} WHERE id = ?"
-        cursor.execute(query, params)
-        conn.commit()
+        # Verificar se é o dono ou tem permissão de edição
+        cursor.execute("""
+            SELECT b.user_id, c.permission
+            FROM canvas_boards b
+            LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
+            WHERE b.id = ?
+        """, (current_user["id"], board_id))
+    
+        result = cursor.fetchone()
+        if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
+            raise HTTPException(status_code=403, detail="No permission to edit this board")
+    
+        # Construir query de update dinamicamente
+        updates = []
+        params = []
+    
+        if board.name is not None:
+            updates.append("name = ?")
+            params.append(board.name)
+        if board.description is not None:
+            updates.append("description = ?")
+            params.append(board.description)
+        if board.viewport_x is not None:
+            updates.append("viewport_x = ?")
+            params.append(board.viewport_x)
+        if board.viewport_y is not None:
+            updates.append("viewport_y = ?")
+            params.append(board.viewport_y)
+        if board.viewport_zoom is not None:
+            updates.append("viewport_zoom = ?")
+            params.append(board.viewport_zoom)
+    
+        if updates:
+            updates.append("updated_at = CURRENT_TIMESTAMP")
+            params.append(board_id)
+        
+            query = f"UPDATE canvas_boards SET {', '.join(updates)} WHERE id = ?"
+            cursor.execute(query, params)
     
-    conn.close()
     return {"message": "Canvas board updated successfully"}
 
 # Canvas Nodes
 @app.post("/canvas/boards/{board_id}/nodes")
 async def create_canvas_node(board_id: int, node: CanvasNodeCreate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def insert_node():
+        with db_write() as conn:
+            cursor = conn.cursor()
     
-    # Verificar permissão
-    cursor.execute("""
-        SELECT b.user_id, c.permission
-        FROM canvas_boards b
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
-        WHERE b.id = ?
-    """, (current_user["id"], board_id))
+            # Verificar permissão
+            cursor.execute("""
+                SELECT b.user_id, c.permission
+                FROM canvas_boards b
+                LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
+                WHERE b.id = ?
+            """, (current_user["id"], board_id))
     
-    result = cursor.fetchone()
-    if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
-        conn.close()
-        raise HTTPException(status_code=403, detail="No permission to edit this board")
+            result = cursor.fetchone()
+            if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
+                raise HTTPException(status_code=403, detail="No permission to edit this board")
     
-    cursor.execute("""
-        INSERT INTO canvas_nodes (id, board_id, type, position_x, position_y, width, height, data, style, z_index)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        node.id, board_id, node.type, node.position_x, node.position_y,
-        node.width, node.height, json.dumps(node.data), json.dumps(node.style), node.z_index
-    ))
+            cursor.execute("""
+                INSERT INTO canvas_nodes (id, board_id, type, position_x, position_y, width, height, data, style, z_index)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                node.id, board_id, node.type, node.position_x, node.position_y,
+                node.width, node.height, json.dumps(node.data), json.dumps(node.style), node.z_index
+            ))
+            board_changed(board_id)
+            canvas_state_written(board_id)
     
-    conn.commit()
+    await run_db(insert_node)
     
     # Notificar via WebSocket
     await manager.broadcast_to_board(board_id, {
@@ -1813,61 +4997,65 @@ async def create_canvas_node(board_id: int, node: CanvasNodeCreate, current_user
         "user": current_user["username"]
     })
     
-    conn.close()
     return {"message": "Canvas node created successfully"}
 
 @app.put("/canvas/boards/{board_id}/nodes/{node_id}")
 async def update_canvas_node(board_id: int, node_id: str, node: CanvasNodeUpdate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def apply_updates():
+        with db_write() as conn:
+            cursor = conn.cursor()
     
-    # Verificar permissão
-    cursor.execute("""
-        SELECT b.user_id, c.permission
-        FROM canvas_boards b
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
-        WHERE b.id = ?
-    """, (current_user["id"], board_id))
-    
-    result = cursor.fetchone()
-    if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
-        conn.close()
-        raise HTTPException(status_code=403, detail="No permission to edit this board")
-    
-    # Construir query de update
-    updates = []
-    params = []
-    
-    if node.position_x is not None:
-        updates.append("position_x = ?")
-        params.append(node.position_x)
-    if node.position_y is not None:
-        updates.append("position_y = ?")
-        params.append(node.position_y)
-    if node.width is not None:
-        updates.append("width = ?")
-        params.append(node.width)
-    if node.height is not None:
-        updates.append("height = ?")
-        params.append(node.height)
-    if node.data is not None:
-        updates.append("data = ?")
-        params.append(json.dumps(node.data))
-    if node.style is not None:
-        updates.append("style = ?")
-        params.append(json.dumps(node.style))
-    if node.z_index is not None:
-        updates.append("z_index = ?")
-        params.append(node.z_index)
+            # Verificar permissão
+            cursor.execute("""
+                SELECT b.user_id, c.permission
+                FROM canvas_boards b
+                LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
+                WHERE b.id = ?
+            """, (current_user["id"], board_id))
+    
+            result = cursor.fetchone()
+            if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
+                raise HTTPException(status_code=403, detail="No permission to edit this board")
+    
+            # Construir query de update
+            updates = []
+            params = []
+    
+            if node.position_x is not None:
+                updates.append("position_x = ?")
+                params.append(node.position_x)
+            if node.position_y is not None:
+                updates.append("position_y = ?")
+                params.append(node.position_y)
+            if node.width is not None:
+                updates.append("width = ?")
+                params.append(node.width)
+            if node.height is not None:
+                updates.append("height = ?")
+                params.append(node.height)
+            if node.data is not None:
+                updates.append("data = ?")
+                params.append(json.dumps(node.data))
+            if node.style is not None:
+                updates.append("style = ?")
+                params.append(json.dumps(node.style))
+            if node.z_index is not None:
+                updates.append("z_index = ?")
+                params.append(node.z_index)
+    
+            if updates:
+                updates.append("updated_at = CURRENT_TIMESTAMP")
+                params.extend([board_id, node_id])
+        
+                query = f"UPDATE canvas_nodes SET {', '.join(updates)} WHERE board_id = ? AND id = ?"
+                cursor.execute(query, params)
+                board_changed(board_id)
+                canvas_state_written(board_id)
+            return updates
+    
+    updates = await run_db(apply_updates)
     
     if updates:
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        params.extend([board_id, node_id])
-        
-        query = f"UPDATE canvas_nodes SET {', '.join(updates)} WHERE board_id = ? AND id = ?"
-        cursor.execute(query, params)
-        conn.commit()
-        
         # Notificar via WebSocket
         await manager.broadcast_to_board(board_id, {
             "type": "node_updated",
@@ -1885,29 +5073,31 @@ async def update_canvas_node(board_id: int, node_id: str, node: CanvasNodeUpdate
             "user": current_user["username"]
         })
     
-    conn.close()
     return {"message": "Canvas node updated successfully"}
 
 @app.delete("/canvas/boards/{board_id}/nodes/{node_id}")
 async def delete_canvas_node(board_id: int, node_id: str, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def remove_node():
+        with db_write() as conn:
+            cursor = conn.cursor()
     
-    # Verificar permissão
-    cursor.execute("""
-        SELECT b.user_id, c.permission
-        FROM canvas_boards b
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
-        WHERE b.id = ?
-    """, (current_user["id"], board_id))
+            # Verificar permissão
+            cursor.execute("""
+                SELECT b.user_id, c.permission
+                FROM canvas_boards b
+                LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
+                WHERE b.id = ?
+            """, (current_user["id"], board_id))
+    
+            result = cursor.fetchone()
+            if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
+                raise HTTPException(status_code=403, detail="No permission to edit this board")
     
-    result = cursor.fetchone()
-    if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
-        conn.close()
-        raise HTTPException(status_code=403, detail="No permission to edit this board")
+            cursor.execute("DELETE FROM canvas_nodes WHERE board_id = ? AND id = ?", (board_id, node_id))
+            board_changed(board_id)
+            canvas_state_written(board_id)
     
-    cursor.execute("DELETE FROM canvas_nodes WHERE board_id = ? AND id = ?", (board_id, node_id))
-    conn.commit()
+    await run_db(remove_node)
     
     # Notificar via WebSocket
     await manager.broadcast_to_board(board_id, {
@@ -1917,37 +5107,38 @@ async def delete_canvas_node(board_id: int, node_id: str, current_user: dict = D
         "user": current_user["username"]
     })
     
-    conn.close()
     return {"message": "Canvas node deleted successfully"}
 
 # Canvas Edges
 @app.post("/canvas/boards/{board_id}/edges")
 async def create_canvas_edge(board_id: int, edge: CanvasEdgeCreate, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def insert_edge():
+        with db_write() as conn:
+            cursor = conn.cursor()
     
-    # Verificar permissão
-    cursor.execute("""
-        SELECT b.user_id, c.permission
-        FROM canvas_boards b
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
-        WHERE b.id = ?
-    """, (current_user["id"], board_id))
+            # Verificar permissão
+            cursor.execute("""
+                SELECT b.user_id, c.permission
+                FROM canvas_boards b
+                LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
+                WHERE b.id = ?
+            """, (current_user["id"], board_id))
     
-    result = cursor.fetchone()
-    if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
-        conn.close()
-        raise HTTPException(status_code=403, detail="No permission to edit this board")
+            result = cursor.fetchone()
+            if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
+                raise HTTPException(status_code=403, detail="No permission to edit this board")
     
-    cursor.execute("""
-        INSERT INTO canvas_edges (id, board_id, source_node_id, target_node_id, source_handle, target_handle, label, style, animated)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        edge.id, board_id, edge.source_node_id, edge.target_node_id,
-        edge.source_handle, edge.target_handle, edge.label, json.dumps(edge.style), edge.animated
-    ))
+            cursor.execute("""
+                INSERT INTO canvas_edges (id, board_id, source_node_id, target_node_id, source_handle, target_handle, label, style, animated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                edge.id, board_id, edge.source_node_id, edge.target_node_id,
+                edge.source_handle, edge.target_handle, edge.label, json.dumps(edge.style), edge.animated
+            ))
+            board_changed(board_id)
+            canvas_state_written(board_id)
     
-    conn.commit()
+    await run_db(insert_edge)
     
     # Notificar via WebSocket
     await manager.broadcast_to_board(board_id, {
@@ -1966,29 +5157,31 @@ async def create_canvas_edge(board_id: int, edge: CanvasEdgeCreate, current_user
         "user": current_user["username"]
     })
     
-    conn.close()
     return {"message": "Canvas edge created successfully"}
 
 @app.delete("/canvas/boards/{board_id}/edges/{edge_id}")
 async def delete_canvas_edge(board_id: int, edge_id: str, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    def remove_edge():
+        with db_write() as conn:
+            cursor = conn.cursor()
     
-    # Verificar permissão
-    cursor.execute("""
-        SELECT b.user_id, c.permission
-        FROM canvas_boards b
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
-        WHERE b.id = ?
-    """, (current_user["id"], board_id))
+            # Verificar permissão
+            cursor.execute("""
+                SELECT b.user_id, c.permission
+                FROM canvas_boards b
+                LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
+                WHERE b.id = ?
+            """, (current_user["id"], board_id))
+    
+            result = cursor.fetchone()
+            if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
+                raise HTTPException(status_code=403, detail="No permission to edit this board")
     
-    result = cursor.fetchone()
-    if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
-        conn.close()
-        raise HTTPException(status_code=403, detail="No permission to edit this board")
+            cursor.execute("DELETE FROM canvas_edges WHERE board_id = ? AND id = ?", (board_id, edge_id))
+            board_changed(board_id)
+            canvas_state_written(board_id)
     
-    cursor.execute("DELETE FROM canvas_edges WHERE board_id = ? AND id = ?", (board_id, edge_id))
-    conn.commit()
+    await run_db(remove_edge)
     
     # Notificar via WebSocket
     await manager.broadcast_to_board(board_id, {
@@ -1998,7 +5191,6 @@ async def delete_canvas_edge(board_id: int, edge_id: str, current_user: dict = D
         "user": current_user["username"]
     })
     
-    conn.close()
     return {"message": "Canvas edge deleted successfully"}
 
 # Canvas Export/Import
@@ -2008,62 +5200,71 @@ async def export_canvas_board(board_id: int, current_user: dict = Depends(get_cu
     return board_data
 
 @app.post("/canvas/boards/{board_id}/import")
-async def import_canvas_board(board_id: int, board_data: dict, current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def import_canvas_board(board_id: int, board_data: dict, current_user: dict = Depends(get_current_user)):
+    with db_write() as conn:
+        cursor = conn.cursor()
     
-    # Verificar permissão
-    cursor.execute("""
-        SELECT b.user_id, c.permission
-        FROM canvas_boards b
-        LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
-        WHERE b.id = ?
-    """, (current_user["id"], board_id))
-    
-    result = cursor.fetchone()
-    if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
-        conn.close()
-        raise HTTPException(status_code=403, detail="No permission to edit this board")
-    
-    # Limpar board atual
-    cursor.execute("DELETE FROM canvas_edges WHERE board_id = ?", (board_id,))
-    cursor.execute("DELETE FROM canvas_nodes WHERE board_id = ?", (board_id,))
-    
-    # Importar nodes
-    for node in board_data.get('nodes', []):
+        # Verificar permissão
         cursor.execute("""
-            INSERT INTO canvas_nodes (id, board_id, type, position_x, position_y, width, height, data, style, z_index)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            node['id'], board_id, node['type'], 
-            node['position']['x'], node['position']['y'],
-            node.get('width', 200), node.get('height', 150),
-            json.dumps(node['data']), json.dumps(node.get('style', {})),
-            node.get('zIndex', 0)
-        ))
+            SELECT b.user_id, c.permission
+            FROM canvas_boards b
+            LEFT JOIN canvas_collaborators c ON b.id = c.board_id AND c.user_id = ?
+            WHERE b.id = ?
+        """, (current_user["id"], board_id))
     
-    # Importar edges
-    for edge in board_data.get('edges', []):
-        cursor.execute("""
-            INSERT INTO canvas_edges (id, board_id, source_node_id, target_node_id, source_handle, target_handle, label, style, animated)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            edge['id'], board_id, edge['source'], edge['target'],
-            edge.get('sourceHandle', ''), edge.get('targetHandle', ''),
-            edge.get('label', ''), json.dumps(edge.get('style', {})),
-            edge.get('animated', False)
-        ))
+        result = cursor.fetchone()
+        if not result or (result[0] != current_user["id"] and result[1] not in ['edit', 'admin']):
+            raise HTTPException(status_code=403, detail="No permission to edit this board")
+    
+        # Limpar board atual
+        cursor.execute("DELETE FROM canvas_edges WHERE board_id = ?", (board_id,))
+        cursor.execute("DELETE FROM canvas_nodes WHERE board_id = ?", (board_id,))
+        board_changed(board_id)
+        canvas_state_written(board_id)
+    
+        # Importar nodes
+        for node in board_data.get('nodes', []):
+            cursor.execute("""
+                INSERT INTO canvas_nodes (id, board_id, type, position_x, position_y, width, height, data, style, z_index)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                node['id'], board_id, node['type'], 
+                node['position']['x'], node['position']['y'],
+                node.get('width', 200), node.get('height', 150),
+                json.dumps(node['data']), json.dumps(node.get('style', {})),
+                node.get('zIndex', 0)
+            ))
     
-    conn.commit()
-    conn.close()
+        # Importar edges
+        for edge in board_data.get('edges', []):
+            cursor.execute("""
+                INSERT INTO canvas_edges (id, board_id, source_node_id, target_node_id, source_handle, target_handle, label, style, animated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                edge['id'], board_id, edge['source'], edge['target'],
+                edge.get('sourceHandle', ''), edge.get('targetHandle', ''),
+                edge.get('label', ''), json.dumps(edge.get('style', {})),
+                edge.get('animated', False)
+            ))
     
     return {"message": "Canvas board imported successfully"}
 
 # =================== CANVAS WEBSOCKET ===================
 
 # Gerenciador de rooms Canvas
-canvas_rooms: dict = {}  # {board_id: {connections: set, state_cache: dict}}
+canvas_rooms: dict = {}  # {board_id: {connections: {websocket: ClientSender}, state: CanvasRoomState, state_lock: asyncio.Lock}}
 canvas_debounce_tasks: dict = {}  # {board_id: asyncio.Task}
+canvas_pending_changes: dict = {}  # {board_id: {"nodes": {id: node | None}, "edges": {id: edge | None}}}
+canvas_flush_lock = asyncio.Lock()  # flushes gravam na ordem em que foram agendados
+canvas_stale_rooms: set = set()  # boards com sala aberta alterados pela API REST: recarregar do banco
+canvas_persist_stats = {
+    "flushes": 0,
+    "failures": 0,
+    "rows_upserted": 0,
+    "rows_deleted": 0,
+    "last_flush_rows": 0,
+    "max_flush_rows": 0,
+}
 
 class CanvasConnectionManager:
     def __init__(self):
@@ -2071,136 +5272,280 @@ class CanvasConnectionManager:
     
     def add_connection(self, board_id: int, websocket: WebSocket):
         if board_id not in self.rooms:
-            self.rooms[board_id] = {"connections": set(), "state_cache": {}}
-        self.rooms[board_id]["connections"].add(websocket)
+            self.rooms[board_id] = {"connections": {}, "state": None, "state_lock": asyncio.Lock()}
+        self.rooms[board_id]["connections"][websocket] = ClientSender(
+            websocket, lambda: self.remove_connection(board_id, websocket)
+        )
     
     def remove_connection(self, board_id: int, websocket: WebSocket):
         if board_id in self.rooms:
-            self.rooms[board_id]["connections"].discard(websocket)
+            sender = self.rooms[board_id]["connections"].pop(websocket, None)
+            if sender:
+                sender.close()
             if not self.rooms[board_id]["connections"]:
                 del self.rooms[board_id]
+                canvas_stale_rooms.discard(board_id)
+    
+    def send(self, board_id: int, websocket: WebSocket, text: str):
+        """Envia para uma conexão pela sua fila, mantendo a ordem com os broadcasts"""
+        sender = self.rooms.get(board_id, {}).get("connections", {}).get(websocket)
+        if sender:
+            sender.send(text)
     
     async def broadcast(self, board_id: int, message: dict, exclude: WebSocket = None):
         if board_id in self.rooms:
-            for ws in self.rooms[board_id]["connections"].copy():
+            text = json.dumps(message)
+            for ws, sender in list(self.rooms[board_id]["connections"].items()):
                 if ws != exclude:
-                    try:
-                        await ws.send_text(json.dumps(message))
-                    except:
-                        self.rooms[board_id]["connections"].discard(ws)
+                    sender.send(text)
+    
+    def presence(self, board_id: int, websocket: WebSocket, message: dict):
+        """Cursor/seleção da conexão: só a última por conexão, um frame por tick"""
+        presence_aggregator.publish(
+            ("canvas", board_id), websocket, websocket, message,
+            lambda: list(self.rooms.get(board_id, {}).get("connections", {}).items())
+        )
 
 canvas_manager = CanvasConnectionManager()
 
+class CanvasRoomState:
+    """Estado autoritativo de um board em memória, compartilhado por todas as conexões da sala.
+
+    Nós e arestas ficam indexados por ID (ops em O(1)); o JSON do snapshot é
+    reaproveitado entre novos participantes até a próxima op.
+    """
+
+    OPS = {
+        "add_node": ("nodes", "add"),
+        "update_node": ("nodes", "update"),
+        "delete_node": ("nodes", "delete"),
+        "add_edge": ("edges", "add"),
+        "update_edge": ("edges", "update"),
+        "delete_edge": ("edges", "delete"),
+    }
+
+    def __init__(self, board_id: int, nodes: list, edges: list):
+        self.board_id = board_id
+        self.reset(nodes, edges)
+
+    def reset(self, nodes: list, edges: list):
+        """Troca o estado inteiro pelo lido do banco (o objeto segue o mesmo para as conexões)"""
+        self.items = {
+            "nodes": {node["id"]: node for node in nodes},
+            "edges": {edge["id"]: edge for edge in edges},
+        }
+        self._snapshot_json = None
+
+    def apply_pending(self, changes: dict):
+        """Sobrepõe mudanças ainda não gravadas no banco (None = removido)"""
+        for kind in ("nodes", "edges"):
+            for item_id, item in changes.get(kind, {}).items():
+                if item is None:
+                    self.items[kind].pop(item_id, None)
+                else:
+                    self.items[kind][item_id] = item
+        self._snapshot_json = None
+
+    def apply(self, op: str, data: dict) -> bool:
+        """Aplica uma op e marca o item para o próximo flush; False se a op não mudou nada"""
+        if op not in self.OPS:
+            return False
+        kind, action = self.OPS[op]
+        items = self.items[kind]
+        item_id = data.get("id")
+        
+        if action == "add":
+            items[item_id] = data
+        elif action == "update":
+            if item_id not in items:
+                return False
+            items[item_id] = data
+        elif items.pop(item_id, None) is None:
+            return False
+        
+        track_canvas_change(self.board_id, kind, item_id, None if action == "delete" else data)
+        self._snapshot_json = None
+        return True
+
+    def state_message(self, online: int) -> str:
+        """Mensagem `state` serializada com o estado atual"""
+        if self._snapshot_json is None:
+            self._snapshot_json = (
+                json.dumps(list(self.items["nodes"].values())),
+                json.dumps(list(self.items["edges"].values()))
+            )
+        nodes_json, edges_json = self._snapshot_json
+        return f'{{"type": "state", "nodes": {nodes_json}, "edges": {edges_json}, "online": {online}}}'
+
+async def get_canvas_room_state(board_id: int) -> CanvasRoomState:
+    """Estado da sala, carregado do banco uma vez enquanto houver conexões (e de novo
+    depois de uma escrita pela API REST, ver canvas_state_written)"""
+    room = canvas_rooms[board_id]
+    async with room["state_lock"]:
+        if room["state"] is None or board_id in canvas_stale_rooms:
+            canvas_stale_rooms.discard(board_id)
+            # Esperar flushes em andamento para não ler um estado anterior a eles
+            async with canvas_flush_lock:
+                nodes, edges = await run_db(load_canvas_state, board_id)
+                if room["state"] is None:
+                    room["state"] = CanvasRoomState(board_id, nodes, edges)
+                else:
+                    room["state"].reset(nodes, edges)
+                room["state"].apply_pending(canvas_pending_changes.get(board_id, {}))
+        return room["state"]
+
+def canvas_state_written(board_id: int):
+    """Escrita fora do WebSocket: depois do commit, a sala aberta relê o banco no próximo join/sync"""
+    def mark_stale():
+        if board_id in canvas_rooms:
+            canvas_stale_rooms.add(board_id)
+    db_pool.after_commit(mark_stale)
+
+CANVAS_NODE_UPSERT = """
+    INSERT INTO canvas_nodes 
+    (id, board_id, type, ref_note_id, text, url, x, y, width, height, color, z_index)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        type = excluded.type, ref_note_id = excluded.ref_note_id, text = excluded.text,
+        url = excluded.url, x = excluded.x, y = excluded.y, width = excluded.width,
+        height = excluded.height, color = excluded.color, z_index = excluded.z_index
+    WHERE canvas_nodes.board_id = excluded.board_id
+"""
+
+CANVAS_EDGE_UPSERT = """
+    INSERT INTO canvas_edges 
+    (id, board_id, source_node_id, target_node_id, label, style)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        source_node_id = excluded.source_node_id, target_node_id = excluded.target_node_id,
+        label = excluded.label, style = excluded.style
+    WHERE canvas_edges.board_id = excluded.board_id
+"""
+
+def canvas_node_row(board_id: int, node: dict) -> tuple:
+    return (
+        node.get("id"), board_id, node["type"], node.get("ref_note_id"),
+        node.get("text"), node.get("url"), node["x"], node["y"],
+        node.get("width"), node.get("height"), node.get("color"), 
+        node.get("z_index", 0)
+    )
+
+def canvas_edge_row(board_id: int, edge: dict) -> tuple:
+    return (
+        edge.get("id"), board_id, edge["source_node_id"], 
+        edge["target_node_id"], edge.get("label"), edge.get("style")
+    )
+
+def write_canvas_changes(cursor, board_id: int, node_rows: list, node_deletes: list,
+                         edge_rows: list, edge_deletes: list) -> int:
+    """Aplica upserts e remoções de nós/arestas no board; devolve o número de linhas escritas"""
+    if edge_deletes:
+        cursor.executemany("DELETE FROM canvas_edges WHERE board_id = ? AND id = ?",
+                           [(board_id, edge_id) for edge_id in edge_deletes])
+    if node_deletes:
+        cursor.executemany("DELETE FROM canvas_nodes WHERE board_id = ? AND id = ?",
+                           [(board_id, node_id) for node_id in node_deletes])
+    if node_rows:
+        cursor.executemany(CANVAS_NODE_UPSERT, node_rows)
+    if edge_rows:
+        cursor.executemany(CANVAS_EDGE_UPSERT, edge_rows)
+    
+    rows = len(node_rows) + len(node_deletes) + len(edge_rows) + len(edge_deletes)
+    board_changed(board_id)
+    canvas_persist_stats["flushes"] += 1
+    canvas_persist_stats["rows_upserted"] += len(node_rows) + len(edge_rows)
+    canvas_persist_stats["rows_deleted"] += len(node_deletes) + len(edge_deletes)
+    canvas_persist_stats["last_flush_rows"] = rows
+    canvas_persist_stats["max_flush_rows"] = max(canvas_persist_stats["max_flush_rows"], rows)
+    return rows
+
+def write_canvas_delta(board_id: int, nodes: dict, edges: dict) -> int:
+    """Grava só os nós/arestas alterados desde o último flush (None = removido), numa transação"""
+    with db_write() as conn:
+        cursor = conn.cursor()
+        rows = write_canvas_changes(
+            cursor, board_id,
+            [canvas_node_row(board_id, node) for node in nodes.values() if node is not None],
+            [node_id for node_id, node in nodes.items() if node is None],
+            [canvas_edge_row(board_id, edge) for edge in edges.values() if edge is not None],
+            [edge_id for edge_id, edge in edges.items() if edge is None]
+        )
+        cursor.execute("UPDATE canvas_boards SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (board_id,))
+    return rows
+
+def track_canvas_change(board_id: int, kind: str, item_id, item: Optional[dict]):
+    """Marca um nó/aresta como sujo para o próximo flush (None = remover)"""
+    pending = canvas_pending_changes.setdefault(board_id, {"nodes": {}, "edges": {}})
+    pending[kind][item_id] = item
+
+def canvas_persist_status() -> dict:
+    flushes = canvas_persist_stats["flushes"]
+    rows = canvas_persist_stats["rows_upserted"] + canvas_persist_stats["rows_deleted"]
+    return {
+        **canvas_persist_stats,
+        "avg_flush_rows": round(rows / flushes, 2) if flushes else 0,
+        "boards_pending": len(canvas_pending_changes),
+    }
+
 async def persist_canvas_state(board_id: int):
-    """Persiste o estado do canvas no banco com debounce"""
+    """Persiste no banco, com debounce, só o que mudou no canvas"""
     await asyncio.sleep(0.6)  # 600ms debounce
     
-    if board_id in canvas_rooms and "state_cache" in canvas_rooms[board_id]:
-        state = canvas_rooms[board_id]["state_cache"]
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
+    # Daqui em diante o flush não é mais cancelado; novas ops agendam outro
+    if canvas_debounce_tasks.get(board_id) is asyncio.current_task():
+        del canvas_debounce_tasks[board_id]
+    await flush_canvas_changes(board_id)
+
+async def flush_canvas_changes(board_id: int):
+    """Grava agora as mudanças pendentes do board (na ordem dos flushes já agendados)"""
+    async with canvas_flush_lock:
+        changes = canvas_pending_changes.pop(board_id, None)
+        if not changes:
+            return
         
         try:
-            # Limpar e recriar estado
-            cursor.execute("DELETE FROM canvas_edges WHERE board_id = ?", (board_id,))
-            cursor.execute("DELETE FROM canvas_nodes WHERE board_id = ?", (board_id,))
-            
-            # Inserir nós
-            for node in state.get("nodes", []):
-                cursor.execute("""
-                    INSERT INTO canvas_nodes 
-                    (id, board_id, type, ref_note_id, text, url, x, y, width, height, color, z_index)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    node.get("id"), board_id, node["type"], node.get("ref_note_id"),
-                    node.get("text"), node.get("url"), node["x"], node["y"],
-                    node.get("width"), node.get("height"), node.get("color"), 
-                    node.get("z_index", 0)
-                ))
-            
-            # Inserir arestas
-            for edge in state.get("edges", []):
-                cursor.execute("""
-                    INSERT INTO canvas_edges 
-                    (id, board_id, source_node_id, target_node_id, label, style)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (
-                    edge.get("id"), board_id, edge["source_node_id"], 
-                    edge["target_node_id"], edge.get("label"), edge.get("style")
-                ))
-            
-            cursor.execute("UPDATE canvas_boards SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (board_id,))
-            conn.commit()
-            
+            await run_db(write_canvas_delta, board_id, changes["nodes"], changes["edges"])
         except Exception as e:
-            conn.rollback()
+            canvas_persist_stats["failures"] += 1
             print(f"Error persisting canvas state: {e}")
-        finally:
-            conn.close()
-    
-    # Limpar task
-    if board_id in canvas_debounce_tasks:
-        del canvas_debounce_tasks[board_id]
+            # Devolver as mudanças que não foram sobrescritas por ops mais novas
+            pending = canvas_pending_changes.setdefault(board_id, {"nodes": {}, "edges": {}})
+            for kind in ("nodes", "edges"):
+                for item_id, item in changes[kind].items():
+                    pending[kind].setdefault(item_id, item)
 
-@app.websocket("/ws/canvas/{board_id}")
-async def canvas_websocket(websocket: WebSocket, board_id: int, token: str = Query(...)):
-    """WebSocket para colaboração em tempo real no Canvas"""
-    
-    # Validar token
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if not user_id:
-            await websocket.close(code=1008, reason="Invalid token")
-            return
-        
-        # Buscar usuário
-        conn = get_db_connection()
+async def flush_all_canvas_changes():
+    """Cancela os debounces e grava o que está pendente em todos os boards (shutdown)"""
+    for task in list(canvas_debounce_tasks.values()):
+        task.cancel()
+    canvas_debounce_tasks.clear()
+    for board_id in list(canvas_pending_changes):
+        await flush_canvas_changes(board_id)
+
+def fetch_user_by_username(username: str):
+    with db_read() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT id, username FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if not user:
-            await websocket.close(code=1008, reason="User not found")
-            return
-            
-        current_user = {"id": user[0], "username": user[1]}
-        
-    except JWTError:
-        await websocket.close(code=1008, reason="Invalid token")
-        return
-    
-    # Verificar acesso ao board
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id FROM canvas_boards 
-        WHERE id = ? AND (owner_id = ? OR owner_id IS NULL)
-    """, (board_id, current_user["id"]))
-    
-    if not cursor.fetchone():
-        conn.close()
-        await websocket.close(code=1008, reason="Board not found or not authorized")
-        return
-    
-    conn.close()
-    
-    await websocket.accept()
-    canvas_manager.add_connection(board_id, websocket)
-    
-    # Enviar estado atual + contagem online na conexão
-    try:
-        # Buscar estado atual
-        conn = get_db_connection()
+        cursor.execute("SELECT id, username FROM users WHERE username = ?", (username,))
+        return cursor.fetchone()
+
+def can_access_canvas_board(board_id: int, user_id: int) -> bool:
+    with db_read() as conn:
         cursor = conn.cursor()
-        
+        cursor.execute("""
+            SELECT id FROM canvas_boards 
+            WHERE id = ? AND (owner_id = ? OR owner_id IS NULL)
+        """, (board_id, user_id))
+        return cursor.fetchone() is not None
+
+def load_canvas_state(board_id: int):
+    with db_read() as conn:
+        cursor = conn.cursor()
+    
         cursor.execute("""
             SELECT id, type, ref_note_id, text, url, x, y, width, height, color, z_index
             FROM canvas_nodes WHERE board_id = ?
         """, (board_id,))
-        
+    
         nodes = []
         for row in cursor.fetchall():
             nodes.append({
@@ -2208,29 +5553,49 @@ async def canvas_websocket(websocket: WebSocket, board_id: int, token: str = Que
                 "text": row[3], "url": row[4], "x": row[5], "y": row[6],
                 "width": row[7], "height": row[8], "color": row[9], "z_index": row[10]
             })
-        
+    
         cursor.execute("""
             SELECT id, source_node_id, target_node_id, label, style
             FROM canvas_edges WHERE board_id = ?
         """, (board_id,))
-        
+    
         edges = []
         for row in cursor.fetchall():
             edges.append({
                 "id": row[0], "source_node_id": row[1], "target_node_id": row[2],
                 "label": row[3], "style": row[4]
             })
+    
+    return nodes, edges
+
+@app.websocket("/ws/canvas/{board_id}")
+async def canvas_websocket(websocket: WebSocket, board_id: int, token: str = Query(...)):
+    """WebSocket para colaboração em tempo real no Canvas"""
+    
+    # Validar token (cache primeiro; só vai ao pool de threads se precisar decodificar/buscar)
+    current_user = auth_cache.get(token)
+    if current_user is None:
+        current_user = await run_db(verify_token, token)
+    if current_user is None:
+        await websocket.close(code=1008, reason="Invalid token")
+        return
+    
+    # Verificar acesso ao board
+    if not await run_db(can_access_canvas_board, board_id, current_user["id"]):
+        await websocket.close(code=1008, reason="Board not found or not authorized")
+        return
+    
+    await websocket.accept()
+    canvas_manager.add_connection(board_id, websocket)
+    
+    # Enviar estado atual + contagem online na conexão
+    try:
+        # Estado compartilhado da sala (só o primeiro participante lê o banco)
+        room_state = await get_canvas_room_state(board_id)
         
-        conn.close()
-        
-        online_count = len(canvas_rooms.get(board_id, {}).get("connections", set()))
+        online_count = len(canvas_rooms.get(board_id, {}).get("connections", {}))
         
-        await websocket.send_text(json.dumps({
-            "type": "state",
-            "nodes": nodes,
-            "edges": edges,
-            "online": online_count
-        }))
+        canvas_manager.send(board_id, websocket, room_state.state_message(online_count))
         
         # Notificar outros usuários sobre novo usuário online
         await canvas_manager.broadcast(board_id, {
@@ -2244,55 +5609,14 @@ async def canvas_websocket(websocket: WebSocket, board_id: int, token: str = Que
                 message = json.loads(data)
                 
                 if message["type"] == "sync":
-                    # Enviar estado atual
+                    # Enviar estado atual (relido se a API REST mudou o board)
+                    room_state = await get_canvas_room_state(board_id)
                     online_count = len(canvas_rooms[board_id]["connections"])
-                    await websocket.send_text(json.dumps({
-                        "type": "state",
-                        "nodes": nodes,
-                        "edges": edges,
-                        "online": online_count
-                    }))
+                    canvas_manager.send(board_id, websocket, room_state.state_message(online_count))
                 
                 elif message["type"] == "op":
-                    # Operação de mudança
-                    op = message["op"]
-                    data = message["data"]
-                    
-                    # Atualizar cache em memória
-                    if board_id not in canvas_rooms:
-                        canvas_rooms[board_id] = {"connections": set(), "state_cache": {"nodes": [], "edges": []}}
-                    
-                    cache = canvas_rooms[board_id]["state_cache"]
-                    if "nodes" not in cache:
-                        cache["nodes"] = nodes.copy()
-                    if "edges" not in cache:
-                        cache["edges"] = edges.copy()
-                    
-                    # Aplicar operação
-                    if op == "add_node":
-                        cache["nodes"].append(data)
-                        nodes.append(data)
-                    elif op == "update_node":
-                        for i, node in enumerate(cache["nodes"]):
-                            if node["id"] == data["id"]:
-                                cache["nodes"][i] = data
-                                nodes[i] = data
-                                break
-                    elif op == "delete_node":
-                        cache["nodes"] = [n for n in cache["nodes"] if n["id"] != data["id"]]
-                        nodes = [n for n in nodes if n["id"] != data["id"]]
-                    elif op == "add_edge":
-                        cache["edges"].append(data)
-                        edges.append(data)
-                    elif op == "update_edge":
-                        for i, edge in enumerate(cache["edges"]):
-                            if edge["id"] == data["id"]:
-                                cache["edges"][i] = data
-                                edges[i] = data
-                                break
-                    elif op == "delete_edge":
-                        cache["edges"] = [e for e in cache["edges"] if e["id"] != data["id"]]
-                        edges = [e for e in edges if e["id"] != data["id"]]
+                    # Operação de mudança aplicada no estado da sala
+                    room_state.apply(message["op"], message["data"])
                     
                     # Broadcast para outros clientes
                     await canvas_manager.broadcast(board_id, message, exclude=websocket)
@@ -2306,8 +5630,8 @@ async def canvas_websocket(websocket: WebSocket, board_id: int, token: str = Que
                     )
                 
                 elif message["type"] == "presence":
-                    # Repassar cursor/presença para outros
-                    await canvas_manager.broadcast(board_id, message, exclude=websocket)
+                    # Repassar cursor/presença para outros no próximo tick
+                    canvas_manager.presence(board_id, websocket, message)
                     
         except WebSocketDisconnect:
             pass
@@ -2327,193 +5651,158 @@ async def canvas_websocket(websocket: WebSocket, board_id: int, token: str = Que
 
 # =================== GRAPH VIEW ENDPOINTS ===================
 
+def build_graph_connections(graph: UserGraph) -> dict:
+    """Grafo do Graph View: [[links]] como referências e tags compartilhadas como ligações fracas"""
+    nodes = []
+    edges = []
+    connected = set()
+    ordered_ids = graph.ordered_ids()
+    
+    # Criar nós do grafo
+    for note_id in ordered_ids:
+        note = graph.notes[note_id]
+        nodes.append({
+            "id": str(note_id),
+            "title": note["title"],
+            "content_preview": note["preview"],
+            "tags": graph.tags.get(note_id, []),
+            "created_at": note["created_at"],
+            "updated_at": note["updated_at"],
+            "word_count": note["word_count"],
+            "folder_id": note["folder_id"],
+            "type": "note"
+        })
+    
+    # Referências entre notas (links do tipo [[Nota]])
+    for note_id in ordered_ids:
+        for target_id in graph.links.get(note_id, []):
+            if target_id == note_id or target_id not in graph.notes:
+                continue
+            connected.add(frozenset((note_id, target_id)))
+            edges.append({
+                "id": f"edge-{note_id}-{target_id}",
+                "source": str(note_id),
+                "target": str(target_id),
+                "type": "reference",
+                "strength": 1
+            })
+    
+    # Conexões por tags compartilhadas (um par de notas recebe no máximo uma aresta)
+    tag_connections = {}
+    for note_id in ordered_ids:
+        for tag in graph.tags.get(note_id, []):
+            tag_connections.setdefault(tag, []).append(note_id)
+    
+    for tag, note_ids in tag_connections.items():
+        for i in range(len(note_ids)):
+            for j in range(i + 1, len(note_ids)):
+                pair = frozenset((note_ids[i], note_ids[j]))
+                if pair in connected:
+                    continue
+                connected.add(pair)
+                edges.append({
+                    "id": f"tag-{note_ids[i]}-{note_ids[j]}-{tag}",
+                    "source": str(note_ids[i]),
+                    "target": str(note_ids[j]),
+                    "type": "tag",
+                    "tag": tag,
+                    "strength": 0.5
+                })
+    
+    linked_ids = set()
+    for pair in connected:
+        linked_ids.update(pair)
+    
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "stats": {
+            "total_notes": len(nodes),
+            "total_connections": len(edges),
+            "orphaned_notes": len(graph.notes) - len(linked_ids)
+        }
+    }
+
 @app.get("/api/graph/connections")
-async def get_graph_connections(
+def get_graph_connections(
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
-    """
-    Retorna todas as conexões entre notas para o Graph View
-    """
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Buscar todas as notas do usuário
-        cursor.execute("""
-            SELECT id, title, content, created_at, updated_at, folder_id
-            FROM notes WHERE user_id = ?
-            ORDER BY updated_at DESC
-        """, (current_user["id"],))
-        
-        notes = cursor.fetchall()
-        
-        # Estrutura para o grafo
-        nodes = []
-        edges = []
-        
-        # Criar nós do grafo
-        for note in notes:
-            note_id, title, content, created_at, updated_at, folder_id = note
-            
-            # Extrair tags da nota
-            tags = []
-            if content:
-                # Buscar tags no formato #tag
-                import re
-                tag_matches = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                tags = list(set(tag_matches))
-            
-            nodes.append({
-                "id": str(note_id),
-                "title": title,
-                "content_preview": content[:100] if content else "",
-                "tags": tags,
-                "created_at": created_at,
-                "updated_at": updated_at,
-                "word_count": len(content.split()) if content else 0,
-                "folder_id": folder_id,
-                "type": "note"
-            })
-        
-        # Buscar referências entre notas (links do tipo [[Nota]])
-        for note in notes:
-            note_id, title, content, _, _, _ = note
-            if content:
-                # Buscar referências no formato [[título da nota]]
-                import re
-                referenced_titles = re.findall(r'\[\[([^\]]+)\]\]', content)
-                
-                for ref_title in referenced_titles:
-                    # Encontrar nota referenciada
-                    cursor.execute("""
-                        SELECT id FROM notes 
-                        WHERE user_id = ? AND LOWER(title) LIKE LOWER(?)
-                    """, (current_user["id"], f"%{ref_title}%"))
-                    
-                    referenced_note = cursor.fetchone()
-                    
-                    if referenced_note:
-                        edges.append({
-                            "id": f"edge-{note_id}-{referenced_note[0]}",
-                            "source": str(note_id),
-                            "target": str(referenced_note[0]),
-                            "type": "reference",
-                            "strength": 1
-                        })
-        
-        # Adicionar conexões por tags compartilhadas
-        tag_connections = {}
-        for note in notes:
-            note_id, title, content, _, _, _ = note
-            if content:
-                import re
-                note_tags = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                for tag in note_tags:
-                    if tag not in tag_connections:
-                        tag_connections[tag] = []
-                    tag_connections[tag].append(str(note_id))
-        
-        # Criar arestas para notas com tags compartilhadas
-        for tag, note_ids in tag_connections.items():
-            if len(note_ids) > 1:
-                for i in range(len(note_ids)):
-                    for j in range(i + 1, len(note_ids)):
-                        # Verificar se já existe uma aresta de referência
-                        existing_edge = any(
-                            (edge["source"] == note_ids[i] and edge["target"] == note_ids[j]) or
-                            (edge["source"] == note_ids[j] and edge["target"] == note_ids[i])
-                            for edge in edges
-                        )
-                        
-                        if not existing_edge:
-                            edges.append({
-                                "id": f"tag-{note_ids[i]}-{note_ids[j]}-{tag}",
-                                "source": note_ids[i],
-                                "target": note_ids[j],
-                                "type": "tag",
-                                "tag": tag,
-                                "strength": 0.5
-                            })
-        
-        conn.close()
-        
-        return {
-            "nodes": nodes,
-            "edges": edges,
-            "stats": {
-                "total_notes": len(nodes),
-                "total_connections": len(edges),
-                "orphaned_notes": len([n for n in nodes if not any(
-                    e["source"] == n["id"] or e["target"] == n["id"] for e in edges
-                )])
-            }
-        }
+    """
+    Retorna todas as conexões entre notas para o Graph View
+    """
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
+    try:
+        return rendered_json(
+            graph_cache.get(current_user["id"]).view("graph_connections", build_graph_connections), response
+        )
         
     except Exception as e:
         print(f"Erro ao buscar conexões do grafo: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
 @app.get("/api/graph/tags")
-async def get_all_tags(
+def get_all_tags(
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Retorna todas as tags utilizadas pelo usuário
     """
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, title, content FROM notes WHERE user_id = ?
-        """, (current_user["id"],))
-        
-        notes = cursor.fetchall()
-        tag_stats = {}
-        
-        for note in notes:
-            note_id, title, content = note
-            if content:
-                # Extrair tags
-                import re
-                tags = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                
-                for tag in tags:
-                    if tag not in tag_stats:
-                        tag_stats[tag] = {
-                            "name": tag,
-                            "count": 0,
-                            "notes": []
-                        }
-                    tag_stats[tag]["count"] += 1
-                    tag_stats[tag]["notes"].append({
-                        "id": note_id,
-                        "title": title
-                    })
+        with db_read() as conn:
+            cursor = conn.cursor()
         
-        # Organizar tags por hierarquia
-        hierarchical_tags = {}
-        for tag_name, tag_data in tag_stats.items():
-            parts = tag_name.split('/')
-            current_level = hierarchical_tags
-            
-            for part in parts:
-                if part not in current_level:
-                    current_level[part] = {
-                        "name": part,
-                        "children": {},
-                        "data": None
+            cursor.execute("""
+                SELECT t.tag, t.occurrences, n.id, n.title
+                FROM note_tags t
+                JOIN notes n ON n.id = t.note_id
+                WHERE t.user_id = ? AND t.path = t.tag
+                ORDER BY t.tag, n.id
+            """, (current_user["id"],))
+        
+            tag_stats = {}
+            for tag, occurrences, note_id, title in cursor.fetchall():
+                if tag not in tag_stats:
+                    tag_stats[tag] = {
+                        "name": tag,
+                        "count": 0,
+                        "notes": []
                     }
-                current_level = current_level[part]["children"]
+                tag_stats[tag]["count"] += occurrences
+                tag_stats[tag]["notes"].append({
+                    "id": note_id,
+                    "title": title
+                })
+        
+            # Organizar tags por hierarquia
+            hierarchical_tags = {}
+            for tag_name, tag_data in tag_stats.items():
+                parts = tag_name.split('/')
+                current_level = hierarchical_tags
             
-            # Adicionar dados na folha
-            if parts:
-                target = hierarchical_tags
-                for part in parts[:-1]:
-                    target = target[part]["children"]
-                target[parts[-1]]["data"] = tag_data
-        
-        conn.close()
+                for part in parts:
+                    if part not in current_level:
+                        current_level[part] = {
+                            "name": part,
+                            "children": {},
+                            "data": None
+                        }
+                    current_level = current_level[part]["children"]
+            
+                # Adicionar dados na folha
+                if parts:
+                    target = hierarchical_tags
+                    for part in parts[:-1]:
+                        target = target[part]["children"]
+                    target[parts[-1]]["data"] = tag_data
         
         return {
             "flat_tags": list(tag_stats.values()),
@@ -2528,46 +5817,37 @@ async def get_all_tags(
 # =================== SISTEMA DE TAGS AVANÇADO ===================
 
 @app.get("/api/tags/autocomplete")
-async def get_tags_autocomplete(
+def get_tags_autocomplete(
+    request: Request,
+    response: Response,
     query: str = Query(..., min_length=1),
     current_user: dict = Depends(get_current_user)
 ):
     """
     Autocomplete para tags baseado no input do usuário
     """
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, title, content FROM notes WHERE user_id = ?
-        """, (current_user["id"],))
+        with db_read() as conn:
+            cursor = conn.cursor()
         
-        notes = cursor.fetchall()
-        all_tags = set()
-        
-        for note in notes:
-            note_id, title, content = note
-            if content:
-                import re
-                tags = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                all_tags.update(tags)
-        
-        # Filtrar tags que contêm a query
-        query_lower = query.lower()
-        matching_tags = [
-            tag for tag in all_tags 
-            if query_lower in tag.lower()
-        ]
+            # Filtrar tags que contêm a query
+            query_lower = query.lower()
+            cursor.execute("""
+                SELECT DISTINCT tag FROM note_tags
+                WHERE user_id = ? AND path = tag AND instr(lower(tag), ?) > 0
+            """, (current_user["id"], query_lower))
         
-        # Ordenar por relevância (começar com a query tem prioridade)
-        matching_tags.sort(key=lambda x: (
-            not x.lower().startswith(query_lower),  # Tags que começam com query primeiro
-            len(x),  # Tags mais curtas primeiro
-            x.lower()  # Ordem alfabética
-        ))
+            matching_tags = [row[0] for row in cursor.fetchall()]
         
-        conn.close()
+            # Ordenar por relevância (começar com a query tem prioridade)
+            matching_tags.sort(key=lambda x: (
+                not x.lower().startswith(query_lower),  # Tags que começam com query primeiro
+                len(x),  # Tags mais curtas primeiro
+                x.lower()  # Ordem alfabética
+            ))
         
         return {
             "suggestions": matching_tags[:10],  # Limitar a 10 sugestões
@@ -2578,101 +5858,106 @@ async def get_tags_autocomplete(
         print(f"Erro no autocomplete de tags: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
+def build_tags_hierarchy(user_id: int) -> dict:
+    with db_read() as conn:
+        cursor = conn.cursor()
+    
+        # Cada prefixo já está indexado; os pais vêm antes dos filhos pela ordenação
+        cursor.execute("""
+            SELECT t.path, t.depth, n.id, n.title, SUM(t.occurrences)
+            FROM note_tags t
+            JOIN notes n ON n.id = t.note_id
+            WHERE t.user_id = ?
+            GROUP BY t.path, n.id
+            ORDER BY t.depth, t.path, n.id
+        """, (user_id,))
+    
+        tag_hierarchy = {}
+        levels = {(0, ""): tag_hierarchy}
+    
+        for path, depth, note_id, title, occurrences in cursor.fetchall():
+            parent_path, _, part = path.rpartition('/')
+            current_level = levels[(depth - 1, parent_path)]
+            if part not in current_level:
+                current_level[part] = {
+                    "name": part,
+                    "fullPath": path,
+                    "children": {},
+                    "notes": [],
+                    "count": 0
+                }
+                levels[(depth, path)] = current_level[part]["children"]
+        
+            current_level[part]["notes"].append({
+                "id": note_id,
+                "title": title
+            })
+            current_level[part]["count"] += occurrences
+    
+    return {"hierarchy": tag_hierarchy}
+
 @app.get("/api/tags/hierarchy")
-async def get_tags_hierarchy(
+def get_tags_hierarchy(
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Retorna estrutura hierárquica de tags (#tag/subtag/subsubtag)
     """
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, title, content FROM notes WHERE user_id = ?
-        """, (current_user["id"],))
-        
-        notes = cursor.fetchall()
-        tag_hierarchy = {}
-        
-        for note in notes:
-            note_id, title, content = note
-            if content:
-                import re
-                tags = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                
-                for tag in tags:
-                    parts = tag.split('/')
-                    current_level = tag_hierarchy
-                    
-                    # Criar estrutura hierárquica
-                    for i, part in enumerate(parts):
-                        if part not in current_level:
-                            current_level[part] = {
-                                "name": part,
-                                "fullPath": '/'.join(parts[:i+1]),
-                                "children": {},
-                                "notes": [],
-                                "count": 0
-                            }
-                        
-                        current_level[part]["notes"].append({
-                            "id": note_id,
-                            "title": title
-                        })
-                        current_level[part]["count"] += 1
-                        current_level = current_level[part]["children"]
-        
-        conn.close()
-        
-        return {"hierarchy": tag_hierarchy}
+        return view_cache.get(current_user["id"], "tags_hierarchy", (),
+                              lambda: build_tags_hierarchy(current_user["id"]))
         
     except Exception as e:
         print(f"Erro ao buscar hierarquia de tags: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
 @app.get("/api/tags/{tag_path:path}/notes")
-async def get_notes_by_tag(
+def get_notes_by_tag(
+    request: Request,
+    response: Response,
     tag_path: str,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Retorna todas as notas que contêm uma tag específica
     """
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, title, content, created_at, updated_at, folder_id 
-            FROM notes WHERE user_id = ?
-        """, (current_user["id"],))
-        
-        notes = cursor.fetchall()
-        matching_notes = []
+        with db_read() as conn:
+            cursor = conn.cursor()
         
-        for note in notes:
-            note_id, title, content, created_at, updated_at, folder_id = note
-            if content:
-                import re
-                tags = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                
-                # Verificar se a tag ou uma sub-tag corresponde
-                for tag in tags:
-                    if tag == tag_path or tag.startswith(tag_path + '/'):
-                        matching_notes.append({
-                            "id": note_id,
-                            "title": title,
-                            "content": content[:200] + "..." if len(content) > 200 else content,
-                            "created_at": created_at,
-                            "updated_at": updated_at,
-                            "folder_id": folder_id,
-                            "matched_tag": tag
-                        })
-                        break
-        
-        conn.close()
+            # A tag ou qualquer sub-tag: busca exata pelo prefixo no índice
+            cursor.execute("""
+                SELECT n.id, n.title, n.content, n.created_at, n.updated_at, n.folder_id, t.tag
+                FROM note_tags t
+                JOIN notes n ON n.id = t.note_id
+                WHERE t.user_id = ? AND t.path = ?
+                ORDER BY n.id, t.position
+            """, (current_user["id"], tag_path))
+        
+            matching_notes = []
+            seen_notes = set()
+        
+            for note_id, title, content, created_at, updated_at, folder_id, tag in cursor.fetchall():
+                if note_id in seen_notes:
+                    continue
+                seen_notes.add(note_id)
+                matching_notes.append({
+                    "id": note_id,
+                    "title": title,
+                    "content": content[:200] + "..." if len(content) > 200 else content,
+                    "created_at": created_at,
+                    "updated_at": updated_at,
+                    "folder_id": folder_id,
+                    "matched_tag": tag
+                })
         
         return {
             "tag": tag_path,
@@ -2684,51 +5969,44 @@ async def get_notes_by_tag(
         print(f"Erro ao buscar notas por tag: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
+def build_popular_tags(user_id: int, limit: int) -> dict:
+    with db_read() as conn:
+        cursor = conn.cursor()
+    
+        # Ordenar por contagem e limitar
+        cursor.execute("""
+            SELECT tag, SUM(occurrences) AS total FROM note_tags
+            WHERE user_id = ? AND path = tag
+            GROUP BY tag
+            ORDER BY total DESC
+            LIMIT ?
+        """, (user_id, limit))
+    
+        popular_tags = cursor.fetchall()
+    
+    return {
+        "popular_tags": [
+            {"name": tag, "count": count}
+            for tag, count in popular_tags
+        ]
+    }
+
 @app.get("/api/tags/popular")
-async def get_popular_tags(
+def get_popular_tags(
+    request: Request,
+    response: Response,
     limit: int = Query(20, le=50),
     current_user: dict = Depends(get_current_user)
 ):
     """
     Retorna as tags mais populares do usuário
     """
+    not_modified = conditional_get(request, response, change_counters.etag(("user", current_user["id"])))
+    if not_modified:
+        return not_modified
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, title, content FROM notes WHERE user_id = ?
-        """, (current_user["id"],))
-        
-        notes = cursor.fetchall()
-        tag_counts = {}
-        
-        for note in notes:
-            note_id, title, content = note
-            if content:
-                import re
-                tags = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                
-                for tag in tags:
-                    if tag not in tag_counts:
-                        tag_counts[tag] = 0
-                    tag_counts[tag] += 1
-        
-        # Ordenar por contagem e limitar
-        popular_tags = sorted(
-            tag_counts.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:limit]
-        
-        conn.close()
-        
-        return {
-            "popular_tags": [
-                {"name": tag, "count": count}
-                for tag, count in popular_tags
-            ]
-        }
+        return view_cache.get(current_user["id"], "popular_tags", (limit,),
+                              lambda: build_popular_tags(current_user["id"], limit))
         
     except Exception as e:
         print(f"Erro ao buscar tags populares: {str(e)}")
@@ -2737,7 +6015,7 @@ async def get_popular_tags(
 # =================== SISTEMA DE BACKLINKS E MENTIONS ===================
 
 @app.get("/api/notes/{note_id}/backlinks")
-async def get_note_backlinks(
+def get_note_backlinks(
     note_id: int,
     current_user: dict = Depends(get_current_user)
 ):
@@ -2745,83 +6023,95 @@ async def get_note_backlinks(
     Retorna todas as notas que fazem referência à nota especificada
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Buscar a nota alvo
-        cursor.execute("""
-            SELECT id, title, content FROM notes 
-            WHERE id = ? AND user_id = ?
-        """, (note_id, current_user["id"]))
-        
-        target_note = cursor.fetchone()
-        if not target_note:
-            raise HTTPException(status_code=404, detail="Nota não encontrada")
-        
-        target_id, target_title, target_content = target_note
-        
-        # Buscar todas as outras notas do usuário
-        cursor.execute("""
-            SELECT id, title, content, created_at, updated_at, folder_id
-            FROM notes WHERE user_id = ? AND id != ?
-        """, (current_user["id"], note_id))
+        # Notas que citam o título em texto puro, do grafo em memória
+        mentioned_by = graph_cache.get(current_user["id"]).view(
+            f"mentioned_by:{note_id}",
+            lambda graph: sorted(graph.mentioned_by.get(note_id, ())),
+            needs_mentions=True,
+            note_id=note_id
+        ) or []
+        
+        with db_read() as conn:
+            cursor = conn.cursor()
+        
+            # Buscar a nota alvo
+            cursor.execute("""
+                SELECT id, title, content FROM notes 
+                WHERE id = ? AND user_id = ?
+            """, (note_id, current_user["id"]))
         
-        all_notes = cursor.fetchall()
-        backlinks = []
+            target_note = cursor.fetchone()
+            if not target_note:
+                raise HTTPException(status_code=404, detail="Nota não encontrada")
         
-        import re
+            target_id, target_title, target_content = target_note
         
-        for note in all_notes:
-            note_id_ref, title, content, created_at, updated_at, folder_id = note
-            if content:
-                # Buscar referências [[título da nota]] ou [[link|display]]
-                wiki_links = re.findall(r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]', content)
-                
-                # Verificar se algum link aponta para a nota alvo
-                for link_data in wiki_links:
-                    link_target = link_data[0].strip()
-                    link_display = link_data[1].strip() if link_data[1] else link_target
-                    
-                    # Verificar se o link corresponde ao título da nota alvo
-                    if link_target.lower() == target_title.lower():
-                        # Extrair contexto ao redor do link
-                        link_pattern = re.escape(f"[[{link_data[0]}]]") if not link_data[1] else re.escape(f"[[{link_data[0]}|{link_data[1]}]]")
-                        match = re.search(f'.{{0,50}}{link_pattern}.{{0,50}}', content)
-                        context = match.group(0) if match else content[:100]
-                        
-                        backlinks.append({
-                            "note_id": note_id_ref,
-                            "title": title,
-                            "context": context,
-                            "link_text": link_display,
-                            "created_at": created_at,
-                            "updated_at": updated_at,
-                            "folder_id": folder_id
-                        })
-                        break
+            # Links [[título]] vêm do índice note_links, sem varrer o conteúdo das outras notas
+            cursor.execute("""
+                SELECT l.source_note_id, n.title, n.created_at, n.updated_at, n.folder_id,
+                       l.display_text, l.position, l.length,
+                       substr(n.content, max(l.position - 50, 0) + 1, l.length + 100)
+                FROM note_links l
+                JOIN notes n ON n.id = l.source_note_id
+                WHERE l.user_id = ? AND l.target_key = ? AND l.source_note_id != ?
+                ORDER BY l.source_note_id, l.position
+            """, (current_user["id"], title_key(target_title), note_id))
+        
+            backlinks = []
+            linked_ids = set()
+            for source_id, title, created_at, updated_at, folder_id, link_display, position, length, snippet in cursor.fetchall():
+                if source_id in linked_ids:
+                    continue
+                linked_ids.add(source_id)
+                offset = position - max(position - 50, 0)
+                backlinks.append({
+                    "note_id": source_id,
+                    "title": title,
+                    "context": link_context(snippet, offset, length),
+                    "link_text": link_display,
+                    "created_at": created_at,
+                    "updated_at": updated_at,
+                    "folder_id": folder_id
+                })
+        
+            # Menções diretas do título (notas sem link). Títulos curtos ficam fora do
+            # grafo (MENTION_MIN_TITLE_LENGTH), mas o painel sempre listou as menções deles
+            title_lower = target_title.lower()
+            if len(title_lower) < MENTION_MIN_TITLE_LENGTH:
+                cursor.execute("SELECT id, content FROM notes WHERE user_id = ? AND id != ? ORDER BY id",
+                               (current_user["id"], note_id))
+                mentioned_by = [source_id for source_id, content in cursor.fetchall()
+                                if content and title_lower in content.lower()]
+            mention_ids = [source_id for source_id in mentioned_by if source_id not in linked_ids]
+        
+            notes = []
+            for start in range(0, len(mention_ids), 500):
+                chunk = mention_ids[start:start + 500]
+                cursor.execute(f"""
+                    SELECT id, title, content, created_at, updated_at, folder_id
+                    FROM notes WHERE user_id = ? AND id IN ({', '.join('?' for _ in chunk)})
+                    ORDER BY id
+                """, [current_user["id"], *chunk])
+                notes.extend(cursor.fetchall())
+        
+            for note in notes:
+                note_id_ref, title, content, created_at, updated_at, folder_id = note
+                if content and target_title.lower() in content.lower():
+                    # Extrair contexto ao redor da menção
+                    title_pattern = re.escape(target_title)
+                    match = re.search(f'.{{0,50}}{title_pattern}.{{0,50}}', content, re.IGNORECASE)
+                    context = match.group(0) if match else content[:100]
                 
-                # Buscar menções diretas do título
-                if target_title.lower() in content.lower():
-                    # Não adicionar se já foi adicionado como wiki link
-                    already_added = any(bl["note_id"] == note_id_ref for bl in backlinks)
-                    if not already_added:
-                        # Extrair contexto ao redor da menção
-                        title_pattern = re.escape(target_title)
-                        match = re.search(f'.{{0,50}}{title_pattern}.{{0,50}}', content, re.IGNORECASE)
-                        context = match.group(0) if match else content[:100]
-                        
-                        backlinks.append({
-                            "note_id": note_id_ref,
-                            "title": title,
-                            "context": context,
-                            "link_text": target_title,
-                            "created_at": created_at,
-                            "updated_at": updated_at,
-                            "folder_id": folder_id,
-                            "is_mention": True
-                        })
-        
-        conn.close()
+                    backlinks.append({
+                        "note_id": note_id_ref,
+                        "title": title,
+                        "context": context,
+                        "link_text": target_title,
+                        "created_at": created_at,
+                        "updated_at": updated_at,
+                        "folder_id": folder_id,
+                        "is_mention": True
+                    })
         
         return {
             "note_id": target_id,
@@ -2835,7 +6125,7 @@ async def get_note_backlinks(
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
 @app.get("/api/notes/{note_id}/outlinks")
-async def get_note_outlinks(
+def get_note_outlinks(
     note_id: int,
     current_user: dict = Depends(get_current_user)
 ):
@@ -2843,79 +6133,47 @@ async def get_note_outlinks(
     Retorna todas as referências que a nota faz para outras notas
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Buscar a nota
-        cursor.execute("""
-            SELECT id, title, content FROM notes 
-            WHERE id = ? AND user_id = ?
-        """, (note_id, current_user["id"]))
-        
-        source_note = cursor.fetchone()
-        if not source_note:
-            raise HTTPException(status_code=404, detail="Nota não encontrada")
-        
-        source_id, source_title, source_content = source_note
-        
-        if not source_content:
-            return {
-                "note_id": source_id,
-                "note_title": source_title,
-                "outlinks": [],
-                "total_outlinks": 0
-            }
+        with db_read() as conn:
+            cursor = conn.cursor()
         
-        # Buscar todas as outras notas para encontrar correspondências
-        cursor.execute("""
-            SELECT id, title, content FROM notes 
-            WHERE user_id = ? AND id != ?
-        """, (current_user["id"], note_id))
-        
-        all_notes = cursor.fetchall()
-        outlinks = []
-        
-        import re
-        
-        # Extrair todos os wiki links da nota fonte
-        wiki_links = re.findall(r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]', source_content)
-        
-        for link_data in wiki_links:
-            link_target = link_data[0].strip()
-            link_display = link_data[1].strip() if link_data[1] else link_target
-            
-            # Buscar nota correspondente
-            matching_note = None
-            for note in all_notes:
-                note_id_target, title, content = note
-                if title.lower() == link_target.lower():
-                    matching_note = {
-                        "note_id": note_id_target,
-                        "title": title,
-                        "exists": True
-                    }
-                    break
-            
-            if not matching_note:
-                # Link quebrado
-                matching_note = {
-                    "note_id": None,
-                    "title": link_target,
-                    "exists": False
+            # Buscar a nota
+            cursor.execute("""
+                SELECT id, title, content FROM notes 
+                WHERE id = ? AND user_id = ?
+            """, (note_id, current_user["id"]))
+        
+            source_note = cursor.fetchone()
+            if not source_note:
+                raise HTTPException(status_code=404, detail="Nota não encontrada")
+        
+            source_id, source_title, source_content = source_note
+        
+            if not source_content:
+                return {
+                    "note_id": source_id,
+                    "note_title": source_title,
+                    "outlinks": [],
+                    "total_outlinks": 0
                 }
-            
-            # Extrair contexto
-            link_pattern = re.escape(f"[[{link_data[0]}]]") if not link_data[1] else re.escape(f"[[{link_data[0]}|{link_data[1]}]]")
-            match = re.search(f'.{{0,50}}{link_pattern}.{{0,50}}', source_content)
-            context = match.group(0) if match else ""
-            
-            outlinks.append({
-                **matching_note,
-                "link_text": link_display,
-                "context": context
-            })
         
-        conn.close()
+            # Links já extraídos e resolvidos no índice note_links
+            cursor.execute("""
+                SELECT l.target_note_id, COALESCE(t.title, l.target_title), l.display_text, l.position, l.length
+                FROM note_links l
+                LEFT JOIN notes t ON t.id = l.target_note_id
+                WHERE l.source_note_id = ?
+                ORDER BY l.position
+            """, (note_id,))
+        
+            outlinks = []
+            for target_id, title, link_display, position, length in cursor.fetchall():
+                outlinks.append({
+                    "note_id": target_id,
+                    "title": title,
+                    "exists": target_id is not None,
+                    "link_text": link_display,
+                    "context": link_context(source_content, position, length)
+                })
         
         return {
             "note_id": source_id,
@@ -2928,67 +6186,53 @@ async def get_note_outlinks(
         print(f"Erro ao buscar outlinks: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
+def build_broken_links(user_id: int) -> dict:
+    with db_read() as conn:
+        cursor = conn.cursor()
+    
+        # Links sem nota de destino ficam com target_note_id nulo no índice
+        cursor.execute("""
+            SELECT l.source_note_id, n.title, l.target_title, l.display_text, l.position, l.length,
+                   substr(n.content, max(l.position - 50, 0) + 1, l.length + 100)
+            FROM note_links l
+            JOIN notes n ON n.id = l.source_note_id
+            WHERE l.user_id = ? AND l.target_note_id IS NULL
+            ORDER BY l.source_note_id, l.position
+        """, (user_id,))
+    
+        broken_links = []
+        for note_id, title, link_target, link_display, position, length, snippet in cursor.fetchall():
+            offset = position - max(position - 50, 0)
+            broken_links.append({
+                "source_note_id": note_id,
+                "source_note_title": title,
+                "broken_link": link_target,
+                "link_display": link_display,
+                "context": link_context(snippet, offset, length)
+            })
+    
+    return {
+        "broken_links": broken_links,
+        "total_broken": len(broken_links)
+    }
+
 @app.get("/api/notes/broken-links")
-async def get_broken_links(
+def get_broken_links(
     current_user: dict = Depends(get_current_user)
 ):
     """
     Retorna todos os links quebrados no sistema do usuário
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, title, content FROM notes WHERE user_id = ?
-        """, (current_user["id"],))
-        
-        all_notes = cursor.fetchall()
-        broken_links = []
-        
-        import re
-        
-        # Criar um mapa de títulos para verificação rápida
-        title_map = {note[1].lower(): note for note in all_notes}
-        
-        for note in all_notes:
-            note_id, title, content = note
-            if content:
-                # Extrair wiki links
-                wiki_links = re.findall(r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]', content)
-                
-                for link_data in wiki_links:
-                    link_target = link_data[0].strip()
-                    link_display = link_data[1].strip() if link_data[1] else link_target
-                    
-                    # Verificar se o link aponta para uma nota existente
-                    if link_target.lower() not in title_map:
-                        # Extrair contexto
-                        link_pattern = re.escape(f"[[{link_data[0]}]]") if not link_data[1] else re.escape(f"[[{link_data[0]}|{link_data[1]}]]")
-                        match = re.search(f'.{{0,50}}{link_pattern}.{{0,50}}', content)
-                        context = match.group(0) if match else ""
-                        
-                        broken_links.append({
-                            "source_note_id": note_id,
-                            "source_note_title": title,
-                            "broken_link": link_target,
-                            "link_display": link_display,
-                            "context": context
-                        })
-        
-        conn.close()
-        
-        return {
-            "broken_links": broken_links,
-            "total_broken": len(broken_links)
-        }
+        return view_cache.get(current_user["id"], "broken_links", (),
+                              lambda: build_broken_links(current_user["id"]))
         
     except Exception as e:
         print(f"Erro ao buscar links quebrados: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
 @app.get("/api/notes/link-suggestions")
-async def get_link_suggestions(
+def get_link_suggestions(
     query: str = Query(..., min_length=2),
     current_user: dict = Depends(get_current_user)
 ):
@@ -2996,40 +6240,38 @@ async def get_link_suggestions(
     Sugere notas para criação de links baseado na query
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        with db_read() as conn:
+            cursor = conn.cursor()
         
-        # Buscar notas que correspondem à query
-        cursor.execute("""
-            SELECT id, title, content, updated_at FROM notes 
-            WHERE user_id = ? AND (title LIKE ? OR content LIKE ?)
-            ORDER BY updated_at DESC
-            LIMIT 10
-        """, (current_user["id"], f"%{query}%", f"%{query}%"))
+            # Buscar notas que correspondem à query
+            cursor.execute("""
+                SELECT id, title, content, updated_at FROM notes 
+                WHERE user_id = ? AND (title LIKE ? OR content LIKE ?)
+                ORDER BY updated_at DESC
+                LIMIT 10
+            """, (current_user["id"], f"%{query}%", f"%{query}%"))
         
-        notes = cursor.fetchall()
-        suggestions = []
+            notes = cursor.fetchall()
+            suggestions = []
         
-        for note in notes:
-            note_id, title, content, updated_at = note
+            for note in notes:
+                note_id, title, content, updated_at = note
             
-            # Calcular relevância
-            title_score = 2 if query.lower() in title.lower() else 0
-            content_score = 1 if query.lower() in content.lower() else 0
-            relevance = title_score + content_score
+                # Calcular relevância
+                title_score = 2 if query.lower() in title.lower() else 0
+                content_score = 1 if query.lower() in content.lower() else 0
+                relevance = title_score + content_score
             
-            suggestions.append({
-                "note_id": note_id,
-                "title": title,
-                "snippet": content[:100] + "..." if len(content) > 100 else content,
-                "updated_at": updated_at,
-                "relevance": relevance
-            })
+                suggestions.append({
+                    "note_id": note_id,
+                    "title": title,
+                    "snippet": content[:100] + "..." if len(content) > 100 else content,
+                    "updated_at": updated_at,
+                    "relevance": relevance
+                })
         
-        # Ordenar por relevância
-        suggestions.sort(key=lambda x: x["relevance"], reverse=True)
-        
-        conn.close()
+            # Ordenar por relevância
+            suggestions.sort(key=lambda x: x["relevance"], reverse=True)
         
         return {
             "query": query,
@@ -3042,52 +6284,44 @@ async def get_link_suggestions(
 
 # =================== QUICK SWITCHER / BUSCA GLOBAL ===================
 
-@app.get("/api/search/global")
-async def global_search(
-    query: str = Query(..., min_length=1),
-    limit: int = Query(10, le=50),
-    current_user: dict = Depends(get_current_user)
-):
-    """
-    Busca global por notas, tags e pastas para o Quick Switcher
-    """
-    try:
-        conn = get_db_connection()
+def build_global_search(user_id: int, query: str, limit: int) -> dict:
+    with db_read() as conn:
         cursor = conn.cursor()
-        
+    
         results = []
         query_lower = query.lower()
-        
-        # Buscar notas
-        cursor.execute("""
-            SELECT id, title, content, updated_at, folder_id FROM notes 
-            WHERE user_id = ? AND (
-                LOWER(title) LIKE ? OR 
-                LOWER(content) LIKE ?
-            )
-            ORDER BY 
-                CASE 
-                    WHEN LOWER(title) = ? THEN 1
-                    WHEN LOWER(title) LIKE ? THEN 2
-                    WHEN LOWER(title) LIKE ? THEN 3
-                    ELSE 4
-                END,
-                updated_at DESC
-            LIMIT ?
-        """, (
-            current_user["id"], 
-            f"%{query_lower}%", 
-            f"%{query_lower}%",
-            query_lower,  # título exato
-            f"{query_lower}%",  # título começa com
-            f"%{query_lower}%",  # título contém
-            limit
-        ))
-        
-        notes = cursor.fetchall()
+        match = fts_query(query)
+    
+        # Buscar notas (snippet e destaque gerados pelo FTS5)
+        notes = []
+        if match is not None:
+            cursor.execute(f"""
+                SELECT n.id, n.title, n.content, n.updated_at, n.folder_id,
+                       snippet(notes_fts, 1, '', '', '...', 16),
+                       snippet(notes_fts, 1, '<mark>', '</mark>', '...', 16)
+                FROM notes_fts
+                JOIN notes n ON n.id = notes_fts.rowid
+                WHERE notes_fts MATCH ? AND n.user_id = ?
+                ORDER BY 
+                    CASE 
+                        WHEN LOWER(n.title) = ? THEN 1
+                        WHEN LOWER(n.title) LIKE ? THEN 2
+                        ELSE 3
+                    END,
+                    {FTS_RANK}
+                LIMIT ?
+            """, (
+                match,
+                user_id,
+                query_lower,  # título exato
+                f"{query_lower}%",  # título começa com
+                limit
+            ))
+            notes = cursor.fetchall()
+    
         for note in notes:
-            note_id, title, content, updated_at, folder_id = note
-            
+            note_id, title, content, updated_at, folder_id, snippet, highlight = note
+        
             # Calcular score de relevância
             score = 0
             if title.lower() == query_lower:
@@ -3096,37 +6330,21 @@ async def global_search(
                 score = 50
             elif query_lower in title.lower():
                 score = 20
-            
+        
             if content and query_lower in content.lower():
                 score += 10
-            
-            # Snippet do conteúdo
-            snippet = ""
-            if content:
-                # Encontrar a primeira ocorrência da query no conteúdo
-                content_lower = content.lower()
-                query_index = content_lower.find(query_lower)
-                if query_index != -1:
-                    start = max(0, query_index - 50)
-                    end = min(len(content), query_index + len(query) + 50)
-                    snippet = content[start:end]
-                    if start > 0:
-                        snippet = "..." + snippet
-                    if end < len(content):
-                        snippet = snippet + "..."
-                else:
-                    snippet = content[:100] + ("..." if len(content) > 100 else "")
-            
+        
             results.append({
                 "id": note_id,
                 "title": title,
                 "type": "note",
                 "snippet": snippet,
+                "highlight": highlight,
                 "updated_at": updated_at,
                 "folder_id": folder_id,
                 "score": score
             })
-        
+    
         # Buscar pastas
         cursor.execute("""
             SELECT id, name, parent_id FROM folders 
@@ -3139,17 +6357,17 @@ async def global_search(
                 END
             LIMIT ?
         """, (
-            current_user["id"], 
+            user_id, 
             f"%{query_lower}%",
             query_lower,
             f"{query_lower}%",
             5  # Limitar pastas
         ))
-        
+    
         folders = cursor.fetchall()
         for folder in folders:
             folder_id, name, parent_id = folder
-            
+        
             score = 0
             if name.lower() == query_lower:
                 score = 80
@@ -3157,7 +6375,7 @@ async def global_search(
                 score = 40
             else:
                 score = 15
-            
+        
             results.append({
                 "id": folder_id,
                 "title": name,
@@ -3166,25 +6384,17 @@ async def global_search(
                 "parent_id": parent_id,
                 "score": score
             })
-        
-        # Buscar tags (usar sistema de tags existente)
+    
+        # Buscar tags (usar o índice note_tags)
         cursor.execute("""
-            SELECT id, title, content FROM notes WHERE user_id = ?
-        """, (current_user["id"],))
-        
-        all_notes = cursor.fetchall()
-        tag_matches = set()
-        
-        import re
-        for note in all_notes:
-            note_id, title, content = note
-            if content:
-                tags = re.findall(r'#([a-zA-Z0-9_/-]+)', content)
-                for tag in tags:
-                    if query_lower in tag.lower():
-                        tag_matches.add(tag)
-        
-        for tag in list(tag_matches)[:5]:  # Limitar tags
+            SELECT DISTINCT tag FROM note_tags
+            WHERE user_id = ? AND path = tag AND instr(lower(tag), ?) > 0
+            LIMIT 5
+        """, (user_id, query_lower))
+    
+        tag_matches = [row[0] for row in cursor.fetchall()]
+    
+        for tag in tag_matches:  # Limitar tags
             score = 0
             if tag.lower() == query_lower:
                 score = 70
@@ -3192,7 +6402,7 @@ async def global_search(
                 score = 35
             else:
                 score = 12
-            
+        
             results.append({
                 "id": f"tag-{tag}",
                 "title": f"#{tag}",
@@ -3201,86 +6411,81 @@ async def global_search(
                 "tag": tag,
                 "score": score
             })
-        
-        conn.close()
-        
-        # Ordenar por score e limitar
-        results.sort(key=lambda x: x["score"], reverse=True)
-        results = results[:limit]
-        
-        return {
-            "query": query,
-            "results": results,
-            "total": len(results)
-        }
-        
-    except Exception as e:
-        print(f"Erro na busca global: {str(e)}")
-        raise HTTPException(status_code=500, detail="Erro interno do servidor")
+    
+    # Ordenar por score e limitar
+    results.sort(key=lambda x: x["score"], reverse=True)
+    results = results[:limit]
+    
+    return {
+        "query": query,
+        "results": results,
+        "total": len(results)
+    }
 
-@app.get("/notes/search")
-async def search_notes(
+@app.get("/api/search/global")
+def global_search(
     query: str = Query(..., min_length=1),
     limit: int = Query(10, le=50),
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Busca específica em notas para compatibilidade
+    Busca global por notas, tags e pastas para o Quick Switcher
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        query_lower = query.lower()
-        
-        cursor.execute("""
-            SELECT id, title, content, created_at, updated_at, folder_id 
-            FROM notes 
-            WHERE user_id = ? AND (
-                LOWER(title) LIKE ? OR 
-                LOWER(content) LIKE ?
-            )
-            ORDER BY 
-                CASE 
-                    WHEN LOWER(title) = ? THEN 1
-                    WHEN LOWER(title) LIKE ? THEN 2
-                    WHEN LOWER(title) LIKE ? THEN 3
-                    ELSE 4
-                END,
-                updated_at DESC
-            LIMIT ?
-        """, (
-            current_user["id"], 
-            f"%{query_lower}%", 
-            f"%{query_lower}%",
-            query_lower,
-            f"{query_lower}%",
-            f"%{query_lower}%",
-            limit
-        ))
-        
-        notes = cursor.fetchall()
-        results = []
-        
-        for note in notes:
-            note_id, title, content, created_at, updated_at, folder_id = note
-            results.append({
-                "id": note_id,
-                "title": title,
-                "content": content[:200] + ("..." if len(content or "") > 200 else ""),
-                "created_at": created_at,
-                "updated_at": updated_at,
-                "folder_id": folder_id
-            })
-        
-        conn.close()
-        
-        return results
+        return view_cache.get(current_user["id"], "global_search", (query, limit),
+                              lambda: build_global_search(current_user["id"], query, limit))
         
     except Exception as e:
-        print(f"Erro na busca de notas: {str(e)}")
+        print(f"Erro na busca global: {str(e)}")
         raise HTTPException(status_code=500, detail="Erro interno do servidor")
 
+@app.on_event("startup")
+async def configure_db_executor():
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = DB_WORKERS
+    instrument_thread_limiter(limiter)
+    version_compactor.start(VERSION_COMPACT_INTERVAL)
+
+@app.on_event("shutdown")
+async def close_database_pool():
+    version_compactor.stop()
+    password_hasher.shutdown()
+    # Última gravação das edições pendentes antes de fechar as conexões
+    await flush_all_canvas_changes()
+    note_write_buffer.flush()
+    db_pool.close()
+
 if __name__ == "__main__":
     init_db()
+    
+    # python main.py rebuild-indexes  -> reconstrói os índices derivados e sai
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-indexes":
+        with db_write() as conn:
+            rebuild_note_indexes(conn.cursor())
+        print("Índices reconstruídos")
+        sys.exit(0)
+    
+    # python main.py compact-versions  -> comprime as versões antigas (texto puro) e mostra o espaço economizado
+    if len(sys.argv) > 1 and sys.argv[1] == "compact-versions":
+        with db_write() as conn:
+            report = compact_note_versions(conn.cursor())
+        print(f"Versões convertidas: {report['versions']} em {report['notes']} notas")
+        print(f"Antes: {report['bytes_before']} bytes, depois: {report['bytes_after']} bytes "
+              f"({report['saved_percent']}% economizado)")
+        print("Rode VACUUM para devolver o espaço livre ao sistema de arquivos")
+        sys.exit(0)
+    
+    # python main.py prune-versions [--dry-run]  -> aplica a retenção de versões agora
+    if len(sys.argv) > 1 and sys.argv[1] == "prune-versions":
+        dry_run = "--dry-run" in sys.argv[2:]
+        results = version_compactor.run_once(dry_run=dry_run)
+        for note_id, result in results.items():
+            if result["pruned"]:
+                print(f"Nota {note_id}: {result['pruned']} versões, {result['bytes_reclaimed']} bytes")
+        pruned = sum(result["pruned"] for result in results.values())
+        reclaimed = sum(result["bytes_reclaimed"] for result in results.values())
+        verb = "seriam removidas" if dry_run else "removidas"
+        print(f"Política {VERSION_RETENTION_POLICY}: {pruned} versões {verb} ({reclaimed} bytes)")
+        sys.exit(0)
+    
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,20 @@
+"""
+Hash de senhas (bcrypt) isolado do main.py.
+
+As funções daqui são as que rodam nos processos do pool de hashing do main.py
+(PasswordHasher); ficam num módulo próprio para o pickle do ProcessPoolExecutor
+achá-las sem depender do estado da aplicação.
+"""
+import os
+
+from passlib.context import CryptContext
+
+BCRYPT_ROUNDS = int(os.getenv("BURESIDIAN_BCRYPT_ROUNDS", "12"))  # custo do bcrypt (2^rounds iterações)
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
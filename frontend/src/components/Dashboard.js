@@ -34,7 +34,7 @@ const Dashboard = () => {
         axios.get('/notes')
       ]);
       setFolders(foldersResponse.data);
-      setNotes(notesResponse.data);
+      setNotes(notesResponse.data.notes);
     } catch (error) {
       console.error('Error loading data:', error);
     } finally {
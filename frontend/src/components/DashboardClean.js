@@ -819,7 +819,7 @@ const DashboardClean = () => {
         axios.get('/notes')
       ]);
       setFolders(foldersResponse.data);
-      setNotes(notesResponse.data);
+      setNotes(notesResponse.data.notes);
     } catch (error) {
       console.error('Error loading data:', error);
     } finally {
@@ -1,29 +1,62 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useCallback } from 'react';
 import { History, RotateCcw, Save, Clock, User, FileText } from 'lucide-react';
 import axios from 'axios';
 import '../styles/VersionHistory.css';
 
 const VersionHistory = ({ noteId, isOpen, onClose, onVersionRestore }) => {
   const [versions, setVersions] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(false);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [selectedVersion, setSelectedVersion] = useState(null);
   const [previewMode, setPreviewMode] = useState(false);
 
+  // A listagem traz só metadados; o conteúdo é buscado ao abrir a prévia
+  const loadVersions = useCallback(async () => {
+    setLoading(true);
+    try {
+      const response = await axios.get(`/notes/${noteId}/versions`, { params: { limit: 50 } });
+      setVersions(response.data.versions);
+      setNextCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Error loading versions:', error);
+    } finally {
+      setLoading(false);
+    }
+  }, [noteId]);
+
   useEffect(() => {
     if (isOpen && noteId) {
       loadVersions();
     }
   }, [isOpen, noteId, loadVersions]);
 
-  const loadVersions = async () => {
-    setLoading(true);
+  const loadMoreVersions = async () => {
+    setLoadingMore(true);
     try {
-      const response = await axios.get(`/notes/${noteId}/versions`);
-      setVersions(response.data);
+      const response = await axios.get(`/notes/${noteId}/versions`, {
+        params: { limit: 50, before: nextCursor }
+      });
+      setVersions(prev => [...prev, ...response.data.versions]);
+      setNextCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Error loading versions:', error);
     } finally {
-      setLoading(false);
+      setLoadingMore(false);
+    }
+  };
+
+  const previewVersion = async (version) => {
+    setSelectedVersion(version);
+    setPreviewMode(true);
+    if (version.content !== undefined) return;
+
+    try {
+      const response = await axios.get(`/notes/${noteId}/versions/${version.id}`);
+      setVersions(prev => prev.map(v => (v.id === version.id ? { ...v, content: response.data.content } : v)));
+      setSelectedVersion(current => (current?.id === version.id ? { ...current, content: response.data.content } : current));
+    } catch (error) {
+      console.error('Error loading version:', error);
     }
   };
 
@@ -70,8 +103,7 @@ const VersionHistory = ({ noteId, isOpen, onClose, onVersionRestore }) => {
   };
 
   const getVersionDiff = (version) => {
-    const contentLength = version.content.length;
-    return `${contentLength} caracteres`;
+    return `${version.content_length} caracteres`;
   };
 
   if (!isOpen) return null;
@@ -150,8 +182,7 @@ const VersionHistory = ({ noteId, isOpen, onClose, onVersionRestore }) => {
                         <button 
                           onClick={(e) => {
                             e.stopPropagation();
-                            setSelectedVersion(version);
-                            setPreviewMode(true);
+                            previewVersion(version);
                           }}
                           className="preview-btn"
                         >
@@ -171,6 +202,15 @@ const VersionHistory = ({ noteId, isOpen, onClose, onVersionRestore }) => {
                     </div>
                   ))
                 )}
+                {nextCursor !== null && (
+                  <button
+                    onClick={loadMoreVersions}
+                    disabled={loadingMore}
+                    className="load-more-versions-btn"
+                  >
+                    {loadingMore ? 'Carregando...' : 'Carregar versões anteriores'}
+                  </button>
+                )}
               </div>
 
               {selectedVersion && previewMode && (
@@ -190,7 +230,9 @@ const VersionHistory = ({ noteId, isOpen, onClose, onVersionRestore }) => {
                     </div>
                     <div className="preview-body">
                       <strong>Conteúdo:</strong>
-                      <pre className="preview-text">{selectedVersion.content}</pre>
+                      <pre className="preview-text">
+                        {selectedVersion.content === undefined ? 'Carregando...' : selectedVersion.content}
+                      </pre>
                     </div>
                   </div>
                 </div>
@@ -125,16 +125,14 @@ const QuickSwitcher = ({ isOpen, onClose }) => {
     const loadRecentNotes = async () => {
         try {
             const token = localStorage.getItem('token');
+            // Só os campos exibidos; a API já devolve as mais recentes primeiro
             const response = await axios.get('/notes', {
-                headers: { Authorization: `Bearer ${token}` }
+                headers: { Authorization: `Bearer ${token}` },
+                params: { fields: 'title,folder_id,updated_at', limit: 5 }
             });
             
             // Simular notas recentes (normalmente seria baseado em último acesso)
-            const recent = response.data
-                .sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at))
-                .slice(0, 5);
-            
-            setRecentNotes(recent);
+            setRecentNotes(response.data.notes);
         } catch (error) {
             console.error('Erro ao carregar notas recentes:', error);
         }
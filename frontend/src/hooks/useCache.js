@@ -1,17 +1,27 @@
 import { useCallback, useRef, useState } from 'react';
 
 /**
- * Hook para cache inteligente de dados com TTL e invalidação automática
+ * Hook para cache inteligente de dados com TTL e invalidação automática.
+ * Se a resposta tinha ETag, a cópia continua guardada depois do TTL para
+ * revalidar com If-None-Match (ver getValidator).
  */
 export const useSmartCache = (ttl = 5 * 60 * 1000) => { // 5 minutos default
   const cache = useRef(new Map());
   const timestamps = useRef(new Map());
+  const validators = useRef(new Map());
 
-  const set = useCallback((key, data) => {
+  const set = useCallback((key, data, etag = null) => {
     cache.current.set(key, data);
     timestamps.current.set(key, Date.now());
+    if (etag) {
+      validators.current.set(key, { etag, data });
+    } else {
+      validators.current.delete(key);
+    }
   }, []);
 
+  const getValidator = useCallback((key) => validators.current.get(key) || null, []);
+
   const get = useCallback((key) => {
     const data = cache.current.get(key);
     const timestamp = timestamps.current.get(key);
@@ -34,10 +44,12 @@ export const useSmartCache = (ttl = 5 * 60 * 1000) => { // 5 minutos default
     if (key) {
       cache.current.delete(key);
       timestamps.current.delete(key);
+      validators.current.delete(key);
     } else {
       // Limpar todo o cache
       cache.current.clear();
       timestamps.current.clear();
+      validators.current.clear();
     }
   }, []);
 
@@ -54,14 +66,14 @@ export const useSmartCache = (ttl = 5 * 60 * 1000) => { // 5 minutos default
     return cache.current.has(key);
   }, [ttl, invalidate]);
 
-  return { set, get, invalidate, has };
+  return { set, get, invalidate, has, getValidator };
 };
 
 /**
  * Hook para cache de requisições API com debounce
  */
 export const useApiCache = () => {
-  const { set, get, invalidate, has } = useSmartCache();
+  const { set, get, invalidate, has, getValidator } = useSmartCache();
   const pendingRequests = useRef(new Map());
 
   const cachedFetch = useCallback(async (url, options = {}) => {
@@ -77,11 +89,22 @@ export const useApiCache = () => {
       return pendingRequests.current.get(cacheKey);
     }
 
-    // Fazer a requisição
-    const promise = fetch(url, options)
-      .then(response => response.json())
-      .then(data => {
-        set(cacheKey, data);
+    // Fazer a requisição (condicional se já temos uma cópia com ETag)
+    const validator = getValidator(cacheKey);
+    const headers = validator
+      ? { ...(options.headers || {}), 'If-None-Match': validator.etag }
+      : options.headers;
+
+    const promise = fetch(url, { ...options, headers })
+      .then(async response => {
+        // 304: nada mudou no servidor, reaproveita a cópia local
+        if (response.status === 304 && validator) {
+          return { data: validator.data, etag: validator.etag };
+        }
+        return { data: await response.json(), etag: response.headers.get('ETag') };
+      })
+      .then(({ data, etag }) => {
+        set(cacheKey, data, etag);
         pendingRequests.current.delete(cacheKey);
         return data;
       })
@@ -92,7 +115,7 @@ export const useApiCache = () => {
 
     pendingRequests.current.set(cacheKey, promise);
     return promise;
-  }, [set, get, has]);
+  }, [set, get, has, getValidator]);
 
   return { cachedFetch, invalidateCache: invalidate };
 };